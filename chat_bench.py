@@ -0,0 +1,413 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import gc
+import tracemalloc
+
+from chat_protocol import CAP_FRAMED, build_hello
+from chat_core import AsyncChatClient
+from chat_server import ChatServer, raise_fd_limit
+from chat_mux import MuxLink, MuxSession
+from chat_log import LogWriter
+
+# Headless load generator: N bot connections against the server, directly or
+# through the relay, each one a chat_core client. Every bot message carries its
+# send time, so receivers can measure end-to-end latency. Results go to a JSON file for comparing runs.
+#
+# The server's rate limiter would reject most of the load, start it with
+# --rate 0 (--spawn-server does that).
+
+HOST = '127.0.0.1'
+PORT = 8888
+RELAY_PORT = 8889
+OUTPUT = "bench_results.json"
+MARKER = "bench "
+# --idle-sessions: the most server memory one idle client may take
+IDLE_BUDGET = 2048
+
+class LatencyRecorder:
+    """Log-scale histogram of latencies, 1% resolution, so millions of samples stay cheap"""
+    GROWTH = 1.01
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        bucket = int(math.log(micros, self.GROWTH))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples, in milliseconds, never above the max"""
+        if not self.count:
+            return None
+        rank = math.ceil(fraction * self.count)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return round(min(self.GROWTH ** (bucket + 1) / 1000, self.max * 1000), 3)
+        return round(self.max * 1000, 3)
+
+    def summary(self):
+        return {
+            "samples": self.count,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "p999_ms": self.percentile(0.999),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+class Bot(AsyncChatClient):
+    """One simulated user, a chat_core client that counts what it receives and samples latencies"""
+
+    def __init__(self, bench, index):
+        args = bench.args
+        # no resumable session, a dropped bot is a failure to measure rather than something to hide
+        super().__init__(f"bot{index}", args.host, args.port, args.relay, args.host, args.relay_port,
+                         track_users=False, resumable=False)
+        self.bench = bench
+        self.sent_public = 0
+        self.sent_private = 0
+        self.received = 0
+        # recv calls that returned data, fewer than messages when the server batches its writes
+        self.reads = 0
+
+    async def handshake(self):
+        """Connect and wait for the welcome, returns the time it took. Reading starts with receive"""
+        started = time.perf_counter()
+        await self.open()
+        return time.perf_counter() - started
+
+    def receive(self):
+        self.receiver = asyncio.ensure_future(self.receive_loop())
+        return self.receiver
+
+    def feed(self, data):
+        self.reads += 1
+        super().feed(data)
+
+    def dispatch(self, message):
+        self.received += 1
+        self.bench.received += 1
+        marker = message.find(": " + MARKER)
+        if marker >= 0 and "[Private to" not in message:
+            sent_ns = int(message.rsplit(" ", 1)[-1])
+            latency = (time.time_ns() - sent_ns) / 1e9
+            if "[Private]" in message:
+                self.bench.private_latency.record(latency)
+            else:
+                self.bench.public_latency.record(latency)
+        super().dispatch(message)
+
+    async def send_loop(self, rate, private, deadline):
+        """Send messages at rate per second until the deadline"""
+        if rate <= 0:
+            return
+        interval = 1 / rate
+        # spread the bots over the first interval so they do not send in lockstep
+        await asyncio.sleep(random.random() * interval)
+        seq = 0
+        while time.perf_counter() < deadline:
+            seq += 1
+            text = f"{MARKER}{seq} {time.time_ns()}"
+            if private:
+                await self.send_private(self.bench.random_peer(self), text)
+                self.sent_private += 1
+            else:
+                await self.send(text)
+                self.sent_public += 1
+            await asyncio.sleep(interval)
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.host = args.host
+        self.port = args.relay_port if args.relay else args.port
+        self.bots = [Bot(self, i) for i in range(args.clients)]
+        self.public_latency = LatencyRecorder()
+        self.private_latency = LatencyRecorder()
+        self.connect_times = LatencyRecorder()
+        self.connect_failures = 0
+        self.received = 0
+
+    def random_peer(self, bot):
+        peer = bot
+        while peer is bot and len(self.bots) > 1:
+            peer = random.choice(self.bots)
+        # as the server knows it, with the relay's '*'
+        return peer.nickname
+
+    async def connect_all(self):
+        limit = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def connect(bot):
+            async with limit:
+                try:
+                    self.connect_times.record(await bot.handshake())
+                except (ConnectionError, OSError):
+                    self.connect_failures += 1
+
+        await asyncio.gather(*(connect(bot) for bot in self.bots))
+        self.bots = [bot for bot in self.bots if bot.welcomed]
+
+    async def run(self):
+        server_pid = self.args.server_pid
+        rss_before = read_rss(server_pid)
+
+        started = time.perf_counter()
+        await self.connect_all()
+        connect_seconds = time.perf_counter() - started
+        print(f"[Bench] {len(self.bots)} connected in {connect_seconds:.2f}s, {self.connect_failures} failed")
+
+        # let the join storm settle before measuring memory and traffic
+        await asyncio.sleep(self.args.settle)
+        rss_connected = read_rss(server_pid)
+
+        receivers = [bot.receive() for bot in self.bots]
+        received_before = self.received
+        cpu_before = read_cpu(server_pid), read_cpu(self.args.relay_pid)
+        deadline = time.perf_counter() + self.args.duration
+        started = time.perf_counter()
+        senders = []
+        for bot in self.bots:
+            senders.append(bot.send_loop(self.args.public_rate, False, deadline))
+            senders.append(bot.send_loop(self.args.private_rate, True, deadline))
+        await asyncio.gather(*senders, return_exceptions=True)
+        # in-flight messages
+        await asyncio.sleep(self.args.drain)
+        elapsed = time.perf_counter() - started
+        received = self.received - received_before
+        cpu_after = read_cpu(server_pid), read_cpu(self.args.relay_pid)
+
+        await asyncio.gather(*(bot.close() for bot in self.bots), return_exceptions=True)
+
+        reads = sum(bot.reads for bot in self.bots)
+        sent_public = sum(bot.sent_public for bot in self.bots)
+        sent_private = sum(bot.sent_private for bot in self.bots)
+        results = {
+            "config": {
+                "target": "relay" if self.args.relay else "server",
+                "host": self.host,
+                "port": self.port,
+                "clients": self.args.clients,
+                "duration": self.args.duration,
+                "public_rate": self.args.public_rate,
+                "private_rate": self.args.private_rate,
+                "server_args": self.args.server_arg,
+                "server_socket": self.args.server_socket,
+            },
+            "connect": dict(self.connect_times.summary(), seconds=round(connect_seconds, 3),
+                            failures=self.connect_failures),
+            "sent": {"public": sent_public, "private": sent_private,
+                     "per_second": round((sent_public + sent_private) / elapsed, 1)},
+            "received": {"messages": received, "per_second": round(received / elapsed, 1), "reads": reads,
+                         "messages_per_read": round(received / reads, 2) if reads else None},
+            "latency": {"public": self.public_latency.summary(), "private": self.private_latency.summary()},
+            "memory": memory_summary(rss_before, rss_connected, len(self.bots)),
+            "cpu": cpu_summary(cpu_before, cpu_after, received),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        return results
+
+def idle_session_memory(count, budget):
+    """Register count idle clients with an in-process server and measure the memory each one takes.
+
+    The clients are sessions of a fan-out relay link, so they need no sockets or
+    writer threads and a join costs one frame for the link rather than a message
+    for every member. What is measured is the server's own state per client:
+    the registry record, outbox, codec, rate limit and room index entries.
+    """
+    gc.collect()
+    rss_before = read_rss(os.getpid())
+    tracemalloc.start()
+    # the user list updates would go out after the measurement
+    server = ChatServer(HOST, PORT, log_writer=LogWriter(os.devnull), delta_window=3600)
+    link = MuxLink("bench", fanout=True)
+    heap_before, _ = tracemalloc.get_traced_memory()
+
+    started = time.perf_counter()
+    for session_id in range(1, count + 1):
+        session = link.sessions[session_id] = MuxSession(link, session_id)
+        session.nickname, _ = server.register_client(session, build_hello(f"idle{session_id}", [CAP_FRAMED]),
+                                                     ("127.0.0.1", None))
+        if not session_id % 1000:
+            # what the link's writer would send
+            link.collect(link.take_nowait())
+    link.collect(link.take_nowait())
+    register_seconds = time.perf_counter() - started
+
+    gc.collect()
+    heap_after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = read_rss(os.getpid())
+    per_session = round((heap_after - heap_before) / count)
+    return {
+        "config": {"idle_sessions": count, "budget": budget},
+        "register_seconds": round(register_seconds, 3),
+        "heap_bytes": heap_after - heap_before,
+        "bytes_per_session": per_session,
+        "rss_bytes_per_session": round((rss_after - rss_before) / count) if rss_before and rss_after else None,
+        "within_budget": per_session <= budget,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+def read_rss(pid):
+    """Resident set size of a process in bytes, Linux only"""
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def read_cpu(pid):
+    """CPU seconds a process has used, user and system, Linux only"""
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # the fields after the command name, which is in parentheses and may contain spaces
+            fields = stat.read().rpartition(")")[2].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def cpu_summary(before, after, messages):
+    """CPU the server and the relay spent on the traffic, in total and per delivered message"""
+    summary = {}
+    for name, used_before, used_after in zip(("server", "relay"), before, after):
+        if used_before is None or used_after is None:
+            continue
+        seconds = used_after - used_before
+        summary[f"{name}_seconds"] = round(seconds, 3)
+        summary[f"{name}_us_per_message"] = round(seconds / messages * 1e6, 2) if messages else None
+    return summary or None
+
+def memory_summary(before, after, connections):
+    if before is None or after is None:
+        return None
+    return {
+        "server_rss_before": before,
+        "server_rss_connected": after,
+        "bytes_per_connection": round((after - before) / connections) if connections else None,
+    }
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def spawn(script, args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, os.path.join(here, script)] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat load generator and benchmark')
+    parser.add_argument('--host', dest="host", default=HOST, help=f'Server (or relay) host (default: {HOST})')
+    parser.add_argument('--port', dest="port", type=int, default=PORT, help=f'Server port (default: {PORT})')
+    parser.add_argument('--relay', dest="relay", action='store_true', help='Connect through the relay')
+    parser.add_argument('--relay-port', dest="relay_port", type=int, default=RELAY_PORT,
+                        help=f'Relay port (default: {RELAY_PORT})')
+    parser.add_argument('--clients', dest="clients", type=int, default=100, help='Bot connections (default: 100)')
+    parser.add_argument('--duration', dest="duration", type=float, default=10, help='Seconds of traffic (default: 10)')
+    parser.add_argument('--public-rate', dest="public_rate", type=float, default=1,
+                        help='Public messages per second per bot (default: 1)')
+    parser.add_argument('--private-rate', dest="private_rate", type=float, default=0,
+                        help='Private messages per second per bot (default: 0)')
+    parser.add_argument('--connect-concurrency', dest="connect_concurrency", type=int, default=200,
+                        help='Connections opened at the same time (default: 200)')
+    parser.add_argument('--settle', dest="settle", type=float, default=1,
+                        help='Seconds to wait after connecting before sending (default: 1)')
+    parser.add_argument('--drain', dest="drain", type=float, default=1,
+                        help='Seconds to wait for in-flight messages after sending stops (default: 1)')
+    parser.add_argument('--server-pid', dest="server_pid", type=int,
+                        help='PID of the server, to report its memory per connection and its CPU time')
+    parser.add_argument('--relay-pid', dest="relay_pid", type=int,
+                        help='PID of the relay, to report its CPU time')
+    parser.add_argument('--server-socket', dest="server_socket", metavar="PATH",
+                        help='With --spawn-server and --relay, connect the relay to the server through a Unix socket '
+                             'at PATH instead of TCP')
+    parser.add_argument('--spawn-server', dest="spawn_server", action='store_true',
+                        help='Start chat_server.py (and chat_relay.py with --relay) for the run')
+    parser.add_argument('--server-arg', dest="server_arg", action='append', default=[],
+                        help='Extra argument for the spawned server, repeatable (e.g. --server-arg=--engine=asyncio)')
+    parser.add_argument('--relay-arg', dest="relay_arg", action='append', default=[],
+                        help='Extra argument for the spawned relay, repeatable (e.g. --relay-arg=--upstreams=0)')
+    parser.add_argument('--idle-sessions', dest="idle_sessions", type=int,
+                        help='Instead of a load run, hold this many idle clients in-process and check their memory')
+    parser.add_argument('--idle-budget', dest="idle_budget", type=int, default=IDLE_BUDGET,
+                        help=f'Server bytes allowed per idle client with --idle-sessions (default: {IDLE_BUDGET})')
+    parser.add_argument('--output', dest="output", default=OUTPUT, help=f'Results file (default: {OUTPUT})')
+    args = parser.parse_args()
+    if args.server_socket and not (args.spawn_server and args.relay):
+        parser.error("--server-socket is for the relay the benchmark spawns, it needs --spawn-server and --relay")
+
+    if args.idle_sessions:
+        results = idle_session_memory(args.idle_sessions, args.idle_budget)
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(json.dumps(results, indent=2))
+        if not results["within_budget"]:
+            print(f"[Bench] {results['bytes_per_session']} bytes per idle session, over the budget of {args.idle_budget}")
+            sys.exit(1)
+        return
+
+    raise_fd_limit()
+    processes = []
+    try:
+        if args.spawn_server:
+            server_args = ["--host", args.host, "--port", str(args.port), "--rate", "0"]
+            if args.server_socket:
+                server_args += ["--unix-socket", args.server_socket]
+            server = spawn("chat_server.py", server_args + args.server_arg)
+            processes.append(server)
+            args.server_pid = server.pid
+            wait_for_port(args.host, args.port)
+            if args.relay:
+                relay_args = [
+                    "--relay-host", args.host, "--relay-port", str(args.relay_port),
+                    "--server-host", args.host, "--server-port", str(args.port),
+                ]
+                if args.server_socket:
+                    relay_args += ["--server-socket", args.server_socket]
+                relay = spawn("chat_relay.py", relay_args + args.relay_arg)
+                processes.append(relay)
+                args.relay_pid = relay.pid
+                wait_for_port(args.host, args.relay_port)
+
+        results = asyncio.run(Benchmark(args).run())
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"[Bench] Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
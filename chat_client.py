@@ -1,119 +1,177 @@
-import socket
+import asyncio
 import threading
+import queue
+import functools
 import argparse
 import tkinter as tk
 from tkinter import scrolledtext, simpledialog, messagebox
+from chat_core import (AsyncChatClient, PrivateMessage, UserList, Reconnected, Disconnected, HOST, PORT, LOBBY)
+from chat_scrollback import Scrollback
 
-# Default settings
-HOST = '127.0.0.1'
-PORT = 8888
-BUFSIZE = 4096
+# seconds to wait for the goodbye when the window closes
+DISCONNECT_TIMEOUT = 2.0
+
+# milliseconds between GUI updates, everything received in between is shown at once
+UPDATE_INTERVAL = 50
+
+# lines a chat window's text widget keeps, older ones are loaded back a page at a time when scrolled to
+SCROLLBACK_LINES = 1000
+SCROLLBACK_PAGE = 200
 
 class ChatClient:
-    def __init__(self, host, port, use_relay=False, relay_host=None, relay_port=None):
+    """Tk view over an AsyncChatClient, which runs on an event loop in a thread of its own"""
+    
+    def __init__(self, host, port, use_relay=False, relay_host=None, relay_port=None, framed=True, compress=False,
+                 scrollback=SCROLLBACK_LINES):
         """Initialize the chat client"""
         self.host = host
         self.port = port
         self.use_relay = use_relay
-        self.relay_host = relay_host if relay_host else host
-        self.relay_port = relay_port if relay_port else port + 1
-        self.socket = None
+        self.relay_host = relay_host
+        self.relay_port = relay_port
+        self.framed = framed
+        self.compress = compress
+        self.core = None
+        self.loop = asyncio.new_event_loop()
+        self.network_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
         self.nickname = None
         self.private_windows = {}
+        # user lists per room, the list box shows the room we are talking in
+        self.room_users = {}
+        self.current_room = LOBBY
+        self.scrollback = scrollback
+        # the network thread never touches Tk: it queues the core's events, and functions to run
+        # on the Tk thread, for process_inbox
+        self.inbox = queue.SimpleQueue()
+        # the user list box is rebuilt at most once per update
+        self.users_dirty = False
         self.running = False
-        self.receive_thread = None
         
     def connect(self):
         """Connect to the chat server"""
+        # the Tk thread keeps its own user lists, the core need not
+        self.core = AsyncChatClient(self.nickname, self.host, self.port, self.use_relay, self.relay_host,
+                                    self.relay_port, self.framed, self.compress, track_users=False)
+        if not self.network_thread.is_alive():
+            self.network_thread.start()
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
-            # Connect to either the relay or directly to the server
-            if self.use_relay:
-                self.socket.connect((self.relay_host, self.relay_port))
-                print(f"Connected to relay at {self.relay_host}:{self.relay_port}")
-            else:
-                self.socket.connect((self.host, self.port))
-                print(f"Connected directly to server at {self.host}:{self.port}")
-            
-            self.socket.send(self.nickname.encode('utf-8'))
-            
-            return True
+            asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
         except Exception as e:
             print(f"Connection error: {e}")
             return False
-            
+        
+        if self.use_relay:
+            print(f"Connected to relay at {self.core.relay_host}:{self.core.relay_port}")
+        else:
+            print(f"Connected directly to server at {self.host}:{self.port}")
+        # the server or the relay may have changed it
+        self.nickname = self.core.nickname
+        self.running = True
+        return True
+    
+    async def start(self):
+        """On the network thread: connect, then pass every event to the inbox"""
+        # from before the hello, so the welcome is in it
+        events = self.core.events()
+        try:
+            await self.core.connect()
+        except BaseException:
+            events.close()
+            raise
+        asyncio.ensure_future(self.forward(events))
+    
+    async def forward(self, events):
+        async for event in events:
+            self.inbox.put(event)
+    
     def disconnect(self):
         """Disconnect from the server"""
         self.running = False
-        if self.socket:
+        if self.core:
             try:
-                self.socket.send("/exit".encode('utf-8'))
-                self.socket.close()
-            except:
+                asyncio.run_coroutine_threadsafe(self.core.close(), self.loop).result(DISCONNECT_TIMEOUT)
+            except Exception:
                 pass
         
     def send_message(self, message):
         """Send a message to the server"""
         if not message:
             return
-            
+        
+        # sent in order on the network thread, a failure comes back through the inbox
+        sending = asyncio.run_coroutine_threadsafe(self.core.send(message), self.loop)
+        sending.add_done_callback(self.sent)
+    
+    def sent(self, sending):
+        """A send finished, on the network thread"""
+        if sending.cancelled() or sending.exception() is None:
+            return
+        self.inbox.put(functools.partial(self.send_failed, sending.exception()))
+    
+    def send_failed(self, error):
+        if not self.running:
+            return
+        print(f"Error sending message: {error}")
+        messagebox.showerror("Error", f"Failed to send message: {error}")
+        self.disconnect()
+    
+    def session_expired(self):
+        self.display_message("Reconnected, your previous session had expired.")
+        self.current_room = LOBBY
+        self.room_users = {}
+        self.users_dirty = True
+    
+    def process_inbox(self):
+        """Apply everything the network thread queued since the last update, on the Tk thread every UPDATE_INTERVAL"""
         try:
-            self.socket.send(message.encode('utf-8'))
-        except Exception as e:
-            print(f"Error sending message: {e}")
-            messagebox.showerror("Error", f"Failed to send message: {e}")
-            self.disconnect()
-            
-    def receive_messages(self):
-        """Receive messages from the server"""
-        self.running = True
-        while self.running:
-            try:
-                message = self.socket.recv(BUFSIZE).decode('utf-8')
-                
-                if not message:
-                    # Server disconnected
-                    break
-                
-                # user list updates
-                if message.startswith("/users "):
-                    users = message[7:].split(",")
-                    self.update_user_list(users)
-                
-                # private messages
-                elif "[Private]" in message:
-                    # Extract sender from private message format: [time] [Private] sender: message
-                    try:
-                        parts = message.split(" ")
-                        timestamp = parts[0][1:-1]  # Remove brackets
-                        sender = parts[3][:-1]      # Remove colon
-                        
-                        # Check if it's a message TO someone
-                        if "[Private to" in message:
-                            recipient = parts[4][:-1]  # Remove bracket and colon
-                            self.handle_private_message(recipient, message)
-                        else:
-                            # This is a message FROM someone
-                            self.handle_private_message(sender, message)
-                    except IndexError:
-                        # If parsing fails, just display in main chat
-                        self.display_message(message)
-                
+            while True:
+                item = self.inbox.get_nowait()
+                if callable(item):
+                    item()
                 else:
-                    self.display_message(message)
-                    
-            except Exception as e:
-                if self.running:
-                    print(f"Error receiving message: {e}")
-                    self.running = False
-                    messagebox.showerror("Connection Lost", f"Lost connection to server: {e}")
-                break
-        
-        # if exit, notify the user
-        if self.running:
-            messagebox.showinfo("Disconnected", "You have been disconnected from the server.")
-            self.running = False
+                    self.handle_event(item)
+        except queue.Empty:
+            pass
+        
+        # one text operation per window, and one user list, however many messages came in
+        self.chat_display.flush()
+        for window in list(self.private_windows.values()):
+            window.flush()
+        if self.users_dirty:
+            self.update_user_list(self.room_users.get(self.current_room, []))
+        self.root.after(UPDATE_INTERVAL, self.process_inbox)
+    
+    def handle_event(self, event):
+        """Show one event of the connection, on the Tk thread"""
+        # user list updates
+        if isinstance(event, UserList):
+            if event.changes is None:
+                self.room_users[event.room] = event.users
+                if event.room == self.current_room:
+                    # only the latest list of this update is shown
+                    self.users_dirty = True
+            else:
+                self.apply_user_delta(event.room, event.changes)
+        
+        # private messages, both the ones we get and the confirmations of the ones we sent
+        elif isinstance(event, PrivateMessage):
+            self.handle_private_message(event.peer, event.raw)
+        
+        elif isinstance(event, Reconnected):
+            if not event.resumed:
+                self.session_expired()
+        
+        elif isinstance(event, Disconnected):
+            if self.running:
+                self.running = False
+                if event.error:
+                    print(f"Error receiving message: {event.error}")
+                    messagebox.showerror("Connection Lost", f"Lost connection to server: {event.error}")
+                else:
+                    messagebox.showinfo("Disconnected", "You have been disconnected from the server.")
+        
+        else:
+            self.display_message(event.raw)
             
     def handle_private_message(self, user, message):
         """Handle incoming private messages by opening or using a private chat window"""
@@ -125,10 +183,29 @@ class ChatClient:
         
     def update_user_list(self, users):
         """Update the user list in the GUI"""
+        self.users_dirty = False
+        self.users_label.config(text="Online Users:" if self.current_room == LOBBY else f"Online Users (#{self.current_room}):")
         self.users_listbox.delete(0, tk.END)
         for user in users:
             self.users_listbox.insert(tk.END, user)
             
+    def apply_user_delta(self, room, changes):
+        """Apply ("+", nick) / ("-", nick) changes to a room's user list and, for the current room, to the list box"""
+        users = self.room_users.setdefault(room, [])
+        # the list box is rebuilt anyway if a full list came in this update
+        visible = room == self.current_room and not self.users_dirty
+        for op, user in changes:
+            # a change can repeat what the snapshot already had, so both ops are idempotent
+            if op == "+" and user not in users:
+                users.append(user)
+                if visible:
+                    self.users_listbox.insert(tk.END, user)
+            elif op == "-" and user in users:
+                index = users.index(user)
+                del users[index]
+                if visible:
+                    self.users_listbox.delete(index)
+        
     def send_private_message(self, recipient, message):
         """Send a private message to a specific user"""
         private_cmd = f"/private {recipient} {message}"
@@ -154,7 +231,7 @@ class ChatClient:
         right_frame.pack_propagate(False)  # Prevent from shrinking
         
         # Chat display
-        self.chat_display = scrolledtext.ScrolledText(left_frame, wrap=tk.WORD, state=tk.DISABLED)
+        self.chat_display = MessageView(left_frame, self.scrollback)
         self.chat_display.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
         # Message entry
@@ -167,8 +244,8 @@ class ChatClient:
         send_button.pack(side=tk.RIGHT, padx=5, pady=5)
         
         # User list label
-        users_label = tk.Label(right_frame, text="Online Users:")
-        users_label.pack(anchor=tk.W, padx=5, pady=5)
+        self.users_label = tk.Label(right_frame, text="Online Users:")
+        self.users_label.pack(anchor=tk.W, padx=5, pady=5)
         
         # User list with double-click binding
         self.users_listbox = tk.Listbox(right_frame)
@@ -179,9 +256,8 @@ class ChatClient:
         exit_button = tk.Button(right_frame, text="Exit", command=self.on_closing)
         exit_button.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=10)
         
-        # Start receiving messages
-        self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
-        self.receive_thread.start()
+        # the network thread is already receiving, the GUI picks up what it queued
+        self.root.after(UPDATE_INTERVAL, self.process_inbox)
         
         # Set the focus to the message entry
         self.message_entry.focus_set()
@@ -190,11 +266,8 @@ class ChatClient:
         self.root.mainloop()
         
     def display_message(self, message):
-        """Display a message in the chat area"""
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, message + "\n")
-        self.chat_display.see(tk.END)  # Autoscroll to bottom
-        self.chat_display.config(state=tk.DISABLED)
+        """Display a message in the chat area, with the next update"""
+        self.chat_display.append(message)
         
     def open_private_window(self, user):
         """Open a private chat window"""
@@ -207,7 +280,18 @@ class ChatClient:
         if message:
             self.send_message(message)
             self.message_entry.delete(0, tk.END)
+            self.track_room(message)
         return "break"  # Prevent default Enter behavior
+    
+    def track_room(self, message):
+        """Follow /join and /leave so the user list shows the room we are talking in"""
+        if message.startswith("/join "):
+            self.current_room = message[6:].strip().lstrip("#")
+        elif message.startswith("/leave ") and message[7:].strip().lstrip("#") == self.current_room:
+            self.current_room = LOBBY
+        else:
+            return
+        self.update_user_list(self.room_users.get(self.current_room, []))
         
     def on_user_double_click(self, event=None):
         """Handle double click on a user to open private chat"""
@@ -223,6 +307,111 @@ class ChatClient:
             self.disconnect()
             self.root.destroy()
             
+class MessageView(scrolledtext.ScrolledText):
+    """Read-only chat text that collects lines and shows them in one insert per GUI update.
+    
+    The widget keeps the last scrollback lines, trimmed a page at a time, and every line
+    also goes to a Scrollback off the widget. Scrolling to the top of the widget loads the
+    page before it from there, scrolling back down loads the pages after it.
+    """
+    
+    def __init__(self, parent, scrollback=SCROLLBACK_LINES):
+        super().__init__(parent, wrap=tk.WORD, state=tk.DISABLED)
+        self.scrollback = scrollback
+        self.store = Scrollback()
+        # the widget shows the store's lines from first to first + shown
+        self.first = 0
+        self.shown = 0
+        self.pending = []
+        self.loading = False
+        self.configure(yscrollcommand=self.on_scroll)
+    
+    def append(self, message):
+        # one stored line per widget line
+        self.pending.extend(message.split("\n"))
+    
+    def flush(self):
+        """Insert the lines appended since the last flush, False if there were none"""
+        if not self.pending:
+            return False
+        lines, self.pending = self.pending, []
+        # whether the widget ends with the newest line, and the user is looking at it
+        following = self.first + self.shown == self.store.count
+        at_bottom = self.yview()[1] >= 1.0
+        self.store.extend(lines)
+        self.config(state=tk.NORMAL)
+        if following and at_bottom:
+            if len(lines) >= self.scrollback:
+                # the batch alone fills the widget
+                self.delete("1.0", tk.END)
+                self.first, self.shown = self.store.count - self.scrollback, 0
+                lines = lines[-self.scrollback:]
+            self.insert_lines(tk.END, lines)
+            if self.shown > self.scrollback + SCROLLBACK_PAGE:
+                self.trim_top(self.shown - self.scrollback)
+            self.see(tk.END)  # Autoscroll to bottom
+        elif following:
+            # the user is reading further up, the widget takes up to a page more and then stops following
+            self.insert_lines(tk.END, lines[:max(self.scrollback + SCROLLBACK_PAGE - self.shown, 0)])
+        self.config(state=tk.DISABLED)
+        return True
+    
+    def insert_lines(self, index, lines):
+        if lines:
+            self.insert(index, "\n".join(lines) + "\n")
+            self.shown += len(lines)
+    
+    def trim_top(self, count):
+        self.delete("1.0", f"{count + 1}.0")
+        self.first += count
+        self.shown -= count
+    
+    def trim_bottom(self, count):
+        self.delete(f"{self.shown - count + 1}.0", tk.END)
+        self.shown -= count
+    
+    def on_scroll(self, first, last):
+        """The widget's view moved, load more from the store when it reached either end"""
+        self.vbar.set(first, last)
+        first, last = float(first), float(last)
+        if self.loading or (first <= 0 and last >= 1):
+            # everything fits, there is nothing to scroll to
+            return
+        if first <= 0 and self.first > 0:
+            self.loading = True
+            self.after_idle(self.load_older)
+        elif last >= 1 and self.first + self.shown < self.store.count:
+            self.loading = True
+            self.after_idle(self.load_newer)
+    
+    def load_older(self):
+        self.loading = False
+        count = min(SCROLLBACK_PAGE, self.first)
+        self.config(state=tk.NORMAL)
+        self.insert_lines("1.0", self.store.lines(self.first - count, self.first))
+        self.first -= count
+        if self.shown > self.scrollback + SCROLLBACK_PAGE:
+            self.trim_bottom(self.shown - self.scrollback - SCROLLBACK_PAGE)
+        self.config(state=tk.DISABLED)
+        # the line that was at the top stays there
+        self.yview(f"{count + 1}.0")
+    
+    def load_newer(self):
+        self.loading = False
+        start = self.first + self.shown
+        top = int(self.index("@0,0").split(".")[0])
+        self.config(state=tk.NORMAL)
+        self.insert_lines(tk.END, self.store.lines(start, start + SCROLLBACK_PAGE))
+        count = max(self.shown - self.scrollback - SCROLLBACK_PAGE, 0)
+        if count:
+            self.trim_top(count)
+        self.config(state=tk.DISABLED)
+        self.yview(f"{max(top - count, 1)}.0")
+    
+    def destroy(self):
+        self.store.close()
+        super().destroy()
+
 class PrivateChatWindow:
     def __init__(self, client, recipient):
         """Initialize a private chat window"""
@@ -234,7 +423,7 @@ class PrivateChatWindow:
         self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
         
         # Chat display area
-        self.chat_display = scrolledtext.ScrolledText(self.window, wrap=tk.WORD, state=tk.DISABLED)
+        self.chat_display = MessageView(self.window, client.scrollback)
         self.chat_display.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         
         # Bottom frame for entry and send button
@@ -252,14 +441,14 @@ class PrivateChatWindow:
         send_button.pack(side=tk.RIGHT, padx=5)
         
     def display_message(self, message):
-        """Display a message in the private chat window"""
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, message + "\n")
-        self.chat_display.see(tk.END)  # Autoscroll to bottom
-        self.chat_display.config(state=tk.DISABLED)
-        
-        # Bring window to front
-        self.window.lift()
+        """Display a message in the private chat window, with the next update"""
+        self.chat_display.append(message)
+    
+    def flush(self):
+        """Show the messages of this update"""
+        if self.chat_display.flush():
+            # Bring window to front
+            self.window.lift()
         
     def on_send(self, event=None):
         """Send a private message"""
@@ -282,7 +471,16 @@ def main():
     parser.add_argument('--relay', dest="use_relay", action='store_true', help='Connect via relay server')
     parser.add_argument('--relay-host', dest="relay_host", help='Relay server host (default: same as server)')
     parser.add_argument('--relay-port', dest="relay_port", type=int, help='Relay server port (default: server port + 1)')
+    parser.add_argument('--unframed', dest="framed", action='store_false',
+                        help='Use the old unframed protocol instead of length-prefixed messages')
+    parser.add_argument('--compress', dest="compress", action='store_true',
+                        help='Ask the server for zlib compression (framed protocol only)')
+    parser.add_argument('--scrollback', dest="scrollback", type=int, default=SCROLLBACK_LINES,
+                        help=f'Lines a chat window keeps on screen, older ones are loaded back when scrolled to '
+                             f'(default: {SCROLLBACK_LINES})')
     args = parser.parse_args()
+    if args.scrollback < SCROLLBACK_PAGE:
+        parser.error(f"--scrollback must be at least {SCROLLBACK_PAGE} lines")
     
     # Use a dialog to get the nickname
     root = tk.Tk()
@@ -298,7 +496,10 @@ def main():
         args.port, 
         args.use_relay, 
         args.relay_host, 
-        args.relay_port
+        args.relay_port,
+        args.framed,
+        args.compress,
+        args.scrollback
     )
     client.nickname = nickname
     
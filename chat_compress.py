@@ -0,0 +1,96 @@
+import time
+import zlib
+from chat_protocol import ProtocolError
+from chat_metrics import REGISTRY
+
+# Stream compression, see chat_protocol for the handshake.
+#
+# A connection that negotiated the zlib capability carries one zlib stream per
+# direction after "/caps". Each side keeps its compression context for the life of
+# the connection, so a short message is coded against everything sent before it
+# (nicknames, room names, "/users" lists) and shrinks to a few bytes. Every write
+# ends with a sync flush so the peer can decode it without waiting for more.
+
+# zlib's defaults, the context costs about 256 KiB per direction compressing and 40 KiB decompressing
+COMPRESS_LEVEL = 6
+WINDOW_BITS = 15
+MEM_LEVEL = 8
+# most bytes one recv may inflate to, a peer sending a zip bomb is cut off
+MAX_INFLATE = 16 * 1024 * 1024
+
+# CPU time spent in zlib and the bytes on either side of it
+COMPRESSION_CPU = {
+    op: REGISTRY.counter("chat_compression_cpu_seconds_total", "Thread CPU time spent in zlib", {"op": op})
+    for op in ("compress", "decompress")
+}
+COMPRESSION_PLAIN_BYTES = {
+    op: REGISTRY.counter("chat_compression_plain_bytes_total", "Bytes before compression or after decompression",
+                         {"op": op})
+    for op in ("compress", "decompress")
+}
+COMPRESSION_WIRE_BYTES = {
+    op: REGISTRY.counter("chat_compression_wire_bytes_total", "Compressed bytes sent or received", {"op": op})
+    for op in ("compress", "decompress")
+}
+
+class Deflater:
+    """The sending half of a compressed connection, one per connection and used by one writer at a time"""
+
+    __slots__ = ("context",)
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        self.context = zlib.compressobj(level, zlib.DEFLATED, WINDOW_BITS, MEM_LEVEL)
+
+    def compress(self, data):
+        """Compress data so the peer can decode all of it as soon as it arrives"""
+        started = time.thread_time()
+        compressed = self.context.compress(data) + self.context.flush(zlib.Z_SYNC_FLUSH)
+        COMPRESSION_CPU["compress"].inc(time.thread_time() - started)
+        COMPRESSION_PLAIN_BYTES["compress"].inc(len(data))
+        COMPRESSION_WIRE_BYTES["compress"].inc(len(compressed))
+        return compressed
+
+class Inflater:
+    """The receiving half of a compressed connection"""
+
+    __slots__ = ("context",)
+
+    def __init__(self):
+        self.context = zlib.decompressobj(WINDOW_BITS)
+
+    def decompress(self, data):
+        """Decompress what one recv got, raises ProtocolError on a corrupt stream"""
+        started = time.thread_time()
+        try:
+            plain = self.context.decompress(data, MAX_INFLATE)
+        except zlib.error as e:
+            raise ProtocolError(f"Corrupt compressed stream: {e}")
+        if self.context.unconsumed_tail:
+            raise ProtocolError(f"Compressed data inflates to more than {MAX_INFLATE} bytes")
+        if self.context.eof:
+            raise ProtocolError("Compressed stream ended")
+        COMPRESSION_CPU["decompress"].inc(time.thread_time() - started)
+        COMPRESSION_PLAIN_BYTES["decompress"].inc(len(plain))
+        COMPRESSION_WIRE_BYTES["decompress"].inc(len(data))
+        return plain
+
+class InflatingCodec:
+    """Reads a compressed connection, decodes what it inflates with the connection's own codec"""
+
+    __slots__ = ("codec", "inflater", "framed")
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.inflater = Inflater()
+        self.framed = codec.framed
+
+    def decode(self, data):
+        return self.codec.decode(self.inflater.decompress(data))
+
+    def decode_payloads(self, data):
+        return self.codec.decode_payloads(self.inflater.decompress(data))
+
+def compression_ratio():
+    """Compressed bytes sent per byte before compression, None before anything was compressed"""
+    plain = COMPRESSION_PLAIN_BYTES["compress"].value()
+    return COMPRESSION_WIRE_BYTES["compress"].value() / plain if plain else None
@@ -0,0 +1,430 @@
+import asyncio
+from chat_protocol import (CAP_FRAMED, CAP_DELTAS, CAP_RESUME, CAP_COMPRESS, CAP_PING, HEADER, ENCODING, build_hello,
+                           parse_caps, make_codec)
+from chat_compress import Deflater, InflatingCodec
+
+# Headless chat client, the protocol without a GUI: for bots, tests and the Tk
+# client, which is a view over it. It runs on an asyncio loop, so one process
+# can hold thousands of clients.
+#
+# What the server sends comes out as typed events, read with "async for" from the
+# streams events() and friends return. Messages are only parsed into events while
+# some stream is open, a simulated user that never reads its events costs a read
+# and a frame split per message.
+
+# Default settings
+HOST = '127.0.0.1'
+PORT = 8888
+BUFSIZE = 65536
+LOBBY = "lobby"
+
+# Reconnecting after a dropped connection, within the server's resume grace period
+RESUME_ATTEMPTS = 5
+RESUME_DELAY = 1.0
+
+class Event:
+    """Something that happened on a connection, raw is the server's message behind it"""
+
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.raw!r})"
+
+class PublicMessage(Event):
+    """Someone said something in a room: "[12:00:00] [#room] alice: hi", lobby messages have no room label"""
+
+    __slots__ = ("time", "room", "sender", "text")
+
+    def __init__(self, raw, time, room, sender, text):
+        super().__init__(raw)
+        self.time = time
+        self.room = room
+        self.sender = sender
+        self.text = text
+
+class PrivateMessage(Event):
+    """A private message, peer is the other user. outgoing marks the server's confirmation of one we sent,
+    "[12:00:00] [Private to bob]: hi", against "[12:00:00] [Private] alice: hi" for one we got"""
+
+    __slots__ = ("time", "peer", "text", "outgoing")
+
+    def __init__(self, raw, time, peer, text, outgoing):
+        super().__init__(raw)
+        self.time = time
+        self.peer = peer
+        self.text = text
+        self.outgoing = outgoing
+
+class UserList(Event):
+    """A room's user list changed. users is the whole list when the server sent one, changes the
+    ("+", nickname) and ("-", nickname) pairs of an incremental update, the other one is None"""
+
+    __slots__ = ("room", "users", "changes")
+
+    def __init__(self, raw, room, users, changes):
+        super().__init__(raw)
+        self.room = room
+        self.users = users
+        self.changes = changes
+
+class Notice(Event):
+    """Any other server text: the welcome, joins and leaves, errors and warnings"""
+
+    __slots__ = ()
+
+class Reconnected(Event):
+    """The connection dropped and came back, resumed tells whether the session went on or a new one started"""
+
+    __slots__ = ("resumed",)
+
+    def __init__(self, resumed):
+        super().__init__(None)
+        self.resumed = resumed
+
+class Disconnected(Event):
+    """The last event of a client, error says why the connection ended and is None if it was closed"""
+
+    __slots__ = ("error",)
+
+    def __init__(self, error=None):
+        super().__init__(None)
+        self.error = error
+
+class EventStream:
+    """Async iterator over a client's events of some kinds, from its creation until the client disconnects.
+    Events queue up until they are read, a stream nobody reads any more should be closed."""
+
+    __slots__ = ("client", "kinds", "queue")
+
+    def __init__(self, client, kinds):
+        self.client = client
+        self.kinds = kinds
+        self.queue = asyncio.Queue()
+        if client.ended:
+            self.queue.put_nowait(None)
+        else:
+            client.streams.append(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is None:
+            # later calls end as well
+            self.queue.put_nowait(None)
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        if self in self.client.streams:
+            self.client.streams.remove(self)
+        self.queue.put_nowait(None)
+
+class AsyncChatClient:
+    """One chat connection, directly to the server or through the relay"""
+
+    def __init__(self, nickname, host=HOST, port=PORT, use_relay=False, relay_host=None, relay_port=None,
+                 framed=True, compress=False, track_users=True, resumable=True):
+        self.nickname = nickname
+        self.host = host
+        self.port = port
+        self.use_relay = use_relay
+        self.relay_host = relay_host if relay_host else host
+        self.relay_port = relay_port if relay_port else port + 1
+        self.caps = [CAP_FRAMED, CAP_DELTAS, CAP_PING] if framed else []
+        # a load generator measures plain connections, without a session to resume
+        if framed and resumable:
+            self.caps.append(CAP_RESUME)
+        if framed and compress:
+            self.caps.append(CAP_COMPRESS)
+        self.reader = None
+        self.writer = None
+        self.codec = make_codec(self.caps)
+        # what the connection is read with, and what compresses our messages if the server granted zlib
+        self.decoder = self.codec
+        self.deflater = None
+        # the session to resume after a dropped connection, and the bytes of its stream received so far
+        self.session_token = None
+        self.stream_offset = 0
+        # set once the server took us in, the handshake of a new session ends with its welcome
+        self.welcomed = False
+        # user lists per room, kept only if asked for, a simulated user rarely needs them
+        self.track_users = track_users
+        self.room_users = {}
+        self.streams = []
+        self.receiver = None
+        self.closing = False
+        self.ended = False
+
+    async def connect(self):
+        """Connect and say hello, returns once the server took us in. Raises OSError if the connection
+        fails and ConnectionError with the server's answer if it refuses the nickname"""
+        await self.open()
+        self.receiver = asyncio.ensure_future(self.receive_loop())
+
+    async def open(self):
+        """Open a connection and run the handshake, resuming the session if there is one.
+        Returns True if a session was resumed"""
+        if self.use_relay:
+            self.reader, self.writer = await asyncio.open_connection(self.relay_host, self.relay_port)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            caps = self.caps
+            if self.session_token:
+                caps = dict.fromkeys(self.caps, "")
+                caps[CAP_RESUME] = f"{self.session_token}:{self.stream_offset}"
+            # a new connection starts with an empty frame buffer
+            self.codec = make_codec(self.caps)
+            self.decoder = self.codec
+            self.deflater = None
+            self.welcomed = False
+            self.writer.write(build_hello(self.nickname, caps))
+            resumed = False
+            if self.caps:
+                resumed, rest = await self.read_caps()
+                self.feed(rest)
+            while not self.welcomed:
+                data = await self.reader.read(BUFSIZE)
+                if not data:
+                    raise ConnectionError("server closed the connection during the handshake")
+                self.feed(data)
+            return resumed
+        except BaseException:
+            self.writer.close()
+            raise
+
+    async def read_caps(self):
+        """Read "/caps", which nothing else may be sent before when we asked for zlib since it says whether
+        the rest is compressed. Returns whether the session was resumed and what was read after "/caps" """
+        reply = None
+        while reply is None:
+            data = await self.reader.read(BUFSIZE)
+            if not data:
+                raise ConnectionError("server closed the connection during the handshake")
+            reply, rest = self.codec.decode_first(data)
+        caps = parse_caps(reply.decode(ENCODING)[6:])
+        if CAP_COMPRESS in caps:
+            self.decoder = InflatingCodec(self.codec)
+            self.deflater = Deflater()
+        if caps.get(CAP_RESUME):
+            # the stream goes on from where we were
+            self.welcomed = True
+            return True, rest
+        # a new stream starts after this message, with new user lists
+        self.session_token = None
+        self.stream_offset = 0
+        self.room_users.clear()
+        return False, rest
+
+    async def receive_loop(self):
+        """Read until the connection ends for good, reconnecting to resume the session when it drops"""
+        error = None
+        try:
+            while True:
+                try:
+                    data = await self.reader.read(BUFSIZE)
+                except OSError as e:
+                    data, error = b"", e
+                if data:
+                    self.feed(data)
+                elif self.closing or not await self.resume():
+                    break
+                else:
+                    error = None
+        except Exception as e:
+            error = e
+        finally:
+            self.end(str(error) if error else None)
+
+    async def resume(self):
+        """Reconnect after the connection dropped and pick up the session, True if that worked"""
+        if not self.session_token:
+            return False
+        self.writer.close()
+        for attempt in range(RESUME_ATTEMPTS):
+            await asyncio.sleep(RESUME_DELAY)
+            if self.closing:
+                return False
+            try:
+                resumed = await self.open()
+            except OSError:
+                continue
+            self.publish(Reconnected(resumed))
+            return True
+        return False
+
+    def end(self, error):
+        self.writer.close()
+        self.publish(Disconnected(error))
+        self.ended = True
+        for stream in self.streams:
+            stream.queue.put_nowait(None)
+        self.streams = []
+
+    def feed(self, data):
+        """Take what one read got"""
+        if not self.codec.framed:
+            # the old protocol, a read is one message and there are no sessions
+            for message in self.decoder.decode(data):
+                self.dispatch(message)
+            return
+        for payload in self.decoder.decode_payloads(data):
+            # everything after "/caps" is the session's stream
+            self.stream_offset += HEADER.size + len(payload)
+            self.dispatch(payload.decode(ENCODING))
+
+    def dispatch(self, message):
+        """Handle one message from the server"""
+        # the token that lets us resume after a dropped connection
+        if message.startswith("/session "):
+            self.session_token = message[9:]
+            return
+
+        # the server checking that we are still there
+        if message == "/ping":
+            self.writer.write(self.encode("/pong"))
+            return
+
+        # the rate limit hint, the warning before it is a notice
+        if message.startswith("/retry-after "):
+            return
+
+        if message.startswith("/users"):
+            if self.track_users or self.streams:
+                self.update_users(message)
+            return
+
+        if not self.welcomed:
+            # the first text of a new session answers the hello
+            self.welcome(message)
+        if self.streams:
+            self.publish(parse_message(message))
+
+    def welcome(self, message):
+        """Take the server's answer to our nickname, raises ConnectionError if it refused it"""
+        _, assigned, nickname = message.partition("You've been assigned '")
+        if assigned:
+            # the nickname was taken, in the old protocol more messages can follow in the same read
+            self.nickname = nickname.partition("'")[0]
+        elif message.startswith("Welcome, *" + self.nickname):
+            # the relay marks the nicknames of its clients
+            self.nickname = "*" + self.nickname
+        elif not message.startswith("Welcome, ") and not message.startswith("["):
+            raise ConnectionError(message)
+        # else a timestamped message came first, a server that drops the oldest messages of a full
+        # queue can drop the welcome when many clients join at once
+        self.welcomed = True
+
+    def update_users(self, message):
+        if message.startswith("/users "):
+            # "/users a,b" is the lobby, other rooms send "/users #room a,b"
+            room, users = LOBBY, message[7:]
+            if users.startswith("#"):
+                room, _, users = users[1:].partition(" ")
+            users = users.split(",") if users else []
+            if self.track_users:
+                self.room_users[room] = dict.fromkeys(users)
+            self.publish(UserList(message, room, users, None))
+            return
+
+        # incremental user list changes: "/users-delta [#room ]+alice,-bob"
+        room, changes = LOBBY, message[13:]
+        if changes.startswith("#"):
+            room, _, changes = changes[1:].partition(" ")
+        changes = [(change[0], change[1:]) for change in changes.split(",") if change]
+        if self.track_users:
+            users = self.room_users.setdefault(room, {})
+            for op, user in changes:
+                # a change can repeat what the snapshot already had, so both ops are idempotent
+                if op == "+":
+                    users[user] = None
+                else:
+                    users.pop(user, None)
+        self.publish(UserList(message, room, None, changes))
+
+    def publish(self, event):
+        for stream in self.streams:
+            if isinstance(event, stream.kinds):
+                stream.queue.put_nowait(event)
+
+    def events(self, *kinds):
+        """Stream of the events of the given classes, all of them if none are given"""
+        return EventStream(self, kinds or (Event,))
+
+    def public_messages(self):
+        return self.events(PublicMessage)
+
+    def private_messages(self):
+        return self.events(PrivateMessage)
+
+    def user_lists(self):
+        return self.events(UserList)
+
+    def users(self, room=LOBBY):
+        """Who is in a room as far as we know, needs track_users"""
+        return list(self.room_users.get(room, ()))
+
+    def encode(self, message):
+        """A message as it goes on the wire"""
+        data = self.codec.encode(message)
+        if self.deflater is not None:
+            data = self.deflater.compress(data)
+        return data
+
+    async def send(self, message):
+        """Send a message to the current room, or a command such as "/join #room" """
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError("not connected")
+        self.writer.write(self.encode(message))
+        await self.writer.drain()
+
+    async def send_private(self, recipient, message):
+        """Send a private message to a specific user"""
+        await self.send(f"/private {recipient} {message}")
+
+    async def close(self):
+        """Leave the chat, the streams end with a Disconnected event"""
+        self.closing = True
+        if self.receiver is None:
+            return
+        try:
+            await self.send("/exit")
+        except (ConnectionError, OSError):
+            pass
+        self.writer.close()
+        self.receiver.cancel()
+        await asyncio.gather(self.receiver, return_exceptions=True)
+
+def parse_message(message):
+    """The event for a text message from the server"""
+    time, room = None, LOBBY
+    if message.startswith("["):
+        time, stamped, rest = message[1:].partition("] ")
+        if not stamped or " " in time:
+            time = None
+    if time is None:
+        return Notice(message)
+
+    if rest.startswith("[Private] "):
+        sender, said, text = rest[10:].partition(": ")
+        if said:
+            return PrivateMessage(message, time, sender, text, False)
+    elif rest.startswith("[Private to "):
+        recipient, said, text = rest[12:].partition("]: ")
+        if said:
+            return PrivateMessage(message, time, recipient, text, True)
+    else:
+        if rest.startswith("[#"):
+            label, labelled, after = rest[2:].partition("] ")
+            if labelled:
+                room, rest = label, after
+        # joins and leaves have no colon after the nickname
+        sender, said, text = rest.partition(": ")
+        if said:
+            return PublicMessage(message, time, room, sender, text)
+    return Notice(message)
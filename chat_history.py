@@ -0,0 +1,41 @@
+import itertools
+from collections import deque
+
+# Recent public messages, replayed to clients when they enter a room
+HISTORY_SIZE = 64 * 1024
+HISTORY_REPLAY = 20
+
+class History:
+    """Ring buffer of a room's recent messages, the oldest go once they take more than max_bytes.
+
+    Messages are kept framed, the same bytes the broadcast queued for framed clients
+    (chat_protocol.Payload), so a replay to a framed client is a single join of them.
+    Every message gets a sequence number, which is how clients page back through the buffer.
+    """
+
+    def __init__(self, max_bytes=HISTORY_SIZE):
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.size = 0
+        # sequence number of the oldest message still kept
+        self.first = 0
+
+    def append(self, frame):
+        self.frames.append(frame)
+        self.size += len(frame)
+        while self.size > self.max_bytes:
+            self.size -= len(self.frames.popleft())
+            self.first += 1
+
+    @property
+    def end(self):
+        """Sequence number the next message will get"""
+        return self.first + len(self.frames)
+
+    def before(self, end, count):
+        """Up to count frames before sequence number end, and the sequence number of the first one"""
+        end = min(end, self.end)
+        start = max(self.first, end - count)
+        if start >= end:
+            return [], end
+        return list(itertools.islice(self.frames, start - self.first, end - self.first)), start
@@ -0,0 +1,402 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime
+from chat_metrics import REGISTRY
+
+LOG_FILE = "chat_server_log.csv"
+LOG_HEADER = ['Timestamp', 'Sender', 'Recipient', 'Message', 'Type']
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+ENCODING = 'utf-8'
+
+# Segmented log store: closed segments are gzipped, the oldest ones deleted beyond MAX_SEGMENTS
+LOG_DIR = "chat_logs"
+SEGMENT_SIZE = 4 * 1024 * 1024
+MAX_SEGMENTS = 50
+INDEX_FILE = "index.jsonl"
+
+# Batching: write once this many records are pending, or once the oldest has waited this long
+BATCH_SIZE = 256
+FLUSH_INTERVAL = 0.2
+
+# fsync policy: "none" leaves it to the OS, "batch" syncs after every batch,
+# "interval" syncs at most once every FSYNC_INTERVAL seconds
+FSYNC_POLICIES = ("none", "batch", "interval")
+FSYNC_INTERVAL = 1.0
+
+_STOP = object()
+
+LOG_RECORDS = REGISTRY.counter("chat_log_records_total", "Chat log records written")
+LOG_WRITE_SECONDS = REGISTRY.histogram("chat_log_write_seconds", "Time to write one batch of log records")
+
+class LogWriter:
+    """Writes chat log records to the CSV file from a single background thread.
+
+    Callers only put a tuple on a queue, the writer keeps the file open and writes
+    the records in batches, so logging costs no syscalls on the sender's thread.
+    """
+
+    def __init__(self, path=LOG_FILE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, fsync="none"):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.file = None
+        self.records_written = 0
+        self.batches_written = 0
+        self.last_fsync = 0.0
+        self._last_second = None
+        self._last_timestamp = ""
+
+    def start(self):
+        """Truncate the log file, write the header and start the writer thread"""
+        self.file = open(self.path, 'wb')
+        self.file.write(encode_rows([LOG_HEADER]))
+        self.file.flush()
+        self.start_thread()
+
+    def start_thread(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, sender, recipient, message, msg_type="public"):
+        """Queue one record, never blocks"""
+        self.queue.put((time.time(), sender, recipient, message, msg_type))
+
+    def close(self):
+        """Write everything still queued and close the file"""
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        """Writer thread: collect records into batches and write them"""
+        pending = []
+        deadline = None
+        stopping = False
+        while not stopping:
+            timeout = None if not pending else max(0.0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = None
+
+            if record is _STOP:
+                stopping = True
+            elif record is not None:
+                if not pending:
+                    deadline = time.monotonic() + self.flush_interval
+                pending.append(record)
+                if len(pending) < self.batch_size and time.monotonic() < deadline:
+                    continue
+
+            if pending:
+                started = time.perf_counter()
+                self.write_batch(pending)
+                LOG_WRITE_SECONDS.observe(time.perf_counter() - started)
+                LOG_RECORDS.inc(len(pending))
+                pending = []
+
+        self.close_files()
+
+    def close_files(self):
+        self.file.close()
+
+    def write_batch(self, records):
+        """Write a batch of records with one write call"""
+        self.file.write(self.encode_records(records))
+        self.file.flush()
+        self.records_written += len(records)
+        self.batches_written += 1
+        self.sync()
+
+    def encode_records(self, records):
+        """CSV-encode a batch of queued records"""
+        return encode_rows(
+            (self.format_timestamp(ts), sender, recipient, message, msg_type)
+            for ts, sender, recipient, message, msg_type in records
+        )
+
+    def sync(self):
+        """Apply the fsync policy after a batch has been written"""
+        if self.fsync == "batch":
+            os.fsync(self.file.fileno())
+        elif self.fsync == "interval":
+            now = time.monotonic()
+            if now - self.last_fsync >= FSYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.last_fsync = now
+
+    def format_timestamp(self, ts):
+        """strftime only once per second, consecutive records usually share it"""
+        second = int(ts)
+        if second != self._last_second:
+            self._last_second = second
+            self._last_timestamp = datetime.fromtimestamp(second).strftime(TIMESTAMP_FORMAT)
+        return self._last_timestamp
+
+
+class LogStore(LogWriter):
+    """Log writer that keeps the log as a directory of fixed-size CSV segments.
+
+    The active segment is rotated once it reaches segment_size, closed segments are
+    gzipped in the background and the oldest are deleted beyond max_segments.
+    Every batch also appends a line to a sidecar index (time range, segment, byte
+    offset and senders), so queries can read just the blocks they need.
+    Unlike LogWriter, a restart continues after the existing segments.
+    """
+
+    def __init__(self, directory=LOG_DIR, segment_size=SEGMENT_SIZE, max_segments=MAX_SEGMENTS,
+                 compress=True, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, fsync="none"):
+        super().__init__(directory, batch_size, flush_interval, fsync)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.compress = compress
+        self.entries = []
+        self.segment = 0
+        self.segment_bytes = 0
+        self.index_file = None
+        self.compressors = []
+
+    def start(self):
+        """Open a new segment after the existing ones and start the writer thread"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.entries = read_index(self.directory)
+        existing = segment_numbers(self.directory)
+        self.segment = max(existing, default=0) + 1
+
+        # segments left uncompressed by a previous run
+        if self.compress:
+            for number in existing:
+                if os.path.exists(segment_path(self.directory, number)):
+                    self.compress_in_background(number)
+
+        self.index_file = open(os.path.join(self.directory, INDEX_FILE), 'a', encoding=ENCODING)
+        self.open_segment()
+        self.prune()
+        self.start_thread()
+
+    def open_segment(self):
+        self.file = open(segment_path(self.directory, self.segment), 'wb')
+        header = encode_rows([LOG_HEADER])
+        self.file.write(header)
+        self.file.flush()
+        self.segment_bytes = len(header)
+
+    def write_batch(self, records):
+        """Write a batch to the active segment, then record it in the index"""
+        if self.segment_bytes >= self.segment_size:
+            self.rotate()
+
+        data = self.encode_records(records)
+        offset = self.segment_bytes
+        self.file.write(data)
+        self.file.flush()
+        self.segment_bytes += len(data)
+
+        # the index is written after the data so it never points past the end of a segment
+        entry = {
+            "first": records[0][0],
+            "last": records[-1][0],
+            "segment": self.segment,
+            "offset": offset,
+            "length": len(data),
+            "senders": sorted({record[1] for record in records}),
+        }
+        self.index_file.write(json.dumps(entry) + "\n")
+        self.index_file.flush()
+        self.entries.append(entry)
+
+        self.records_written += len(records)
+        self.batches_written += 1
+        self.sync()
+
+    def sync(self):
+        super().sync()
+        if self.fsync == "batch":
+            os.fsync(self.index_file.fileno())
+
+    def rotate(self):
+        """Close the active segment and start the next one"""
+        self.file.close()
+        if self.compress:
+            self.compress_in_background(self.segment)
+        self.segment += 1
+        self.open_segment()
+        self.prune()
+
+    def prune(self):
+        """Delete the oldest segments beyond max_segments and drop them from the index"""
+        if not self.max_segments:
+            return
+        numbers = segment_numbers(self.directory)
+        expired = numbers[:-self.max_segments] if len(numbers) > self.max_segments else []
+        if not expired:
+            return
+        for number in expired:
+            for path in (segment_path(self.directory, number), segment_path(self.directory, number) + ".gz"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        # rewrite the index without the deleted segments
+        expired = set(expired)
+        self.entries = [entry for entry in self.entries if entry["segment"] not in expired]
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        self.index_file.close()
+        with open(index_path + ".tmp", 'w', encoding=ENCODING) as file:
+            for entry in self.entries:
+                file.write(json.dumps(entry) + "\n")
+        os.replace(index_path + ".tmp", index_path)
+        self.index_file = open(index_path, 'a', encoding=ENCODING)
+
+    def compress_in_background(self, number):
+        """Gzip a closed segment without holding up the writer thread"""
+        self.compressors = [thread for thread in self.compressors if thread.is_alive()]
+        thread = threading.Thread(target=compress_segment, args=(self.directory, number), daemon=True)
+        thread.start()
+        self.compressors.append(thread)
+
+    def close_files(self):
+        self.file.close()
+        self.index_file.close()
+        for thread in self.compressors:
+            thread.join()
+
+def encode_rows(rows):
+    """CSV-encode rows into bytes"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode(ENCODING)
+
+def segment_path(directory, number):
+    """Path of an uncompressed segment, the compressed one has an extra .gz"""
+    return os.path.join(directory, f"segment-{number:06d}.csv")
+
+def segment_numbers(directory):
+    """Sorted numbers of the segments in a log directory"""
+    numbers = set()
+    for name in os.listdir(directory):
+        if name.startswith("segment-") and (name.endswith(".csv") or name.endswith(".csv.gz")):
+            numbers.add(int(name[len("segment-"):].split(".")[0]))
+    return sorted(numbers)
+
+def compress_segment(directory, number):
+    """Replace a closed segment with its gzipped copy"""
+    path = segment_path(directory, number)
+    try:
+        with open(path, 'rb') as source, gzip.open(path + ".gz.tmp", 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(path + ".gz.tmp", path + ".gz")
+        os.remove(path)
+    except FileNotFoundError:
+        # pruned while we were compressing it
+        pass
+
+def read_index(directory):
+    """Load the index entries of a log directory"""
+    entries = []
+    try:
+        with open(os.path.join(directory, INDEX_FILE), encoding=ENCODING) as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # torn last line after a crash
+                    pass
+    except FileNotFoundError:
+        pass
+    return entries
+
+def open_segment(directory, number):
+    """Open a segment for reading, compressed or not"""
+    path = segment_path(directory, number)
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        return gzip.open(path + ".gz", 'rb')
+
+def query(directory, since=None, until=None, sender=None):
+    """Yield the log rows between two datetimes and/or from one sender.
+
+    Only the index blocks whose time range and senders match are read, each segment
+    is opened once and read from the block offsets.
+    """
+    since_ts = since.timestamp() if since else None
+    until_ts = until.timestamp() if until else None
+
+    matching = []
+    for entry in read_index(directory):
+        # timestamps in the segments have second resolution
+        if since_ts is not None and entry["last"] < int(since_ts):
+            continue
+        if until_ts is not None and entry["first"] >= int(until_ts) + 1:
+            continue
+        if sender is not None and sender not in entry["senders"]:
+            continue
+        matching.append(entry)
+    matching.sort(key=lambda entry: (entry["segment"], entry["offset"]))
+
+    current = None
+    file = None
+    try:
+        for entry in matching:
+            if entry["segment"] != current:
+                if file:
+                    file.close()
+                try:
+                    file = open_segment(directory, entry["segment"])
+                except FileNotFoundError:
+                    # pruned since the index was read
+                    file, current = None, None
+                    continue
+                current = entry["segment"]
+            file.seek(entry["offset"])
+            block = file.read(entry["length"]).decode(ENCODING)
+
+            for row in csv.reader(io.StringIO(block)):
+                timestamp = datetime.strptime(row[0], TIMESTAMP_FORMAT)
+                if since and timestamp < since.replace(microsecond=0):
+                    continue
+                if until and timestamp > until:
+                    continue
+                if sender is not None and row[1] != sender:
+                    continue
+                yield row
+    finally:
+        if file:
+            file.close()
+
+def parse_time(value):
+    """Accept "YYYY-MM-DD HH:MM:SS" or any ISO 8601 timestamp"""
+    return datetime.fromisoformat(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the segmented chat log')
+    parser.add_argument('--dir', dest="directory", default=LOG_DIR, help=f'Log directory (default: {LOG_DIR})')
+    parser.add_argument('--since', dest="since", type=parse_time, help='Only messages at or after this time')
+    parser.add_argument('--until', dest="until", type=parse_time, help='Only messages at or before this time')
+    parser.add_argument('--sender', dest="sender", help='Only messages from this nickname')
+    args = parser.parse_args()
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(LOG_HEADER)
+    for row in query(args.directory, args.since, args.until, args.sender):
+        writer.writerow(row)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Metrics in the Prometheus text format, served over HTTP by start_metrics_server.
+#
+# Updates have to be cheap on the hot path, so counters and histograms keep one
+# cell per thread: a thread only ever adds to its own cell and the cells are
+# summed when the metrics are scraped. There is no lock per increment.
+
+METRICS_HOST = '127.0.0.1'
+
+# seconds, for latencies from a few microseconds up to a few seconds
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# thread cells a metric keeps at least before it looks for threads that have exited
+PRUNE_AT = 64
+
+class ThreadCells:
+    """Per-thread lists of numbers that are summed on read"""
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.cells = []
+        # values of threads that have exited, so their cells can be dropped
+        self.retired = [0] * size
+        # cells kept before the next new one looks for exited threads
+        self.prune_at = PRUNE_AT
+        self.lock = threading.Lock()
+
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = [0] * self.size
+            with self.lock:
+                # a thread per connection would otherwise keep a cell per thread ever
+                # started, when nothing scrapes the metrics
+                if len(self.cells) >= self.prune_at:
+                    self._prune()
+                    self.prune_at = max(PRUNE_AT, 2 * len(self.cells))
+                self.cells.append((threading.current_thread(), cell))
+            self.local.cell = cell
+            return cell
+
+    def totals(self):
+        with self.lock:
+            self._prune()
+            totals = list(self.retired)
+            for thread, cell in self.cells:
+                for i, value in enumerate(cell):
+                    totals[i] += value
+        return totals
+
+    def _prune(self):
+        """Fold the cells of exited threads into retired, with the lock held"""
+        alive = []
+        for thread, cell in self.cells:
+            if thread.is_alive():
+                alive.append((thread, cell))
+            else:
+                for i, value in enumerate(cell):
+                    self.retired[i] += value
+        self.cells = alive
+
+class Counter:
+    """Monotonic counter"""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.cells = ThreadCells(1)
+
+    def inc(self, amount=1):
+        self.cells.cell()[0] += amount
+
+    def value(self):
+        return self.cells.totals()[0]
+
+    def samples(self):
+        yield self.name, self.labels, self.value()
+
+class Gauge:
+    """Value computed by a callback when the metrics are scraped"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, callback, labels=None):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.labels = labels or {}
+
+    def value(self):
+        return self.callback()
+
+    def samples(self):
+        yield self.name, self.labels, self.value()
+
+class Histogram:
+    """Distribution of observed values in fixed buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labels=None):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.labels = labels or {}
+        # one slot per bucket, one for +Inf, then the sum
+        self.cells = ThreadCells(len(self.buckets) + 2)
+
+    def observe(self, value):
+        cell = self.cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self):
+        totals = self.cells.totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), totals):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield self.name + "_bucket", dict(self.labels, le=le), cumulative
+        yield self.name + "_sum", self.labels, totals[-1]
+        yield self.name + "_count", self.labels, cumulative
+
+class Registry:
+    """All metrics of a process, rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=None):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, callback, labels=None):
+        return self.register(Gauge(name, help_text, callback, labels))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, labels=None):
+        return self.register(Histogram(name, help_text, buckets, labels))
+
+    def unregister(self, metric):
+        with self.lock:
+            self.metrics.remove(metric)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+# the process-wide registry every component registers its metrics in
+REGISTRY = Registry()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood the console
+        pass
+
+def start_metrics_server(port, host=METRICS_HOST, registry=REGISTRY):
+    """Serve /metrics from a background thread, returns the HTTP server"""
+    handler = type("BoundMetricsHandler", (MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
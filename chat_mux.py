@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import deque
+from chat_protocol import MUX_CLOSE, encode_mux
+from chat_outbox import SLOW_CONSUMER_DISCONNECTS
+
+# Server side of the relay's multiplexed links, see chat_protocol for the framing.
+#
+# Every session on a link is a client of its own to ChatServer: a MuxSession stands
+# in for the client's socket and has its own outbox, rate limit and rooms. Only the
+# writing is shared, a session's outbox schedules the session on its link and one
+# writer per link drains every scheduled outbox into a single send.
+#
+# The frames queued on the link itself (room joins and leaves, fan-out broadcasts)
+# cannot be dropped without the relay's rooms going out of step with the server's,
+# so a link that falls too far behind is cut off like a slow client instead.
+
+# a link carries many clients, it may have this many times a client's backlog waiting
+LINK_BACKLOG_SCALE = 16
+
+class MuxSession:
+    """One client behind a relay link, used by ChatServer in place of the client's socket"""
+
+    __slots__ = ("link", "session_id", "nickname", "outbox", "scheduled", "ended", "pending")
+
+    def __init__(self, link, session_id):
+        self.link = link
+        self.session_id = session_id
+        self.nickname = None
+        self.outbox = None
+        self.scheduled = False
+        self.ended = False
+        # the frames that arrive while the session waits for its nickname claim
+        self.pending = None
+
+    def attach(self, outbox):
+        """Let the link's writer drain the session's outbox"""
+        self.outbox = outbox
+        outbox.wakeup = self.wakeup
+        # the welcome was queued before there was anyone to wake up
+        self.wakeup()
+
+    def wakeup(self):
+        # a session is queued on its link at most once until the writer gets to it
+        if not self.scheduled:
+            self.scheduled = True
+            self.link.schedule(self)
+
+    def send(self, data):
+        # Only used before the session has an outbox, to refuse it, so the session ends here
+        self.ended = True
+        self.link.schedule(data + encode_mux(self.session_id, MUX_CLOSE))
+        return len(data)
+
+class MuxLink:
+    """A relay connection carrying many sessions, written by a single writer.
+
+    Works like an Outbox whose items are either sessions with something to write
+    or ready-made bytes.
+    """
+
+    def __init__(self, name, fanout=False, deflater=None, max_bytes=0, max_age=0):
+        self.name = name
+        # the relay delivers room broadcasts to its sessions itself
+        self.fanout = fanout
+        # set when the link negotiated zlib, the writer compresses everything it sends with it
+        self.deflater = deflater
+        # session id -> MuxSession
+        self.sessions = {}
+        self.ready = deque()
+        # bytes of the frames in ready, and when ready last went from empty to not, see expire
+        self.size = 0
+        self.since = 0.0
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # why the link was cut off, None if it was not
+        self.cut_off = None
+        # the relay's connection (a socket or a StreamClient), for ending it when the link is cut off
+        self.connection = None
+        self.closed = False
+        self.condition = threading.Condition(threading.Lock())
+        # event-loop writers set this to get woken up instead of waiting on the condition
+        self.wakeup = None
+
+    def schedule(self, item):
+        with self.condition:
+            if self.closed:
+                return
+            if isinstance(item, bytes):
+                if self.max_bytes and self.size + len(item) > self.max_bytes:
+                    SLOW_CONSUMER_DISCONNECTS["bytes"].inc()
+                    self._cut_off(f"relay link '{self.name}', over {self.max_bytes} bytes were waiting for it")
+                    item = None
+                else:
+                    self.size += len(item)
+            if item is not None:
+                if self.max_age and not self.ready:
+                    self.since = time.monotonic()
+                self.ready.append(item)
+            self.condition.notify()
+            wakeup = self.wakeup
+        if wakeup:
+            wakeup()
+
+    def expire(self, now):
+        """Cut the link off if what is queued has waited over max_age seconds, True if it did"""
+        with self.condition:
+            if not self.max_age or self.closed or not self.ready or now - self.since <= self.max_age:
+                return False
+            SLOW_CONSUMER_DISCONNECTS["age"].inc()
+            self._cut_off(f"relay link '{self.name}', frames waited over {self.max_age:g} seconds for it")
+            self.condition.notify()
+            wakeup = self.wakeup
+        if wakeup:
+            wakeup()
+        return True
+
+    def _cut_off(self, reason):
+        # the writer stops, and the server ends the connection and with it every session on the link
+        self.cut_off = reason
+        self.closed = True
+        self.ready.clear()
+        self.size = 0
+
+    def take(self):
+        """Block until something is scheduled, returns [] once the link is closed"""
+        with self.condition:
+            while not self.ready and not self.closed:
+                self.condition.wait()
+            return self._take_all()
+
+    def take_nowait(self):
+        with self.condition:
+            return self._take_all()
+
+    def _take_all(self):
+        items = list(self.ready)
+        self.ready.clear()
+        self.size = 0
+        return items
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            wakeup = self.wakeup
+        if wakeup:
+            wakeup()
+
+    def collect(self, items):
+        """Encoded frames for a batch of scheduled items, and the sessions whose outbox was closed"""
+        frames = []
+        ended = []
+        for item in items:
+            if isinstance(item, bytes):
+                frames.append(item)
+                continue
+            session = item
+            session.scheduled = False
+            outbox = session.outbox
+            # read before taking, a close that comes after the take schedules the session again
+            closed = outbox.closed
+            frames.extend(outbox.take_nowait())
+            if closed and not session.ended:
+                session.ended = True
+                frames.append(encode_mux(session.session_id, MUX_CLOSE))
+                ended.append(session)
+        return frames, ended
@@ -0,0 +1,199 @@
+import threading
+import time
+from chat_metrics import REGISTRY
+
+# What to do when a connection's outbound queue is full
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+QUEUE_SIZE = 256
+
+# Write coalescing, off by default: a writer that has something to send waits up to
+# COALESCE_WINDOW seconds for more, unless COALESCE_BYTES are queued already
+COALESCE_WINDOW = 0
+COALESCE_BYTES = 64 * 1024
+
+# Slow consumers: a connection is cut off once this many bytes wait for it, or once the
+# oldest of them has waited this many seconds. 0 turns either limit off
+MAX_BACKLOG = 1024 * 1024
+MAX_BACKLOG_AGE = 30.0
+
+DROPPED_MESSAGES = REGISTRY.counter("chat_dropped_messages_total", "Outbound messages dropped because a queue was full")
+OVERFLOW_DISCONNECTS = REGISTRY.counter("chat_overflow_disconnects_total", "Clients disconnected because their queue overflowed")
+SLOW_CONSUMER_DISCONNECTS = {
+    limit: REGISTRY.counter("chat_slow_consumer_disconnects_total", "Clients disconnected for reading too slowly",
+                            {"limit": limit})
+    for limit in ("bytes", "age")
+}
+
+class Outbox:
+    """Bounded queue of encoded messages waiting to be written to one connection.
+
+    Senders only call put, a single writer (a thread or an event-loop task) drains the
+    queue, so a client that reads slowly only ever fills its own queue.
+    """
+
+    # a server holds one per client, slots keep tens of thousands of idle ones small
+    __slots__ = ("max_messages", "policy", "max_bytes", "max_age", "messages", "size", "since", "dropped", "cut_off",
+                 "closed", "lingering", "lock", "condition", "wakeup")
+
+    def __init__(self, max_messages=QUEUE_SIZE, policy=DROP_OLDEST, max_bytes=0, max_age=0):
+        self.max_messages = max_messages
+        self.policy = policy
+        # the slow consumer limits, see expire for the age
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # a list rather than a deque, an empty deque takes a whole block. Dropping the
+        # oldest from a full queue moves max_messages pointers, only a slow client pays that
+        self.messages = []
+        # bytes queued
+        self.size = 0
+        # when the oldest queued message was put, only kept with max_age
+        self.since = 0.0
+        self.dropped = 0
+        # why the outbox was closed to end the connection, to finish "Disconnecting ...", None if it was not
+        self.cut_off = None
+        self.closed = False
+        # while the writer waits out a coalescing window, the bytes that end it early
+        self.lingering = 0
+        self.lock = threading.Lock()
+        # made by the first blocking take, event-loop and relay link writers never wait on it
+        self.condition = None
+        # event-loop writers set this to get woken up instead of waiting on the condition
+        self.wakeup = None
+
+    def put(self, data):
+        """Queue data for the writer, returns False if the connection is closed or must be dropped"""
+        with self.lock:
+            if self.closed:
+                return False
+            accepted = True
+            if self.max_bytes and self.size + len(data) > self.max_bytes:
+                SLOW_CONSUMER_DISCONNECTS["bytes"].inc()
+                self._cut_off(f"slow client, over {self.max_bytes} bytes were waiting for it")
+                accepted = False
+            elif len(self.messages) >= self.max_messages:
+                self.dropped += 1
+                DROPPED_MESSAGES.inc()
+                if self.policy == DROP_NEWEST:
+                    return True
+                if self.policy == DISCONNECT:
+                    OVERFLOW_DISCONNECTS.inc()
+                    self._cut_off("client whose outbound queue overflowed")
+                    accepted = False
+                else:
+                    self.size -= len(self.messages.pop(0))
+            if accepted:
+                if self.max_age and not self.messages:
+                    self.since = time.monotonic()
+                self.messages.append(data)
+                self.size += len(data)
+            if self.lingering and not self.closed and self.size < self.lingering and len(self.messages) < self.max_messages:
+                # the writer is gathering a batch, it takes this one with the rest
+                return accepted
+            if self.condition is not None:
+                self.condition.notify()
+            wakeup = self.wakeup
+        if wakeup:
+            wakeup()
+        return accepted
+
+    def expire(self, now):
+        """Cut the connection off if the oldest queued message has waited over max_age seconds,
+        True if it did. Called periodically, now is time.monotonic()"""
+        with self.lock:
+            if not self.max_age or self.closed or not self.messages or now - self.since <= self.max_age:
+                return False
+            SLOW_CONSUMER_DISCONNECTS["age"].inc()
+            self._cut_off(f"slow client, a message waited over {self.max_age:g} seconds for it")
+        self._wake()
+        return True
+
+    def cut(self, reason):
+        """Close the outbox and drop what it holds, for a connection the server gives up on. The writer ends
+        the connection, reason finishes the "Disconnecting ..." it prints. False if it was already closed"""
+        with self.lock:
+            if self.closed:
+                return False
+            self._cut_off(reason)
+        self._wake()
+        return True
+
+    def _cut_off(self, reason):
+        # the writer sees the closed outbox and ends the connection
+        self.cut_off = reason
+        self.closed = True
+        self.messages.clear()
+        self.size = 0
+        if self.condition is not None:
+            self.condition.notify()
+
+    def _wake(self):
+        wakeup = self.wakeup
+        if wakeup:
+            wakeup()
+
+    def take(self, linger=0, max_bytes=COALESCE_BYTES):
+        """Block until there is something to write, returns [] once the outbox is closed and empty.
+
+        With linger the writer then waits up to that many seconds for more, so a burst
+        goes out in one write instead of one per message. It stops waiting early once
+        max_bytes or a full queue are waiting.
+        """
+        with self.lock:
+            if self.condition is None:
+                self.condition = threading.Condition(self.lock)
+            while not self.messages and not self.closed:
+                self.condition.wait()
+            if linger and self._start_linger(max_bytes):
+                deadline = time.monotonic() + linger
+                # put only notifies once the batch is complete, so this wakes up once per batch
+                while not self.closed and self.size < max_bytes and len(self.messages) < self.max_messages:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            return self._take_all()
+
+    def linger(self, max_bytes):
+        """Have put call the wakeup only once max_bytes or a full queue are waiting, until the next take.
+
+        For event-loop writers, which wait out the coalescing window themselves.
+        Returns False if there is nothing to wait for.
+        """
+        with self.lock:
+            return self._start_linger(max_bytes)
+
+    def _start_linger(self, max_bytes):
+        if self.closed or not self.messages or self.size >= max_bytes or len(self.messages) >= self.max_messages:
+            return False
+        self.lingering = max_bytes
+        return True
+
+    def take_nowait(self):
+        """Return everything queued so far without blocking"""
+        with self.lock:
+            return self._take_all()
+
+    def _take_all(self):
+        batch = self.messages
+        self.messages = []
+        self.size = 0
+        self.lingering = 0
+        return batch
+
+    def close(self):
+        """Stop accepting messages, whatever is already queued still gets written"""
+        with self.lock:
+            self.closed = True
+            if self.condition is not None:
+                self.condition.notify()
+            wakeup = self.wakeup
+        if wakeup:
+            wakeup()
+
+    @property
+    def depth(self):
+        return len(self.messages)
@@ -0,0 +1,263 @@
+import struct
+
+# Wire protocol shared by the chat server, relay and client.
+#
+# The first packet a client sends is the hello: the nickname, optionally followed
+# by a newline and a space separated list of capabilities ("alice\nframed").
+# A bare nickname is the old unframed protocol where every recv is one message.
+# When the client asks for capabilities the server answers with a "/caps ..."
+# message listing the ones it granted, and from then on both sides use them.
+#
+# Framed mode prefixes every message with its length as a 4 byte big-endian
+# integer, so several messages can share one send and one recv.
+#
+# With the deltas capability the client gets one full "/users ..." list per room
+# it enters and then only "/users-delta [#room ]+alice,-bob" changes.
+#
+# With the resume capability (framed clients only) the server's first message after
+# "/caps" is "/session TOKEN". Everything after "/caps" is the session's stream and
+# the client counts its bytes. After a dropped connection the client can say hello
+# with resume=TOKEN:OFFSET, OFFSET being the bytes it received; the server answers
+# "/caps ... resume=OFFSET" and continues the stream from there. A "/caps" without
+# a resume value means the session is gone and a new one starts.
+#
+# The relay marks the hellos it forwards with the relayed flag, the only way a
+# nickname may start with '*'. The flag is not a capability and is never echoed.
+#
+# A relay can also carry many clients over one connection, a multiplexed link.
+# It says hello with the mux capability and after the server's "/caps mux" every
+# frame on the link starts with a session id and a frame kind:
+#   open  - a client connected, the body is its IP, a newline and its hello
+#   data  - one message to or from that client
+#   close - the client left, or the server ended the session
+# Session 0 is reserved for the link itself.
+#
+# With the fanout capability as well, the server sends a room's broadcasts to the
+# link once instead of once per session on it, and keeps the relay informed of
+# which sessions are in which room:
+#   join, leave - the session entered or left the room named in the body
+#   broadcast   - the body is the room, a newline and the message; the session id
+#                 is the sender's session on this link, which does not get it, or 0
+#
+# With the zlib capability (framed connections and relay links, not the sessions on
+# a link, which share their link's) everything after "/caps" is a zlib stream in
+# both directions, see chat_compress. The hello and "/caps" are never compressed,
+# so a client asking for zlib sends nothing more until it has read "/caps", and
+# compresses only if it was granted. A resumed connection starts new streams.
+#
+# With the ping capability the server sends "/ping" to a connection it has not heard
+# from for a while and the client answers "/pong". Anything the client sends counts,
+# so only quiet clients are pinged, and one that answers nothing for the idle timeout
+# is taken for dead and disconnected.
+
+ENCODING = 'utf-8'
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 1024 * 1024
+
+CAP_FRAMED = "framed"
+CAP_DELTAS = "deltas"
+CAP_PING = "ping"
+SUPPORTED_CAPS = (CAP_FRAMED, CAP_DELTAS, CAP_PING)
+CAP_RESUME = "resume"
+CAP_COMPRESS = "zlib"
+RELAYED = "relayed"
+# Addresses relays may connect from by default. A relay link names each client's IP and a
+# relayed hello gets the '*' prefix, so only trusted peers may send either
+TRUSTED_RELAYS = ("127.0.0.1", "::1")
+
+CAP_MUX = "mux"
+CAP_FANOUT = "fanout"
+MUX_HEADER = struct.Struct('!IB')
+MUX_OPEN = 1
+MUX_DATA = 2
+MUX_CLOSE = 3
+MUX_JOIN = 4
+MUX_LEAVE = 5
+MUX_BROADCAST = 6
+
+class ProtocolError(Exception):
+    """Raised when a peer sends data that does not follow the protocol"""
+
+def encode_frame(payload):
+    """Prefix a bytes payload with its length"""
+    return HEADER.pack(len(payload)) + payload
+
+def encode_mux(session_id, kind, body=b""):
+    """Frame for one session of a multiplexed link"""
+    return encode_frame(MUX_HEADER.pack(session_id, kind) + body)
+
+def decode_mux(payload):
+    """Split a multiplexed link frame's payload into (session id, kind, body)"""
+    session_id, kind = MUX_HEADER.unpack_from(payload)
+    return session_id, kind, payload[MUX_HEADER.size:]
+
+def is_link_hello(data):
+    """True for the hello of a relay's multiplexed link"""
+    return bool(data) and CAP_MUX in parse_hello(data)[1]
+
+def build_hello(nickname, caps=()):
+    """Build the first packet a client sends"""
+    if not caps:
+        return nickname.encode(ENCODING)
+    return f"{nickname}\n{format_caps(caps)}".encode(ENCODING)
+
+def parse_hello(data):
+    """Split a hello packet into (nickname, caps dict)"""
+    text = data.decode(ENCODING)
+    nickname, _, cap_line = text.partition("\n")
+    return nickname, parse_caps(cap_line)
+
+def parse_caps(cap_line):
+    """Parse "framed key=value" into {"framed": "", "key": "value"}"""
+    caps = {}
+    for token in cap_line.split():
+        name, _, value = token.partition("=")
+        caps[name] = value
+    return caps
+
+def format_caps(caps):
+    """Inverse of parse_caps, also accepts a plain list of names"""
+    if isinstance(caps, dict):
+        return " ".join(f"{name}={value}" if value else name for name, value in caps.items())
+    return " ".join(caps)
+
+class Payload:
+    """A message encoded once for all its recipients, broadcasts share it instead of
+    encoding the message per connection. Every codec picks the form it sends, the
+    same bytes object ends up in every queue that takes that form."""
+
+    __slots__ = ("data", "frame")
+
+    def __init__(self, message):
+        self.data = message.encode(ENCODING)
+        self.frame = encode_frame(self.data)
+
+class RawCodec:
+    """The old unframed protocol, each recv is taken as exactly one message"""
+    framed = False
+
+    def encode(self, message):
+        return message.encode(ENCODING)
+
+    def encode_payload(self, payload):
+        return payload.data
+
+    def encode_many(self, messages):
+        return b"".join(self.encode(message) for message in messages)
+
+    def encode_frames(self, frames):
+        """Re-encode messages kept framed (e.g. the room history) for this connection"""
+        return b"".join(frame[HEADER.size:] for frame in frames)
+
+    def decode(self, data):
+        return [data.decode(ENCODING)] if data else []
+
+class FramedCodec:
+    """Length-prefixed framing, keeps partial frames between calls to decode"""
+    framed = True
+    __slots__ = ("buffer",)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def encode(self, message):
+        return encode_frame(message.encode(ENCODING))
+
+    def encode_payload(self, payload):
+        return payload.frame
+
+    def encode_many(self, messages):
+        """Encode several messages so they can go out in a single send"""
+        return b"".join(self.encode(message) for message in messages)
+
+    def encode_frames(self, frames):
+        # already in this codec's format
+        return b"".join(frames)
+
+    def decode(self, data):
+        """Feed received bytes, returns every message that is now complete"""
+        return [payload.decode(ENCODING) for payload in self.decode_payloads(data)]
+
+    def decode_payloads(self, data):
+        """Like decode but returns the raw payload bytes"""
+        self.buffer += data
+        payloads = []
+        view = memoryview(self.buffer)
+        offset = 0
+        try:
+            while len(view) - offset >= HEADER.size:
+                (length,) = HEADER.unpack_from(view, offset)
+                if length > MAX_FRAME_SIZE:
+                    raise ProtocolError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+                end = offset + HEADER.size + length
+                if end > len(view):
+                    break
+                payloads.append(bytes(view[offset + HEADER.size:end]))
+                offset = end
+        finally:
+            view.release()
+        del self.buffer[:offset]
+        return payloads
+
+    def decode_first(self, data):
+        """Feed received bytes, returns the first complete payload (None until there is one) and
+        the bytes after it, for a reply after which the stream changes format ("/caps" granting zlib)"""
+        self.buffer += data
+        if len(self.buffer) < HEADER.size:
+            return None, b""
+        (length,) = HEADER.unpack_from(self.buffer)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+        end = HEADER.size + length
+        if len(self.buffer) < end:
+            return None, b""
+        payload, rest = bytes(self.buffer[HEADER.size:end]), bytes(self.buffer[end:])
+        self.buffer.clear()
+        return payload, rest
+
+    def split(self, data):
+        """Feed received bytes, returns the complete frames still encoded (used to forward them)"""
+        self.buffer += data
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+            if offset + HEADER.size + length > len(self.buffer):
+                break
+            offset += HEADER.size + length
+        complete = bytes(self.buffer[:offset])
+        del self.buffer[:offset]
+        return complete
+
+class MuxCodec:
+    """Wraps every message in a data frame for one session of a multiplexed link.
+
+    framed tells whether the client behind the relay uses framing, the relay
+    takes care of its wire format.
+    """
+
+    __slots__ = ("framed", "prefix")
+
+    def __init__(self, session_id, framed=True):
+        self.framed = framed
+        self.prefix = MUX_HEADER.pack(session_id, MUX_DATA)
+
+    def encode(self, message):
+        return encode_frame(self.prefix + message.encode(ENCODING))
+
+    def encode_payload(self, payload):
+        # the session id makes every session's frame its own
+        return encode_frame(self.prefix + payload.data)
+
+    def encode_many(self, messages):
+        return b"".join(self.encode(message) for message in messages)
+
+    def encode_frames(self, frames):
+        return b"".join(encode_frame(self.prefix + frame[HEADER.size:]) for frame in frames)
+
+def make_codec(caps):
+    """Pick the codec for a connection from its negotiated caps"""
+    if CAP_FRAMED in caps:
+        return FramedCodec()
+    return RawCodec()
@@ -0,0 +1,119 @@
+import threading
+import time
+
+# Default limits: a burst of 5 messages, refilled at 5 messages every 3 seconds
+RATE = 5 / 3
+BURST = 5
+
+class TokenBucket:
+    """Token bucket owned by a single connection.
+
+    Only the connection's own reader touches it, so it needs no lock.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until one token is available, 0 if one is available now"""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket shared by several connections, guarded by its own lock"""
+
+    __slots__ = ("lock", "users")
+
+    def __init__(self, rate, burst):
+        super().__init__(rate, burst)
+        self.lock = threading.Lock()
+        self.users = 0
+
+class RateLimiter:
+    """Per-connection token buckets plus optional per-IP and global buckets.
+
+    The limiter only holds the configuration and the shared buckets, each
+    connection keeps its own bucket (from new_bucket) and passes it to check.
+    A rate of 0 disables that bucket.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, ip_rate=0, ip_burst=0, global_rate=0, global_burst=0):
+        self.rate = rate
+        self.burst = burst
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst or burst
+        self.global_bucket = SharedTokenBucket(global_rate, global_burst or burst) if global_rate else None
+        self.ip_buckets = {}
+        self.ip_lock = threading.Lock()
+
+    def new_bucket(self):
+        """Bucket for a new connection, None when per-connection limiting is off"""
+        return TokenBucket(self.rate, self.burst) if self.rate else None
+
+    def acquire_ip(self, ip):
+        """Register a connection from an IP, returns the shared bucket for that IP"""
+        if not self.ip_rate or ip is None:
+            return None
+        with self.ip_lock:
+            bucket = self.ip_buckets.get(ip)
+            if bucket is None:
+                bucket = self.ip_buckets[ip] = SharedTokenBucket(self.ip_rate, self.ip_burst)
+            bucket.users += 1
+            return bucket
+
+    def release_ip(self, ip):
+        """Forget an IP's bucket once its last connection is gone"""
+        if not self.ip_rate or ip is None:
+            return
+        with self.ip_lock:
+            bucket = self.ip_buckets.get(ip)
+            if bucket is not None:
+                bucket.users -= 1
+                if bucket.users <= 0:
+                    del self.ip_buckets[ip]
+
+    def check(self, bucket, ip_bucket=None):
+        """Take one token from every bucket that applies.
+
+        Returns 0 if the message may go out, otherwise the seconds until it could.
+        Nothing is taken unless every bucket has a token.
+        """
+        now = time.monotonic()
+        wait = bucket.wait_time(now) if bucket else 0.0
+        if wait:
+            return wait
+
+        shared = [b for b in (ip_bucket, self.global_bucket) if b is not None]
+        if not shared:
+            if bucket:
+                bucket.take()
+            return 0.0
+
+        for shared_bucket in shared:
+            shared_bucket.lock.acquire()
+        try:
+            wait = max(shared_bucket.wait_time(now) for shared_bucket in shared)
+            if wait:
+                return wait
+            for shared_bucket in shared:
+                shared_bucket.take()
+        finally:
+            for shared_bucket in shared:
+                shared_bucket.lock.release()
+        if bucket:
+            bucket.take()
+        return 0.0
@@ -1,7 +1,17 @@
 import socket
 import threading
 import argparse
+import itertools
+import selectors
+import errno
+import os
 import time
+from chat_protocol import (SUPPORTED_CAPS, CAP_MUX, CAP_FANOUT, CAP_COMPRESS, RELAYED, TRUSTED_RELAYS, MUX_OPEN, MUX_DATA, MUX_CLOSE,
+                           MUX_JOIN, MUX_LEAVE, MUX_BROADCAST, ENCODING, FramedCodec, parse_hello, parse_caps,
+                           format_caps, build_hello, make_codec, is_link_hello, encode_frame, encode_mux, decode_mux)
+from chat_outbox import Outbox, QUEUE_SIZE, DISCONNECT
+from chat_compress import Deflater, InflatingCodec
+from chat_metrics import REGISTRY, start_metrics_server
 
 # relay settings
 RELAY_HOST = '127.0.0.1'
@@ -10,30 +20,295 @@ SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 8888
 BUFSIZE = 4096
 
+# Upstream connections shared by all relay clients, 0 opens one server connection per client
+UPSTREAMS = 4
+LINK_BUFSIZE = 65536
+# frames queued for a downstream relay, it carries the traffic of many clients
+LINK_QUEUE_SIZE = 65536
+# room for a burst of connecting clients, a full accept queue makes them retry after a second or more
+LISTEN_BACKLOG = 1024
+
+# selectors engine
+ENGINES = ("threads", "selectors")
+CHUNK_SIZE = 65536
+SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+MAX_IDLE_PIPES = 64
+
+# Metrics, served in the Prometheus text format with --metrics-port
+RELAY_CONNECTS = REGISTRY.counter("chat_relay_connects_total", "Clients accepted by the relay")
+RELAY_DISCONNECTS = REGISTRY.counter("chat_relay_disconnects_total", "Relay clients that disconnected")
+RELAY_BYTES = {
+    direction: REGISTRY.counter("chat_relay_bytes_total", "Bytes forwarded by the relay",
+                                {"direction": direction.replace(" ", "_")})
+    for direction in ("client to server", "server to client")
+}
+
+class RelaySession:
+    """A relay client carried over an upstream link"""
+    
+    def __init__(self, session_id, client_socket, codec):
+        self.session_id = session_id
+        self.client_socket = client_socket
+        self.codec = codec
+        self.outbox = Outbox(QUEUE_SIZE)
+    
+    def deliver(self, payload, frame=None):
+        """Queue a message from the server, in the client's wire format. A broadcast passes the
+        frame it made once for all its recipients"""
+        if self.codec.framed:
+            payload = frame or encode_frame(payload)
+        self.outbox.put(payload)
+    
+    def forward(self, kind, body):
+        # room memberships are kept by the upstream link, a local client needs nothing else
+        pass
+    
+    def close(self):
+        """The server ended the session, the writer closes the client"""
+        self.outbox.close()
+
+class ChildSession:
+    """A client of a downstream relay, carried over one of this relay's upstream links"""
+    
+    def __init__(self, session_id, child_link, child_id, link):
+        self.session_id = session_id
+        self.child_link = child_link
+        # the session's id on the downstream relay's link
+        self.child_id = child_id
+        self.link = link
+    
+    def deliver(self, payload, frame=None):
+        self.forward(MUX_DATA, payload)
+    
+    def forward(self, kind, body):
+        """Pass a frame for the session on to the downstream relay"""
+        self.child_link.send(encode_mux(self.child_id, kind, body))
+    
+    def close(self):
+        if self.child_link.sessions.pop(self.child_id, None) is not None:
+            self.forward(MUX_CLOSE, b"")
+
+class ChildLink:
+    """A downstream relay's multiplexed link, this relay is its server"""
+    
+    def __init__(self, name, sock):
+        self.name = name
+        self.socket = sock
+        # the downstream relay's session id -> ChildSession
+        self.sessions = {}
+        # written by one writer thread, the upstream links' readers only queue frames. A dropped frame
+        # would leave a session out of step, so a link that falls behind is cut off instead
+        self.outbox = Outbox(LINK_QUEUE_SIZE, DISCONNECT)
+    
+    def send(self, data):
+        if not self.outbox.put(data) and self.outbox.cut_off:
+            # the writer may be stuck in a send, this ends it and the reader, which closes the sessions
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class UpstreamLink:
+    """A persistent server connection carrying the sessions of many relay clients"""
+    
+    def __init__(self, name, server_host, server_port, fanout=False, compress=False, server_path=None):
+        self.name = name
+        self.server_host = server_host
+        self.server_port = server_port
+        self.server_path = server_path
+        self.fanout = fanout
+        # ask for zlib, the link then compresses what it sends with deflater, a new one per connection
+        self.compress = compress
+        self.deflater = None
+        self.socket = None
+        # session id -> RelaySession or ChildSession
+        self.sessions = {}
+        # with fan-out, room -> ids of the sessions in it and session id -> its rooms (rooms as sent, in bytes)
+        self.rooms = {}
+        self.session_rooms = {}
+        # client threads send whole frames, the lock keeps them from interleaving
+        self.send_lock = threading.Lock()
+        self.connect_lock = threading.Lock()
+    
+    def ensure_connected(self):
+        """Connect if the link is down, raises OSError if the server cannot be reached"""
+        with self.connect_lock:
+            if self.socket is not None:
+                return
+            server_socket = connect_server(self.server_host, self.server_port, self.server_path)
+            try:
+                caps = [CAP_MUX]
+                if self.fanout:
+                    caps.append(CAP_FANOUT)
+                if self.compress:
+                    caps.append(CAP_COMPRESS)
+                server_socket.sendall(build_hello(self.name, caps))
+                codec = FramedCodec()
+                reply = None
+                while reply is None:
+                    data = server_socket.recv(BUFSIZE)
+                    if not data:
+                        raise ConnectionError("server closed the link")
+                    # what follows "/caps" may be compressed already
+                    reply, rest = codec.decode_first(data)
+                reply = reply.decode(ENCODING)
+                granted = parse_caps(reply[len("/caps"):]) if reply.startswith("/caps") else {}
+                if CAP_MUX not in granted:
+                    raise ConnectionError("server does not support multiplexed links")
+                compressed = CAP_COMPRESS in granted
+                if compressed:
+                    codec = InflatingCodec(codec)
+                payloads = codec.decode_payloads(rest)
+            except Exception:
+                server_socket.close()
+                raise
+            self.deflater = Deflater() if compressed else None
+            self.socket = server_socket
+            reader_thread = threading.Thread(
+                target=self.read_loop,
+                args=(server_socket, codec, payloads),
+                daemon=True
+            )
+            reader_thread.start()
+            print(f"[Relay] Upstream link '{self.name}' connected" + (" (compressed)" if compressed else ""))
+    
+    def send(self, data):
+        with self.send_lock:
+            if self.socket is None:
+                raise ConnectionError("upstream link is down")
+            if self.deflater is not None:
+                # under the lock, the stream has to be compressed in the order it is sent
+                data = self.deflater.compress(data)
+            self.socket.sendall(data)
+        RELAY_BYTES["client to server"].inc(len(data))
+    
+    def read_loop(self, server_socket, codec, payloads):
+        """Hand the server's frames to the sessions they belong to"""
+        forwarded = RELAY_BYTES["server to client"]
+        try:
+            while True:
+                for payload in payloads:
+                    self.dispatch(payload)
+                data = server_socket.recv(LINK_BUFSIZE)
+                if not data:
+                    break
+                forwarded.inc(len(data))
+                payloads = codec.decode_payloads(data)
+        except Exception as e:
+            print(f"[Relay Error] {e}")
+        finally:
+            # every client on the link loses its server, the next client reconnects the link
+            with self.connect_lock:
+                self.socket = None
+            server_socket.close()
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            self.rooms.clear()
+            self.session_rooms.clear()
+            for session in sessions:
+                session.close()
+            print(f"[Relay] Upstream link '{self.name}' closed, {len(sessions)} clients dropped")
+    
+    def dispatch(self, payload):
+        """Handle one frame from the server, only the link's reader thread calls this"""
+        session_id, kind, body = decode_mux(payload)
+        if kind == MUX_BROADCAST:
+            self.fan_out(session_id, body)
+            return
+        
+        # memberships are kept even for sessions whose client has just gone, the server's leave frames follow
+        if kind == MUX_JOIN:
+            self.rooms.setdefault(body, set()).add(session_id)
+            self.session_rooms.setdefault(session_id, set()).add(body)
+        elif kind == MUX_LEAVE:
+            self.unsubscribe(session_id, body)
+        elif kind == MUX_CLOSE:
+            for room in list(self.session_rooms.get(session_id, ())):
+                self.unsubscribe(session_id, room)
+        
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        if kind == MUX_DATA:
+            session.deliver(body)
+        elif kind == MUX_CLOSE:
+            # the server ended the session
+            self.sessions.pop(session_id, None)
+            session.close()
+        else:
+            session.forward(kind, body)
+    
+    def unsubscribe(self, session_id, room):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(session_id)
+            if not members:
+                del self.rooms[room]
+        rooms = self.session_rooms.get(session_id)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self.session_rooms[session_id]
+    
+    def fan_out(self, excluded, body):
+        """Deliver a room broadcast to the local members, and once to every downstream relay with members"""
+        room, _, message = body.partition(b"\n")
+        # framed once, every framed member queues the same bytes
+        frame = encode_frame(message)
+        children = {}
+        for session_id in self.rooms.get(room, ()):
+            session = self.sessions.get(session_id)
+            if session is None:
+                continue
+            if isinstance(session, ChildSession):
+                # the downstream relay leaves out the sender if it is one of its clients
+                if session_id == excluded:
+                    children[session.child_link] = session.child_id
+                else:
+                    children.setdefault(session.child_link, 0)
+            elif session_id != excluded:
+                session.deliver(message, frame)
+        for child_link, child_excluded in children.items():
+            child_link.send(encode_mux(child_excluded, MUX_BROADCAST, body))
+
 class ChatRelay:
-    def __init__(self, relay_host, relay_port, server_host, server_port):
+    def __init__(self, relay_host, relay_port, server_host, server_port, metrics_port=None, upstreams=UPSTREAMS,
+                 fanout=False, compress=False, server_path=None, trusted_relays=TRUSTED_RELAYS):
         """Initialize the chat relay server"""
         self.relay_host = relay_host
         self.relay_port = relay_port
         self.server_host = server_host
         self.server_port = server_port
+        # the server's Unix socket, used instead of its TCP port when set
+        self.server_path = server_path
         self.clients = []
         self.relay_socket = None
+        self.metrics_port = metrics_port
+        # subscribe to room broadcasts once per link and deliver them locally
+        self.fanout = fanout
+        # the downstream relays that may link to this one, their links name each client's IP
+        self.trusted_relays = set(trusted_relays)
+        self.links = [
+            UpstreamLink(f"relay-{relay_port}-{i}", server_host, server_port, fanout, compress, server_path)
+            for i in range(upstreams)
+        ]
+        self.next_link = itertools.count()
+        # session ids are unique for the relay's lifetime, 0 is reserved for the link itself
+        self.session_ids = itertools.count(1)
         
     def start(self):
         """Start the relay server"""
-        self.relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
         try:
-            self.relay_socket.bind((self.relay_host, self.relay_port))
-            self.relay_socket.listen(5)
-            print(f"[Relay] Listening on {self.relay_host}:{self.relay_port}")
-            print(f"[Relay] Forwarding to server at {self.server_host}:{self.server_port}")
+            self.listen()
+            
+            # the pool is opened up front so clients do not pay for the server connection
+            for link in self.links:
+                try:
+                    link.ensure_connected()
+                except OSError as e:
+                    print(f"[Relay] Upstream link '{link.name}' not connected yet: {e}")
             
-            # stat printing thread
-            stats_thread = threading.Thread(target=self.print_stats, daemon=True)
-            stats_thread.start()
+            self.start_monitoring()
             
             # Accept incoming connections
             while True:
@@ -54,6 +329,25 @@ class ChatRelay:
             if self.relay_socket:
                 self.relay_socket.close()
     
+    def listen(self):
+        """Open the socket clients connect to"""
+        self.relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.relay_socket.bind((self.relay_host, self.relay_port))
+        self.relay_socket.listen(LISTEN_BACKLOG)
+        print(f"[Relay] Listening on {self.relay_host}:{self.relay_port}")
+        print(f"[Relay] Forwarding to server at {self.server_path or f'{self.server_host}:{self.server_port}'}")
+    
+    def start_monitoring(self):
+        """Start the stats printing thread and, if configured, the metrics endpoint"""
+        stats_thread = threading.Thread(target=self.print_stats, daemon=True)
+        stats_thread.start()
+        
+        REGISTRY.gauge("chat_relay_connections", "Clients connected to the relay", lambda: len(self.clients))
+        if self.metrics_port:
+            start_metrics_server(self.metrics_port)
+            print(f"[Relay] Metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+    
     def print_stats(self):
         """Periodically print relay statistics"""
         while True:
@@ -63,43 +357,39 @@ class ChatRelay:
     
     def handle_client(self, client_socket, address):
         """Handle a client connection by relaying to the main server"""
+        if self.links:
+            self.handle_muxed_client(client_socket, address)
+            return
         server_socket = None
         
         try:
             # Connect to the main server
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.connect((self.server_host, self.server_port))
+            server_socket = connect_server(self.server_host, self.server_port, self.server_path)
             
             # Add to clients list
             self.clients.append(client_socket)
+            RELAY_CONNECTS.inc()
             
             # handle the nickname exchange
             nickname_data = client_socket.recv(BUFSIZE)
             if not nickname_data:
                 return
-                
-            # Add '*' prefix to the nickname
-            nickname = nickname_data.decode('utf-8')
-            modified_nickname = f"*{nickname}"
-            print(f"[Relay] Modified nickname: {nickname} -> {modified_nickname}")
-            
-            server_socket.send(modified_nickname.encode('utf-8'))
+            server_socket.sendall(relayed_hello(nickname_data))
             
-            # server's response --->> client
-            response = server_socket.recv(BUFSIZE)
-            if response:
-                client_socket.send(response)
+            # the server grants every cap it supports, so both directions are framed if the client asked for it
+            _, caps = parse_hello(nickname_data)
+            granted = [cap for cap in caps if cap in SUPPORTED_CAPS]
             
-            # bi-directional communication
+            # bi-directional communication, the server's response goes through the server to client pipe
             client_to_server = threading.Thread(
                 target=self.relay_data,
-                args=(client_socket, server_socket, "client to server"),
+                args=(client_socket, server_socket, "client to server", make_codec(granted)),
                 daemon=True
             )
             
             server_to_client = threading.Thread(
                 target=self.relay_data,
-                args=(server_socket, client_socket, "server to client"),
+                args=(server_socket, client_socket, "server to client", make_codec(granted)),
                 daemon=True
             )
             
@@ -122,6 +412,7 @@ class ChatRelay:
                 
             if client_socket in self.clients:
                 self.clients.remove(client_socket)
+                RELAY_DISCONNECTS.inc()
                 
             try:
                 client_socket.close()
@@ -130,18 +421,482 @@ class ChatRelay:
                 
             print(f"[Relay] Client connection from {address} closed")
     
-    def relay_data(self, source, destination, direction):
+    def pick_link(self):
+        """Next connected upstream link in round-robin order"""
+        error = None
+        for _ in range(len(self.links)):
+            link = self.links[next(self.next_link) % len(self.links)]
+            try:
+                link.ensure_connected()
+                return link
+            except OSError as e:
+                error = e
+        raise ConnectionError(f"no upstream link to the server: {error}")
+    
+    def handle_muxed_client(self, client_socket, address):
+        """Carry a client over one of the upstream links"""
+        session = None
+        link = None
+        try:
+            nickname_data = client_socket.recv(BUFSIZE)
+            if is_link_hello(nickname_data):
+                # a downstream relay, relays chain into a tree
+                if address[0] in self.trusted_relays:
+                    self.handle_child_link(client_socket, address, nickname_data)
+                else:
+                    print(f"[Relay] Refused a relay link from {address}, not a trusted relay")
+                return
+            self.clients.append(client_socket)
+            RELAY_CONNECTS.inc()
+            if not nickname_data:
+                return
+            
+            # Add '*' prefix to the nickname, the caps go through untouched
+            nickname, caps = parse_hello(nickname_data)
+            modified_nickname = f"*{nickname}"
+            print(f"[Relay] Modified nickname: {nickname} -> {modified_nickname}")
+            
+            # the relay speaks the client's wire format, the server grants every cap it supports
+            granted = [cap for cap in caps if cap in SUPPORTED_CAPS]
+            codec = make_codec(granted)
+            link = self.pick_link()
+            session = RelaySession(next(self.session_ids), client_socket, codec)
+            link.sessions[session.session_id] = session
+            writer_thread = threading.Thread(target=self.write_loop, args=(client_socket, session.outbox), daemon=True)
+            writer_thread.start()
+            
+            hello = build_hello(modified_nickname, caps)
+            link.send(encode_mux(session.session_id, MUX_OPEN, address[0].encode(ENCODING) + b"\n" + hello))
+            
+            while True:
+                data = client_socket.recv(BUFSIZE)
+                if not data:
+                    break
+                # every message of this recv goes upstream in one send
+                frames = [
+                    encode_mux(session.session_id, MUX_DATA, message.encode(ENCODING))
+                    for message in codec.decode(data)
+                ]
+                if frames:
+                    link.send(b"".join(frames))
+        except Exception as e:
+            print(f"[Relay Error] {e}")
+        finally:
+            if session is not None:
+                if link.sessions.pop(session.session_id, None) is not None:
+                    try:
+                        link.send(encode_mux(session.session_id, MUX_CLOSE))
+                    except OSError:
+                        # the link is down, the server has dropped the session already
+                        pass
+                session.outbox.close()
+            
+            if client_socket in self.clients:
+                self.clients.remove(client_socket)
+                RELAY_DISCONNECTS.inc()
+            try:
+                client_socket.close()
+            except OSError:
+                pass
+            print(f"[Relay] Client connection from {address} closed")
+    
+    def handle_child_link(self, link_socket, address, hello):
+        """Serve a downstream relay's link, its sessions go on over this relay's upstream links"""
+        name, caps = parse_hello(hello)
+        granted = [CAP_MUX, CAP_FANOUT] if self.fanout and CAP_FANOUT in caps else [CAP_MUX]
+        link_socket.sendall(FramedCodec().encode(f"/caps {format_caps(granted)}"))
+        print(f"[Relay] Downstream relay link '{name}' from {address}")
+        child = ChildLink(name, link_socket)
+        writer_thread = threading.Thread(target=self.write_loop, args=(link_socket, child.outbox), daemon=True)
+        writer_thread.start()
+        
+        codec = FramedCodec()
+        try:
+            while True:
+                data = link_socket.recv(LINK_BUFSIZE)
+                if not data:
+                    break
+                # the frames of one recv go upstream in one send per link
+                batches = {}
+                for payload in codec.decode_payloads(data):
+                    child_id, kind, body = decode_mux(payload)
+                    if kind == MUX_OPEN:
+                        try:
+                            link = self.pick_link()
+                        except ConnectionError:
+                            child.send(encode_mux(child_id, MUX_CLOSE))
+                            continue
+                        session = ChildSession(next(self.session_ids), child, child_id, link)
+                        child.sessions[child_id] = session
+                        link.sessions[session.session_id] = session
+                    elif kind in (MUX_DATA, MUX_CLOSE):
+                        session = child.sessions.get(child_id)
+                        if session is None:
+                            continue
+                        link = session.link
+                        if kind == MUX_CLOSE:
+                            del child.sessions[child_id]
+                            if link.sessions.pop(session.session_id, None) is None:
+                                continue
+                    else:
+                        continue
+                    batches.setdefault(link, []).append(encode_mux(session.session_id, kind, body))
+                for link, frames in batches.items():
+                    try:
+                        link.send(b"".join(frames))
+                    except OSError:
+                        # the link dropped, its sessions were closed with it
+                        pass
+        except Exception as e:
+            print(f"[Relay Error] {e}")
+        finally:
+            for session in list(child.sessions.values()):
+                if session.link.sessions.pop(session.session_id, None) is not None:
+                    try:
+                        session.link.send(encode_mux(session.session_id, MUX_CLOSE))
+                    except OSError:
+                        pass
+            child.sessions.clear()
+            child.outbox.close()
+            print(f"[Relay] Downstream relay link '{name}' closed")
+    
+    def write_loop(self, sock, outbox):
+        """Write queued data to a multiplexed client or downstream relay until the outbox is closed"""
+        try:
+            while True:
+                batch = outbox.take()
+                if not batch:
+                    break
+                sock.sendall(b"".join(batch))
+        except OSError:
+            pass
+        finally:
+            outbox.close()
+            if outbox.cut_off:
+                print(f"[Relay] Disconnecting {outbox.cut_off}")
+            # wakes up the reader, it closes the socket
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    
+    def relay_data(self, source, destination, direction, codec):
         """Relay data between source and destination sockets"""
+        forwarded = RELAY_BYTES[direction]
         try:
             while True:
                 data = source.recv(BUFSIZE)
                 if not data:
                     break
+                
+                # framed streams are forwarded as whole frames only, every frame that
+                # completed in this recv goes out in one send
+                if codec.framed:
+                    data = codec.split(data)
+                    if not data:
+                        continue
                     
-                destination.send(data)
+                destination.sendall(data)
+                forwarded.inc(len(data))
         except:
             # socket closed
             pass
+        finally:
+            # wake up the other direction so the pair shuts down together
+            for sock in (source, destination):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+def connect_server(server_host, server_port, server_path=None):
+    """A connection to the chat server, through its Unix socket if server_path is set"""
+    if not server_path:
+        return socket.create_connection((server_host, server_port))
+    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server_socket.connect(server_path)
+    except OSError:
+        server_socket.close()
+        raise
+    return server_socket
+
+def relayed_hello(nickname_data):
+    """The hello a client of a relayed pair sends to the server: '*' before the nickname, caps untouched
+    except zlib, the relay reads the frames it forwards so the pair stays uncompressed"""
+    nickname, caps = parse_hello(nickname_data)
+    modified_nickname = f"*{nickname}"
+    print(f"[Relay] Modified nickname: {nickname} -> {modified_nickname}")
+    caps.pop(CAP_COMPRESS, None)
+    return build_hello(modified_nickname, dict(caps, **{RELAYED: ""}))
+
+class Direction:
+    """One direction of a relayed pair: what is read from source is written to destination.
+    
+    At most one chunk is in flight per direction. While the destination cannot take it
+    the source is not read, so a slow reader pushes back on its peer instead of growing
+    a buffer in the relay.
+    """
+    
+    def __init__(self, relay, source, destination, forwarded):
+        self.relay = relay
+        self.source = source
+        self.destination = destination
+        self.forwarded = forwarded
+        # copy path: bytes read but not yet written
+        self.pending = None
+        # splice path: a pipe borrowed from the relay and how many bytes sit in it
+        self.pipe = None
+        self.in_pipe = 0
+        self.eof = False
+    
+    @property
+    def backlogged(self):
+        return bool(self.pending) or self.in_pipe > 0
+    
+    def queue(self, data):
+        """Bytes to write before anything else, e.g. the rewritten hello"""
+        self.pending = memoryview(data)
+    
+    def pump(self):
+        """The source is readable, move one chunk"""
+        if self.relay.splice:
+            try:
+                self.splice_in()
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                # socket type splice cannot handle, stay with copying
+                self.relay.splice = False
+                self.relay.release_pipe(self)
+        try:
+            data = self.source.recv(CHUNK_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self.eof = True
+            return
+        self.forwarded.inc(len(data))
+        self.pending = memoryview(data)
+        self.flush()
+    
+    def splice_in(self):
+        if self.pipe is None:
+            self.pipe = self.relay.acquire_pipe()
+        try:
+            moved = os.splice(self.source.fileno(), self.pipe[1], CHUNK_SIZE, flags=SPLICE_FLAGS)
+        except BlockingIOError:
+            self.relay.release_pipe(self)
+            return
+        if not moved:
+            self.relay.release_pipe(self)
+            self.eof = True
+            return
+        self.forwarded.inc(moved)
+        self.in_pipe = moved
+        self.flush()
+    
+    def flush(self):
+        """Write as much of the chunk in flight as the destination takes without blocking"""
+        try:
+            while self.pending:
+                sent = self.destination.send(self.pending)
+                self.pending = self.pending[sent:]
+            while self.in_pipe:
+                self.in_pipe -= os.splice(self.pipe[0], self.destination.fileno(), self.in_pipe, flags=SPLICE_FLAGS)
+        except BlockingIOError:
+            return
+        if self.pipe is not None:
+            self.relay.release_pipe(self)
+
+class RelayPair:
+    """A client and its own server connection, forwarded by the selectors engine"""
+    
+    def __init__(self, client_socket, address):
+        self.client_socket = client_socket
+        self.address = address
+        self.server_socket = None
+        self.connected = False
+        self.upstream = None
+        self.downstream = None
+        # socket -> event mask it is registered with
+        self.events = {}
+    
+    def start(self, relay, hello):
+        """Connect to the server, the rewritten hello goes out once connected"""
+        if relay.server_path:
+            self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = relay.server_path
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (relay.server_host, relay.server_port)
+        self.server_socket.setblocking(False)
+        error = self.server_socket.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS):
+            # a Unix socket whose accept queue is full refuses at once (EAGAIN) instead of waiting
+            raise ConnectionError(os.strerror(error))
+        self.upstream = Direction(relay, self.client_socket, self.server_socket, RELAY_BYTES["client to server"])
+        self.downstream = Direction(relay, self.server_socket, self.client_socket, RELAY_BYTES["server to client"])
+        self.upstream.queue(hello)
+    
+    def wanted_events(self, sock):
+        """What the loop should wait for on one of the pair's sockets"""
+        if sock is self.client_socket and self.upstream is None:
+            # waiting for the hello
+            return selectors.EVENT_READ
+        if sock is self.server_socket and not self.connected:
+            return selectors.EVENT_WRITE
+        outgoing = self.upstream if sock is self.client_socket else self.downstream
+        incoming = self.downstream if sock is self.client_socket else self.upstream
+        events = 0
+        if not outgoing.eof and not outgoing.backlogged:
+            events |= selectors.EVENT_READ
+        if incoming.backlogged:
+            events |= selectors.EVENT_WRITE
+        return events
+    
+    @property
+    def finished(self):
+        """A side closed and everything it sent has been written"""
+        return any(direction is not None and direction.eof and not direction.backlogged
+                   for direction in (self.upstream, self.downstream))
+
+class SelectorChatRelay(ChatRelay):
+    """Relay that forwards every client pair from a single selectors (epoll) loop.
+    
+    After the nickname rewrite the bytes of a pair are moved between the sockets with
+    os.splice through a pipe where available, so they never enter Python, and with
+    recv/send otherwise. Each client still has its own server connection.
+    """
+    
+    def __init__(self, relay_host, relay_port, server_host, server_port, metrics_port=None, server_path=None):
+        super().__init__(relay_host, relay_port, server_host, server_port, metrics_port, upstreams=0,
+                         server_path=server_path)
+        self.selector = selectors.DefaultSelector()
+        self.splice = hasattr(os, "splice")
+        # pipes not lent to a direction, reused so forwarding does not open and close them
+        self.pipes = []
+    
+    def start(self):
+        """Start the relay server"""
+        try:
+            self.listen()
+            self.relay_socket.setblocking(False)
+            self.selector.register(self.relay_socket, selectors.EVENT_READ)
+            self.start_monitoring()
+            print(f"[Relay] Forwarding with {'splice' if self.splice else 'recv/send'} from one event loop")
+            
+            while True:
+                for key, mask in self.selector.select():
+                    if key.data is None:
+                        self.accept_clients()
+                    else:
+                        self.handle_event(key.data, key.fileobj, mask)
+                    
+        except KeyboardInterrupt:
+            print("[Relay] Shutting down...")
+        finally:
+            if self.relay_socket:
+                self.relay_socket.close()
+            self.selector.close()
+    
+    def accept_clients(self):
+        while True:
+            try:
+                client_socket, address = self.relay_socket.accept()
+            except BlockingIOError:
+                return
+            print(f"[Relay] New client connection from {address}")
+            client_socket.setblocking(False)
+            pair = RelayPair(client_socket, address)
+            self.clients.append(client_socket)
+            RELAY_CONNECTS.inc()
+            self.update_events(pair)
+    
+    def handle_event(self, pair, sock, mask):
+        try:
+            if pair.upstream is None:
+                # the first recv is the hello, the nickname gets its '*' before anything is forwarded
+                nickname_data = sock.recv(BUFSIZE)
+                if not nickname_data:
+                    self.close_pair(pair)
+                    return
+                pair.start(self, relayed_hello(nickname_data))
+            elif sock is pair.server_socket and not pair.connected:
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise ConnectionError(os.strerror(error))
+                pair.connected = True
+                pair.upstream.flush()
+            else:
+                outgoing = pair.upstream if sock is pair.client_socket else pair.downstream
+                incoming = pair.downstream if sock is pair.client_socket else pair.upstream
+                if mask & selectors.EVENT_WRITE:
+                    incoming.flush()
+                if mask & selectors.EVENT_READ and not outgoing.backlogged:
+                    outgoing.pump()
+        except OSError as e:
+            if not isinstance(e, (ConnectionResetError, BrokenPipeError)):
+                print(f"[Relay Error] {e}")
+            self.close_pair(pair)
+            return
+        
+        if pair.finished:
+            self.close_pair(pair)
+        else:
+            self.update_events(pair)
+    
+    def update_events(self, pair):
+        for sock in (pair.client_socket, pair.server_socket):
+            if sock is None:
+                continue
+            events = pair.wanted_events(sock)
+            registered = pair.events.get(sock, 0)
+            if events == registered:
+                continue
+            if not events:
+                self.selector.unregister(sock)
+            elif not registered:
+                self.selector.register(sock, events, pair)
+            else:
+                self.selector.modify(sock, events, pair)
+            pair.events[sock] = events
+    
+    def close_pair(self, pair):
+        # like the threads engine, the pair ends together once either side has gone
+        for direction in (pair.upstream, pair.downstream):
+            if direction is not None:
+                self.release_pipe(direction)
+        for sock in (pair.client_socket, pair.server_socket):
+            if sock is None:
+                continue
+            if pair.events.get(sock):
+                self.selector.unregister(sock)
+            sock.close()
+        pair.events.clear()
+        if pair.client_socket in self.clients:
+            self.clients.remove(pair.client_socket)
+            RELAY_DISCONNECTS.inc()
+        print(f"[Relay] Client connection from {pair.address} closed")
+    
+    def acquire_pipe(self):
+        if self.pipes:
+            return self.pipes.pop()
+        return os.pipe()
+    
+    def release_pipe(self, direction):
+        """Take a direction's pipe back, it is only reused when nothing is left in it"""
+        pipe = direction.pipe
+        if pipe is None:
+            return
+        direction.pipe = None
+        if direction.in_pipe or len(self.pipes) >= MAX_IDLE_PIPES:
+            for fd in pipe:
+                os.close(fd)
+        else:
+            self.pipes.append(pipe)
+        direction.in_pipe = 0
 
 def main():
     parser = argparse.ArgumentParser(description='Chat Relay Server')
@@ -153,9 +908,39 @@ def main():
                         help=f'Chat server host address (default: {SERVER_HOST})')
     parser.add_argument('--server-port', dest="server_port", type=int, default=SERVER_PORT, 
                         help=f'Chat server port (default: {SERVER_PORT})')
+    parser.add_argument('--server-socket', dest="server_path", metavar="PATH",
+                        help='Connect to the server through its Unix socket at PATH instead of TCP (default: off)')
+    parser.add_argument('--metrics-port', dest="metrics_port", type=int,
+                        help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (default: off)')
+    parser.add_argument('--upstreams', dest="upstreams", type=int,
+                        help=f'Server connections shared by all clients, 0 opens one per client (default: {UPSTREAMS})')
+    parser.add_argument('--engine', dest="engine", choices=ENGINES, default="threads",
+                        help='Threads per client, or one selectors loop forwarding client pairs (default: threads)')
+    parser.add_argument('--fanout', dest="fanout", action='store_true',
+                        help='Take room broadcasts once per upstream link and deliver them to local clients')
+    parser.add_argument('--compress', dest="compress", action='store_true',
+                        help='Ask the server for zlib compression on the upstream links')
+    parser.add_argument('--trusted-relay', dest="trusted_relays", action="append", metavar="ADDRESS",
+                        help=f'IP address a downstream relay may link from, repeat for several '
+                             f'(default: {", ".join(TRUSTED_RELAYS)})')
     args = parser.parse_args()
     
-    relay = ChatRelay(args.relay_host, args.relay_port, args.server_host, args.server_port)
+    if args.server_path and not hasattr(socket, "AF_UNIX"):
+        parser.error("--server-socket needs Unix domain sockets, which this platform does not have")
+    if args.engine == "selectors":
+        if args.upstreams:
+            parser.error("the selectors engine gives every client its own server connection, --upstreams must be 0")
+        if args.fanout or args.compress:
+            parser.error("--fanout and --compress need the upstream links of the threads engine")
+        relay = SelectorChatRelay(args.relay_host, args.relay_port, args.server_host, args.server_port,
+                                  args.metrics_port, args.server_path)
+    else:
+        upstreams = UPSTREAMS if args.upstreams is None else args.upstreams
+        if (args.fanout or args.compress) and not upstreams:
+            parser.error("--fanout and --compress need upstream links, --upstreams must be at least 1")
+        relay = ChatRelay(args.relay_host, args.relay_port, args.server_host, args.server_port, args.metrics_port,
+                          upstreams, args.fanout, args.compress, args.server_path,
+                          args.trusted_relays or TRUSTED_RELAYS)
     relay.start()
 
 if __name__ == "__main__":
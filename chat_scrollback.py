@@ -0,0 +1,72 @@
+import tempfile
+import zlib
+from array import array
+
+# A chat window's full history, kept off the Tk text widget.
+#
+# The widget only holds the last few hundred lines, every line it ever showed goes
+# here as well: in blocks of BLOCK_LINES lines, zlib-compressed and appended to a
+# temporary file. Memory stays at one block of text plus a file offset per block,
+# however long the client runs, and scrolling up reads back one block at a time.
+
+# lines per compressed block
+BLOCK_LINES = 256
+
+class Scrollback:
+    """Append-only store of text lines, numbered from 0, readable by range"""
+
+    def __init__(self):
+        self.file = None
+        # file offset where block i starts, and where the next one will
+        self.offsets = array("Q")
+        self.end = 0
+        # lines of the block being filled
+        self.tail = []
+        self.count = 0
+        # the last block read back, scrolling reads the same one many times
+        self.cached = (None, None)
+
+    def extend(self, lines):
+        for line in lines:
+            self.tail.append(line)
+            if len(self.tail) == BLOCK_LINES:
+                self._write_block()
+        self.count += len(lines)
+
+    def _write_block(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+        data = zlib.compress("\n".join(self.tail).encode("utf-8"))
+        self.file.seek(self.end)
+        self.file.write(data)
+        self.offsets.append(self.end)
+        self.end += len(data)
+        self.tail = []
+
+    def lines(self, start, end):
+        """Lines start up to but not including end"""
+        start, end = max(start, 0), min(end, self.count)
+        result = []
+        while start < end:
+            block, skip = divmod(start, BLOCK_LINES)
+            lines = self._block(block)[skip:skip + end - start]
+            result.extend(lines)
+            start += len(lines)
+        return result
+
+    def _block(self, index):
+        if index == len(self.offsets):
+            return self.tail
+        if self.cached[0] == index:
+            return self.cached[1]
+        start = self.offsets[index]
+        stop = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.end
+        self.file.seek(start)
+        lines = zlib.decompress(self.file.read(stop - start)).decode("utf-8").split("\n")
+        self.cached = (index, lines)
+        return lines
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,263 +1,1774 @@
+import os
+import stat
 import socket
 import threading
+import asyncio
 import time
 import argparse
-import csv
 import random
 import string
 from datetime import datetime
+from chat_protocol import (SUPPORTED_CAPS, CAP_FRAMED, CAP_DELTAS, CAP_RESUME, CAP_MUX, CAP_FANOUT, CAP_COMPRESS, CAP_PING,
+                           RELAYED, TRUSTED_RELAYS,
+                           MUX_OPEN, MUX_DATA, MUX_CLOSE, MUX_JOIN, MUX_LEAVE, MUX_BROADCAST, ENCODING,
+                           FramedCodec, MuxCodec, Payload, parse_hello, format_caps, make_codec, is_link_hello,
+                           encode_mux, decode_mux)
+from chat_mux import MuxLink, MuxSession, LINK_BACKLOG_SCALE
+from chat_compress import Deflater, InflatingCodec, compression_ratio
+from chat_session import Session, RESUME_GRACE, RESUME_BUFFER
+from chat_outbox import (Outbox, QUEUE_SIZE, DROP_OLDEST, OVERFLOW_POLICIES, COALESCE_WINDOW, COALESCE_BYTES, MAX_BACKLOG,
+                         MAX_BACKLOG_AGE, SLOW_CONSUMER_DISCONNECTS)
+from chat_ratelimit import RateLimiter, RATE, BURST
+from chat_metrics import REGISTRY, start_metrics_server
+from chat_log import LogWriter, LogStore, LOG_FILE, BATCH_SIZE, FLUSH_INTERVAL, FSYNC_POLICIES, SEGMENT_SIZE, MAX_SEGMENTS
+from chat_shard import run_shards
+from chat_history import History, HISTORY_SIZE, HISTORY_REPLAY
 
 HOST = '127.0.0.1'
 PORT = 8888
 BUFSIZE = 4096
+# relay links carry the traffic of many clients
+LINK_BUFSIZE = 65536
+# buffers per vectored write, the usual IOV_MAX
+IOV_MAX = 1024
 
-# Rate limiting 
-MAX_MESSAGES = 5
-TIME_WINDOW = 3
-LOG_FILE = "chat_server_log.csv"
+
+# Rooms, everyone starts in the lobby
+LOBBY = "lobby"
+MAX_ROOM_NAME = 32
+
+# User list changes within this many seconds go out as one update
+DELTA_WINDOW = 0.05
+
+# Dead connections. Clients with the ping capability get "/ping" after HEARTBEAT_INTERVAL
+# seconds without a word from them and are disconnected after IDLE_TIMEOUT; the others
+# cannot be told from quiet users and are left to TCP keepalive, which probes a connection
+# idle for KEEPALIVE_IDLE seconds every KEEPALIVE_INTERVAL and gives up after KEEPALIVE_PROBES
+HEARTBEAT_INTERVAL = 30.0
+IDLE_TIMEOUT = 90.0
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_PROBES = 3
+# how often the heartbeats, idle timeouts and slow consumer limits are checked
+SWEEP_INTERVAL = 1.0
+# Metrics, served in the Prometheus text format with --metrics-port
+MESSAGES_IN = REGISTRY.counter("chat_messages_in_total", "Messages received from clients")
+MESSAGES_OUT = REGISTRY.counter("chat_messages_out_total", "Messages written to clients")
+BYTES_IN = REGISTRY.counter("chat_bytes_in_total", "Bytes received from clients")
+BYTES_OUT = REGISTRY.counter("chat_bytes_out_total", "Bytes written to clients")
+WRITES = REGISTRY.counter("chat_writes_total", "Writes to client connections, each carrying one or more messages")
+MESSAGES_PROCESSED = REGISTRY.counter("chat_messages_processed_total", "Public and private chat messages delivered")
+RATE_LIMITED = REGISTRY.counter("chat_rate_limited_total", "Messages rejected by the rate limiter")
+CONNECTS = REGISTRY.counter("chat_connects_total", "Clients that completed the nickname handshake")
+DISCONNECTS = REGISTRY.counter("chat_disconnects_total", "Registered clients that disconnected")
+RESUMES = REGISTRY.counter("chat_session_resumes_total", "Dropped sessions taken over by a reconnecting client")
+HEARTBEATS = REGISTRY.counter("chat_heartbeats_total", "Pings sent to quiet clients")
+PONGS = REGISTRY.counter("chat_pongs_total", "Pings answered")
+IDLE_DISCONNECTS = REGISTRY.counter("chat_idle_disconnects_total", "Clients disconnected for answering no ping")
+KEEPALIVE_TIMEOUTS = REGISTRY.counter("chat_keepalive_timeouts_total", "Connections whose TCP keepalive probes went unanswered")
+FANOUT_SECONDS = REGISTRY.histogram("chat_fanout_seconds", "Time from receiving a public message to queueing it for every recipient")
+
+# asyncio engine
+ENGINES = ("threads", "asyncio")
+ASYNC_BACKLOG = 1024
 
 class ChatServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, queue_size=QUEUE_SIZE, overflow=DROP_OLDEST, log_writer=None,
+                 delta_window=DELTA_WINDOW, rate_limiter=None, metrics_port=None, bus=None,
+                 history_size=HISTORY_SIZE, history_replay=HISTORY_REPLAY, resume_grace=RESUME_GRACE,
+                 resume_buffer=RESUME_BUFFER, coalesce_window=COALESCE_WINDOW, coalesce_bytes=COALESCE_BYTES,
+                 unix_path=None, heartbeat=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT, keepalive=KEEPALIVE_IDLE,
+                 max_backlog=MAX_BACKLOG, max_backlog_age=MAX_BACKLOG_AGE, trusted_relays=TRUSTED_RELAYS):
         """Initialize the chat server with the given host and port"""
         self.host = host
         self.port = port
+        # also listen on this Unix socket, for relays on the same host
+        self.unix_path = unix_path
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.log_writer = log_writer if log_writer else LogWriter(LOG_FILE)
+        self.delta_window = delta_window
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        self.metrics_port = metrics_port
+        # set when this server is one shard of several (chat_shard.ShardBus)
+        self.bus = bus
+        # bytes of recent messages kept per room, and how many a client gets when it enters
+        self.history_size = history_size
+        self.history_replay = history_replay
+        # how long a dropped resumable client keeps its session, and how much of its stream is kept
+        self.resume_grace = resume_grace
+        self.resume_buffer = resume_buffer
+        # how long a client's writer waits for more messages before writing, and how much it gathers at most
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = coalesce_bytes
+        # finding dead connections and slow consumers, 0 turns each off
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.max_backlog = max_backlog
+        self.max_backlog_age = max_backlog_age
+        self.trusted_relays = set(trusted_relays)
+        # token -> Session, for the clients that can resume
+        self.sessions = {}
+        # client_socket -> ClientState, everything kept about a client is in the one record
         self.clients = {}
+        # nickname -> ClientState, None while a registering client waits for its claim
         self.nicknames = {}
-        self.message_count = 0
-        self.rate_limits = {}
+        # room -> {client_socket: nickname}, so a room broadcast only touches its members
+        self.rooms = {LOBBY: {}}
+        # what a room broadcast is written to: room -> {client_socket: ClientState} for the members the
+        # server writes to itself, and room -> {link: members} for relay links that fan out
+        self.room_targets = {LOBBY: {}}
+        self.room_links = {}
+        # room -> {nickname: None} for the members on the other shards
+        self.remote_members = {}
+        # room -> History
+        self.histories = {}
+        # room -> {nickname: "+" or "-"} waiting for the delta window to close
+        self.pending_deltas = {}
+        # (second, "%H:%M:%S") of the last timestamp, one tuple so threads never see a torn pair
+        self._clock = (None, "")
         self.lock = threading.Lock()
 
     def start(self):
         """Start the chat server"""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.bus:
+            # the shards share the port, the kernel spreads new connections over them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         
         try:
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen(5)
-            print(f"[Server] Listening on {self.host}:{self.port}")
+            print(f"[Server] Listening on {self.host}:{self.port}" + (f" (shard {self.bus.shard})" if self.bus else ""))
+            
+            if self.unix_path:
+                unix_socket = listen_unix(self.unix_path)
+                print(f"[Server] Listening on {self.unix_path}")
+                accept_thread = threading.Thread(target=self.accept_loop, args=(unix_socket,), daemon=True)
+                accept_thread.start()
             
-            # monitoring thread
-            stats_thread = threading.Thread(target=self.print_stats, daemon=True)
-            stats_thread.start()
+            # monitoring thread and metrics endpoint
+            self.start_monitoring()
+            self.start_sweeping()
+            if self.bus:
+                self.bus.start(self)
             
             # log file
             self.init_log_file()
             
             # incoming connections
-            while True:
-                client_socket, address = self.server_socket.accept()
-                print(f"[Server] New connection from {address}")
-                
-                # Start a new thread to handle this client
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, address),
-                    daemon=True
-                )
-                client_thread.start()
+            self.accept_loop(self.server_socket)
                 
         except KeyboardInterrupt:
             print("[Server] Shutting down...")
         finally:
             self.server_socket.close()
+            if self.unix_path:
+                remove_unix_socket(self.unix_path)
+            self.close_log()
+    
+    def accept_loop(self, listener):
+        """Accept connections and start a thread for each"""
+        while True:
+            client_socket, address = listener.accept()
+            set_keepalive(client_socket, self.keepalive)
+            # empty for a Unix socket peer
+            address = address or unix_address(self.unix_path)
+            print(f"[Server] New connection from {address}")
+            
+            # Start a new thread to handle this client
+            client_thread = threading.Thread(
+                target=self.handle_client,
+                args=(client_socket, address),
+                daemon=True
+            )
+            client_thread.start()
     
     def init_log_file(self):
-        """Initialize the log file with headers"""
-        with open(LOG_FILE, 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(['Timestamp', 'Sender', 'Recipient', 'Message', 'Type'])
+        """Initialize the log file with headers and start the background log writer"""
+        self.log_writer.start()
     
     def log_message(self, sender, recipient, message, msg_type="public"):
         """Log messages to the CSV file"""
         """I got help from a LLM to write that definition called logging..."""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(LOG_FILE, 'a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([timestamp, sender, recipient, message, msg_type])
+        # only queues the record, the log writer thread does the file I/O in batches
+        self.log_writer.write(sender, recipient, message, msg_type)
+    
+    def close_log(self):
+        """Write out every queued log record before exiting"""
+        self.log_writer.close()
+    
+    def start_monitoring(self):
+        """Start the stats printing thread and, if configured, the metrics endpoint"""
+        stats_thread = threading.Thread(target=self.print_stats, daemon=True)
+        stats_thread.start()
+        
+        REGISTRY.gauge("chat_connections", "Connected clients", lambda: len(self.clients))
+        REGISTRY.gauge("chat_queued_messages", "Messages waiting in outbound queues",
+                       lambda: sum(depth for _, depth, _ in self.queue_stats()))
+        REGISTRY.gauge("chat_queue_depth_max", "Deepest outbound queue",
+                       lambda: max((depth for _, depth, _ in self.queue_stats()), default=0))
+        if self.metrics_port:
+            start_metrics_server(self.metrics_port)
+            print(f"[Server] Metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+    
+    def start_sweeping(self):
+        """Start the periodic sweep for dead connections and slow consumers, if any check is on"""
+        if self.heartbeat or self.idle_timeout or self.max_backlog or self.max_backlog_age:
+            self.call_later(SWEEP_INTERVAL, self.sweep)
+    
+    def sweep(self):
+        """Ping quiet clients, cut off the ones that answer nothing or read too slowly, and end the
+        connections of the clients cut off since the last sweep, every SWEEP_INTERVAL seconds"""
+        now = time.monotonic()
+        with self.lock:
+            states = list(self.clients.values())
+        links = set()
+        for state in states:
+            client = state.client
+            if isinstance(client, MuxSession):
+                links.add(client.link)
+            if isinstance(client, Session) and client.connection is None:
+                # waiting to be resumed, the grace period decides
+                continue
+            quiet = now - state.last_seen
+            # only a client that gets pinged has to send something, one that just listens is not idle
+            if state.heartbeats and self.heartbeat and self.idle_timeout and quiet > self.idle_timeout:
+                if state.outbox.cut(f"{state.nickname}, who answered nothing for {quiet:.0f} seconds"):
+                    IDLE_DISCONNECTS.inc()
+            elif (not state.outbox.expire(now) and state.heartbeats and self.heartbeat
+                  and now - max(state.last_seen, state.pinged) >= self.heartbeat):
+                state.pinged = now
+                if state.send("/ping"):
+                    HEARTBEATS.inc()
+            if state.outbox.cut_off:
+                # a writer blocked on a client that stopped reading would not notice the closed outbox
+                drop_connection(client)
+        for link in links:
+            if link.expire(now) or link.cut_off:
+                # its writer may be blocked on a relay that stopped reading, the reader then ends every session
+                drop_connection(link.connection)
+        self.call_later(SWEEP_INTERVAL, self.sweep)
     
     def print_stats(self):
         """Periodically print server statistics"""
         while True:
             time.sleep(10)  # Print stats every 10 seconds
-            with self.lock:
-                connected_clients = len(self.clients)
-                total_messages = self.message_count
+            connected_clients = len(self.clients)
+            total_messages = MESSAGES_PROCESSED.value()
             
             print(f"[Stats] Connected clients: {connected_clients}, Messages processed: {total_messages}")
+            
+            # outbound queues, only the busiest ones are worth printing
+            queues = self.queue_stats()
+            queued = sum(depth for _, depth, _ in queues)
+            dropped = sum(drops for _, _, drops in queues)
+            print(f"[Stats] Queued messages: {queued}, Dropped messages: {dropped}")
+            print(f"[Stats] Log records written: {self.log_writer.records_written} in {self.log_writer.batches_written} batches")
+            slow = sum(counter.value() for counter in SLOW_CONSUMER_DISCONNECTS.values())
+            print(f"[Stats] Heartbeats sent: {HEARTBEATS.value()}, Idle clients reaped: {IDLE_DISCONNECTS.value()}, "
+                  f"Slow clients cut off: {slow}, Keepalive timeouts: {KEEPALIVE_TIMEOUTS.value()}")
+            ratio = compression_ratio()
+            if ratio is not None:
+                print(f"[Stats] Compressed output to {ratio:.0%} of its size")
+            busiest = sorted((q for q in queues if q[1] or q[2]), key=lambda q: (q[1], q[2]), reverse=True)
+            for nickname, depth, drops in busiest[:5]:
+                print(f"[Stats]   {nickname}: queue depth {depth}, dropped {drops}")
+    
+    def timestamp(self):
+        """The time shown in messages, formatted only once per second"""
+        now = int(time.time())
+        second, text = self._clock
+        if now != second:
+            text = datetime.fromtimestamp(now).strftime('%H:%M:%S')
+            self._clock = (now, text)
+        return text
+    
+    def queue_stats(self):
+        """Return (nickname, queue depth, dropped messages) for every connection"""
+        with self.lock:
+            return [(state.nickname, state.outbox.depth, state.outbox.dropped) for state in self.clients.values()]
     
     def handle_client(self, client_socket, address):
         """Handle communication with a client"""
-        #client's nickname
+        client = client_socket
+        exited = False
         try:
-            nickname_data = client_socket.recv(BUFSIZE).decode('utf-8')
-            requested_nickname = nickname_data.strip()
-            
-            # we should '*' (reserve this for relay)
-            if '*' in requested_nickname:
-                client_socket.send("Nickname cannot contain '*'. Please try again.".encode('utf-8'))
-                client_socket.close()
-                return
-            
-            # unique nickname
-            with self.lock:
-                if requested_nickname in self.nicknames:
-                    # Generate a random nickname
-                    random_suffix = ''.join(random.choices(string.digits, k=3))
-                    assigned_nickname = f"User{random_suffix}"
-                    client_socket.send(f"Nickname '{requested_nickname}' is taken. You've been assigned '{assigned_nickname}'".encode('utf-8'))
-                    nickname = assigned_nickname
+            #client's nickname
+            nickname_data = client_socket.recv(BUFSIZE)
+            if is_link_hello(nickname_data):
+                if self.trusts_relay(address):
+                    self.handle_link(client_socket, address, nickname_data)
                 else:
-                    client_socket.send(f"Welcome, {requested_nickname}!".encode('utf-8'))
-                    nickname = requested_nickname
-                
-                self.clients[client_socket] = nickname
-                self.nicknames[nickname] = client_socket
-                
-                # rate limiting for this client
-                self.rate_limits[client_socket] = {"count": 0, "timestamp": time.time()}
-            
-            # Broadcast that a new client has joined
-            join_message = f"[{datetime.now().strftime('%H:%M:%S')}] {nickname} has joined the chat!"
-            self.broadcast(join_message, None)
-            
-            # Update clients
-            self.send_user_list()
+                    print(f"[Server] Refused a relay link from {address}, not a trusted relay")
+                return
+            session = self.resume_session(client_socket, nickname_data)
+            if session is not None:
+                client, nickname, codec = session, session.nickname, reading_codec(FramedCodec(), session.caps)
+            else:
+                client = self.open_session(client_socket, nickname_data)
+                nickname, codec = self.register_client(client, nickname_data, address)
+                if nickname is None:
+                    return
             
             while True:
-                message_data = client_socket.recv(BUFSIZE).decode('utf-8')
+                data = client_socket.recv(BUFSIZE)
                 
-                if not message_data:
+                if not data:
                     break
                 
-                if message_data.startswith("/private"):
-                    # Handle private message: /private nickname message
-                    parts = message_data[9:].split(" ", 1)
-                    if len(parts) == 2:
-                        target_nick, private_msg = parts
-                        self.private_message(nickname, target_nick, private_msg)
-                elif message_data == "/exit":
-                    # Handle client exit
+                if not self.process_data(client, nickname, codec, data):
+                    exited = True
                     break
-                else:
-                    # rate limiting
-                    if self.check_rate_limit(client_socket):
-                        # Public message
-                        timestamp = datetime.now().strftime('%H:%M:%S')
-                        formatted_message = f"[{timestamp}] {nickname}: {message_data}"
-                        self.broadcast(formatted_message, client_socket)
-                        
-                        # Log the message
-                        self.log_message(nickname, "ALL", message_data)
-                        
-                        # Update message count
-                        with self.lock:
-                            self.message_count += 1
-                    else:
-                        # Rate limit exceeded
-                        warning = f"You're sending messages too quickly. Please slow down."
-                        client_socket.send(warning.encode('utf-8'))
                         
+        except TimeoutError:
+            # the keepalive probes went unanswered
+            KEEPALIVE_TIMEOUTS.inc()
+            print(f"[Server] Connection from {address} timed out")
         except Exception as e:
             print(f"[Error] {e}")
         finally:
-            # Client disconnected, clean up
-            with self.lock:
-                if client_socket in self.clients:
-                    left_nickname = self.clients[client_socket]
-                    del self.nicknames[left_nickname]
-                    del self.clients[client_socket]
-                    del self.rate_limits[client_socket]
-                    
-                    # Broadcast that the client has left
-                    # I got help a LLM to write that exit message again..
-                    leave_message = f"[{datetime.now().strftime('%H:%M:%S')}] {left_nickname} has left the chat!"
-                    self.broadcast(leave_message, None)
-                    
-                    self.send_user_list()
-            
+            # Client disconnected, clean up. The shutdown also stops the writer thread
+            # if it is stuck sending to a client that stopped reading
+            if isinstance(client, Session) and not exited:
+                # it may come back
+                self.detach_session(client, client_socket)
+            else:
+                self.remove_client(client)
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             client_socket.close()
     
-    def check_rate_limit(self, client_socket):
-        """Check if a client is sending messages too quickly"""
+    def start_writer(self, client_socket, outbox, deflater=None):
+        """Start the thread that drains a client's outbox, deflater compresses what it writes"""
+        writer_thread = threading.Thread(
+            target=self.write_loop,
+            args=(client_socket, outbox, deflater),
+            daemon=True
+        )
+        writer_thread.start()
+    
+    def write_loop(self, client_socket, outbox, deflater=None):
+        """Write queued messages to a client until its outbox is closed"""
+        try:
+            while True:
+                batch = outbox.take(self.coalesce_window, self.coalesce_bytes)
+                if not batch:
+                    break
+                if deflater is not None:
+                    data = deflater.compress(b"".join(batch))
+                    client_socket.sendall(data)
+                    BYTES_OUT.inc(len(data))
+                else:
+                    send_buffers(client_socket, batch)
+                    BYTES_OUT.inc(sum(len(data) for data in batch))
+                WRITES.inc()
+                MESSAGES_OUT.inc(len(batch))
+        except OSError:
+            pass
+        finally:
+            outbox.close()
+            if outbox.cut_off:
+                print(f"[Server] Disconnecting {outbox.cut_off}")
+            # wakes up the reader thread if it is still waiting in recv, it closes the socket
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    
+    def start_session_writer(self, session, outbox):
+        """Start the thread that drains a resumable client's outbox"""
+        writer_thread = threading.Thread(
+            target=self.session_write_loop,
+            args=(session, outbox),
+            daemon=True
+        )
+        writer_thread.start()
+    
+    def session_write_loop(self, session, outbox):
+        """Write a resumable client's messages to whichever connection it has until its outbox is closed"""
+        try:
+            while True:
+                batch = outbox.take(self.coalesce_window, self.coalesce_bytes)
+                if not batch:
+                    break
+                session.record(b"".join(batch))
+                connection, data = session.unwritten()
+                if data is None:
+                    # missed more than the buffer holds, the client has to start over
+                    shutdown_connection(connection)
+                elif data:
+                    try:
+                        connection.sendall(data)
+                        WRITES.inc()
+                        MESSAGES_OUT.inc(len(batch))
+                        BYTES_OUT.inc(len(data))
+                    except OSError:
+                        # the reader detaches the session, a resume sends the rest
+                        pass
+        finally:
+            outbox.close()
+            if outbox.cut_off:
+                print(f"[Server] Disconnecting {outbox.cut_off}")
+            shutdown_connection(session.connection)
+    
+    def open_session(self, connection, hello):
+        """A Session for clients that ask to be resumable, the connection itself for everyone else"""
+        if not self.resume_grace or not hello:
+            return connection
+        _, caps = parse_hello(hello)
+        # the stream offsets count frames
+        if CAP_RESUME in caps and CAP_FRAMED in caps:
+            return Session(connection, self.resume_buffer)
+        return connection
+    
+    def resume_session(self, connection, hello):
+        """Give a reconnecting client its session back, None if the hello does not resume one"""
+        if not self.resume_grace or not hello:
+            return None
+        _, caps = parse_hello(hello)
+        token, _, offset = caps.get(CAP_RESUME, "").partition(":")
+        if not offset.isdigit():
+            return None
+        
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            previous = session.connection
+            granted = dict.fromkeys(session.caps, "")
+            granted[CAP_RESUME] = offset
+            greeting = FramedCodec().encode(f"/caps {format_caps(granted)}")
+            # the new connection's stream is compressed from scratch
+            deflater = Deflater() if CAP_COMPRESS in session.caps else None
+            resumed = session.attach(connection, int(offset), greeting, deflater)
+            if not resumed:
+                # the client missed more than was kept, it gets a new session
+                del self.sessions[token]
+        if not resumed:
+            self.remove_client(session)
+            return None
+        
+        RESUMES.inc()
+        print(f"[Server] {session.nickname} resumed its session from offset {offset}")
+        # the old connection may not have noticed it is dead yet, its reader ends on the shutdown
+        shutdown_connection(previous)
+        # wakes up the writer, it sends the greeting and what the client missed
+        state = self.clients.get(session)
+        if state is not None:
+            state.last_seen = time.monotonic()
+            state.outbox.put(b"")
+        return session
+    
+    def detach_session(self, session, connection):
+        """A resumable client's connection dropped, keep the session for the grace period"""
+        generation = session.detach(connection)
+        if generation is None:
+            # already resumed on another connection
+            return
+        state = self.clients.get(session)
+        if session.token not in self.sessions or state is None or state.outbox.closed:
+            # never registered, or ended by the server
+            self.remove_client(session)
+            return
+        self.call_later(self.resume_grace, self.expire_session, session, generation)
+    
+    def expire_session(self, session, generation):
+        """The grace period is over and the client did not come back"""
         with self.lock:
-            current_time = time.time()
-            client_stats = self.rate_limits[client_socket]
+            if session.generation != generation or self.sessions.get(session.token) is not session:
+                return
+            del self.sessions[session.token]
+        self.remove_client(session)
+    
+    def register_client(self, client_socket, nickname_data, address=None):
+        """Run the nickname handshake, returns (nickname, codec) and nickname is None if refused.
+        The codec is the one to read the client with, it inflates if the client compresses"""
+        hello, codec = self.negotiate(client_socket, nickname_data, address)
+        if hello is None:
+            return None, codec
+        nickname, reply = self.choose_nickname(hello.nickname, hello.prefix)
+        return self.admit_client(client_socket, hello, nickname, reply, address)
+    
+    def negotiate(self, client_socket, nickname_data, address=None):
+        """First half of the handshake, up to the nickname claim. Returns (Hello, None), or
+        (None, codec) for a client that was refused"""
+        if not nickname_data:
+            # closed before saying anything
+            return None, make_codec(())
+        requested_nickname, caps = parse_hello(nickname_data)
+        requested_nickname = requested_nickname.strip()
+        
+        # sessions of a relay link are relayed by definition, the relay flags the other connections
+        # and the flag counts only from a trusted relay
+        muxed = isinstance(client_socket, MuxSession)
+        relayed = muxed or (caps.pop(RELAYED, None) is not None and self.trusts_relay(address))
+        
+        # negotiate the wire format, clients that send a bare nickname keep the old unframed one
+        granted = [cap for cap in caps if cap in SUPPORTED_CAPS]
+        if isinstance(client_socket, Session):
+            granted.append(CAP_RESUME)
+        # sessions on a relay link are compressed with the link if at all
+        deflater = None
+        if CAP_COMPRESS in caps and CAP_FRAMED in granted and not muxed:
+            granted.append(CAP_COMPRESS)
+            deflater = Deflater()
+        codec = MuxCodec(client_socket.session_id, CAP_FRAMED in granted) if muxed else make_codec(granted)
+        replies = [f"/caps {format_caps(granted)}"] if caps else []
+        
+        # we should '*' (reserve this for relay)
+        prefix = '*' if relayed and requested_nickname.startswith('*') else ''
+        # '#' and ',' would make "/users #room a,b" and the lobby's "/users a,b" ambiguous
+        refused = [char for char in "*#," if char in requested_nickname[len(prefix):]]
+        if refused:
+            replies.append(f"Nickname cannot contain '{refused[0]}'. Please try again.")
+            if deflater is not None:
+                # "/caps" goes out as is, the stream it announces after it
+                client_socket.send(codec.encode(replies[0]) + deflater.compress(codec.encode_many(replies[1:])))
+            else:
+                client_socket.send(codec.encode_many(replies))
+            return None, reading_codec(codec, granted)
+        return Hello(requested_nickname, prefix, granted, codec, deflater, replies), None
+    
+    def trusts_relay(self, address):
+        """True if address may be a relay, for a link or a relayed hello"""
+        if address is None:
+            return False
+        return address[0] in self.trusted_relays or str(address[0]).startswith("unix:")
+    
+    def choose_nickname(self, requested_nickname, prefix):
+        """Claim the requested nickname or a random one, returns (nickname, welcome)"""
+        if self.claim_nickname(requested_nickname):
+            return requested_nickname, f"Welcome, {requested_nickname}!"
+        for assigned_nickname in random_nicknames(prefix):
+            if self.claim_nickname(assigned_nickname):
+                return assigned_nickname, assigned_message(requested_nickname, assigned_nickname)
+    
+    def admit_client(self, client_socket, hello, nickname, reply, address):
+        """Second half of the handshake, the client gets its claimed nickname and joins the lobby"""
+        codec, granted, deflater, replies = hello.codec, hello.granted, hello.deflater, hello.replies
+        replies.append(reply)
+        muxed = isinstance(client_socket, MuxSession)
+        resumable = isinstance(client_socket, Session)
+        if resumable:
+            # the stream a resume continues starts after "/caps", with the token
+            client_socket.nickname = nickname
+            client_socket.caps = granted
+            client_socket.greeting = codec.encode(replies.pop(0))
+            client_socket.deflater = deflater
+            replies.insert(0, f"/session {client_socket.token}")
+        elif deflater is not None:
+            # ahead of the writer, which compresses everything after "/caps"
+            client_socket.send(codec.encode(replies.pop(0)))
+        
+        with self.lock:
+            outbox = Outbox(self.queue_size, self.overflow, self.max_backlog, self.max_backlog_age)
+            outbox.put(codec.encode_many(replies))
+            if resumable:
+                self.sessions[client_socket.token] = client_socket
             
-            # Reset counter if time window has passed
-            if current_time - client_stats["timestamp"] > TIME_WINDOW:
-                client_stats["count"] = 1
-                client_stats["timestamp"] = current_time
-                return True
+            # rate limiting for this client
+            ip = address[0] if address else None
+            state = ClientState(client_socket, nickname, codec, outbox, self.rate_limiter.new_bucket(),
+                                ip, self.rate_limiter.acquire_ip(ip), CAP_DELTAS in granted, CAP_PING in granted)
+            self.clients[client_socket] = state
+            self.nicknames[nickname] = state
+            
+            self.subscribe(state, LOBBY)
+            state.current_room = LOBBY
+            history = self.replay_history(state, LOBBY, self.history_replay)
+            if history:
+                outbox.put(history)
+        if muxed:
+            # the link's writer drains the session's outbox
+            client_socket.attach(outbox)
+        elif resumable:
+            self.start_session_writer(client_socket, outbox)
+        else:
+            self.start_writer(client_socket, outbox, deflater)
+        CONNECTS.inc()
+        
+        # Broadcast that a new client has joined
+        join_message = f"[{self.timestamp()}] {nickname} has joined the chat!"
+        self.broadcast(join_message, None, LOBBY)
+        
+        # Update clients
+        self.send_user_snapshot(state, LOBBY)
+        self.user_list_changed(LOBBY, nickname, True)
+        return nickname, reading_codec(codec, granted)
+    
+    def claim_nickname(self, nickname):
+        """Reserve a nickname for a client that is registering, False if someone else has it"""
+        if not self.reserve_nickname(nickname):
+            return False
+        # the other shards' clients count too, the hub decides
+        if self.bus and not self.bus.claim(nickname):
+            self.unreserve_nickname(nickname)
+            return False
+        return True
+    
+    def reserve_nickname(self, nickname):
+        """The local half of a claim, False if a client here has the nickname or is registering with it"""
+        with self.lock:
+            if nickname in self.nicknames:
+                return False
+            # held until admit_client puts the client in
+            self.nicknames[nickname] = None
+        return True
+    
+    def unreserve_nickname(self, nickname):
+        with self.lock:
+            del self.nicknames[nickname]
+    
+    def handle_link(self, link_socket, address, hello):
+        """Serve a relay's multiplexed link, every session on it is a client of its own"""
+        link = self.open_link(hello, address)
+        link.connection = link_socket
+        link_socket.sendall(link_caps(link))
+        writer_thread = threading.Thread(
+            target=self.link_write_loop,
+            args=(link_socket, link),
+            daemon=True
+        )
+        writer_thread.start()
+        
+        codec = reading_codec(FramedCodec(), link_caps_granted(link))
+        try:
+            while True:
+                data = link_socket.recv(LINK_BUFSIZE)
+                if not data:
+                    break
+                received = time.perf_counter()
+                BYTES_IN.inc(len(data))
+                for payload in codec.decode_payloads(data):
+                    self.process_link_frame(link, payload, address, received)
+        finally:
+            self.close_link(link)
+    
+    def link_write_loop(self, link_socket, link):
+        """Write the queued messages of every session on a link until the link is closed"""
+        try:
+            while True:
+                items = link.take()
+                if not items:
+                    break
+                frames, ended = link.collect(items)
+                if frames:
+                    data = b"".join(frames)
+                    if link.deflater is not None:
+                        data = link.deflater.compress(data)
+                    link_socket.sendall(data)
+                    MESSAGES_OUT.inc(len(frames))
+                    BYTES_OUT.inc(len(data))
+                for session in ended:
+                    self.end_session(session)
+        except OSError:
+            pass
+        finally:
+            link.close()
+            if link.cut_off:
+                print(f"[Server] Disconnecting {link.cut_off}")
+            try:
+                link_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    
+    def open_link(self, hello, address):
+        name, caps = parse_hello(hello)
+        fanout = CAP_FANOUT in caps
+        compress = CAP_COMPRESS in caps
+        print(f"[Server] Relay link '{name}' from {address}" + (" (fan-out)" if fanout else "")
+              + (" (compressed)" if compress else ""))
+        return MuxLink(name, fanout, Deflater() if compress else None,
+                       self.max_backlog * LINK_BACKLOG_SCALE, self.max_backlog_age)
+    
+    def process_link_frame(self, link, payload, address, received=None):
+        """Handle one frame from a relay link"""
+        session_id, kind, body = decode_mux(payload)
+        if kind == MUX_OPEN:
+            ip, _, hello = body.partition(b"\n")
+            session = link.sessions[session_id] = MuxSession(link, session_id)
+            # rate limits per IP apply to the client's address, not the relay's
+            address = (ip.decode(ENCODING) or address[0], None)
+            if self.bus:
+                # claiming the nickname is a round trip to the hub, the other sessions on the link go on meanwhile
+                session.pending = []
+                self.start_link_registration(session, hello, address)
             else:
-                client_stats["count"] += 1
-                
-                # Check if rate limit is exceeded
-                if client_stats["count"] > MAX_MESSAGES:
-                    return False
-                return True
+                self.register_link_session(session, hello, address)
+            return
+        
+        session = link.sessions.get(session_id)
+        if session is not None and session.pending is not None:
+            with self.lock:
+                if session.pending is not None:
+                    session.pending.append((payload, received))
+                    return
+        if session is None or session.nickname is None:
+            # already gone, frames can cross a close
+            return
+        if kind == MUX_DATA:
+            MESSAGES_IN.inc()
+            self.touch(session)
+            if not self.process_message(session, session.nickname, body.decode(ENCODING), received):
+                self.end_session(session)
+        elif kind == MUX_CLOSE:
+            self.end_session(session)
+    
+    def register_link_session(self, session, hello, address):
+        nickname, _ = self.register_client(session, hello, address)
+        self.link_session_registered(session, nickname)
+    
+    def start_link_registration(self, session, hello, address):
+        """Register a session of a relay link on a thread of its own, it waits for the hub"""
+        registration_thread = threading.Thread(
+            target=self.register_link_session,
+            args=(session, hello, address),
+            daemon=True
+        )
+        registration_thread.start()
     
-    def broadcast(self, message, sender_socket):
-        """Send a message to all connected clients except the sender"""
+    def link_session_registered(self, session, nickname):
+        """Let a session that registered take part, or forget it if it was refused"""
+        link = session.link
+        if nickname is None:
+            link.sessions.pop(session.session_id, None)
+            session.pending = None
+            return
+        session.nickname = nickname
+        if link.closed:
+            # the link went away while the session was registering
+            self.end_session(session)
+            return
+        # the frames that came in meanwhile, in order, before the link's reader hands over new ones
+        while True:
+            with self.lock:
+                frames = session.pending
+                session.pending = [] if frames else None
+            if not frames:
+                break
+            for payload, received in frames:
+                self.process_link_frame(link, payload, None, received)
+    
+    def end_session(self, session):
+        """Forget a session of a relay link, its close frame goes out with the outbox"""
+        session.link.sessions.pop(session.session_id, None)
+        self.remove_client(session)
+    
+    def close_link(self, link):
+        """A relay link went away, and every client on it with it"""
+        # closed first, a session still registering sees it and ends itself
+        link.close()
+        for session in list(link.sessions.values()):
+            self.end_session(session)
+        print(f"[Server] Relay link '{link.name}' closed")
+    
+    def touch(self, client_socket):
+        """Note that a client was heard from, only quiet clients get pinged"""
+        state = self.clients.get(client_socket)
+        if state is not None:
+            state.last_seen = time.monotonic()
+    
+    def process_data(self, client_socket, nickname, codec, data):
+        """Handle everything that arrived in one recv, returns False when the client wants to leave"""
+        received = time.perf_counter()
+        BYTES_IN.inc(len(data))
+        self.touch(client_socket)
+        for message_data in codec.decode(data):
+            MESSAGES_IN.inc()
+            if not self.process_message(client_socket, nickname, message_data, received):
+                return False
+        return True
+    
+    def process_message(self, client_socket, nickname, message_data, received=None):
+        """Handle one message from a client, returns False when the client wants to leave"""
+        if message_data.startswith("/private"):
+            # Handle private message: /private nickname message
+            parts = message_data[9:].split(" ", 1)
+            if len(parts) == 2:
+                target_nick, private_msg = parts
+                self.private_message(nickname, target_nick, private_msg)
+        elif message_data == "/exit":
+            # Handle client exit
+            return False
+        elif message_data == "/pong":
+            # the reader already noted that the client is alive
+            PONGS.inc()
+        elif message_data.startswith("/join "):
+            self.join_room(client_socket, nickname, message_data[6:])
+        elif message_data.startswith("/leave "):
+            self.leave_room(client_socket, nickname, message_data[7:])
+        elif message_data.startswith("/room "):
+            # Handle room message: /room name message
+            parts = message_data[6:].split(" ", 1)
+            if len(parts) == 2:
+                room, room_msg = parts
+                self.public_message(client_socket, nickname, room_msg, room.lstrip("#"), received)
+        elif message_data == "/rooms":
+            self.send_room_list(client_socket)
+        elif message_data == "/history" or message_data.startswith("/history "):
+            # Handle history paging: /history [count]
+            count = message_data[9:].strip()
+            self.send_history(client_socket, int(count) if count.isdigit() else self.history_replay)
+        else:
+            self.public_message(client_socket, nickname, message_data, received=received)
+        return True
+    
+    def public_message(self, client_socket, nickname, message, room=None, received=None):
+        """Send a message to a room, the client's current room if none is given"""
         with self.lock:
-            for client in self.clients:
-                # Don't send the message back to the sender
-                if client != sender_socket:
-                    try:
-                        client.send(message.encode('utf-8'))
-                    except:
-                        # If there's an issue with the client socket, we'll handle it in the client thread
-                        pass
+            state = self.clients.get(client_socket)
+            if state is None:
+                # already gone, frames can cross a close
+                return
+            if room is None:
+                room = state.current_room
+            joined = room in state.rooms
+        if not joined:
+            state.send(f"You are not in room '{room}'. Use /join to enter a room." if room else
+                       "You are not in any room. Use /join to enter a room.")
+            return
+        
+        # rate limiting
+        wait = self.check_rate_limit(state)
+        if not wait:
+            # Public message
+            timestamp = self.timestamp()
+            formatted_message = f"[{timestamp}] {room_label(room)}{nickname}: {message}"
+            self.broadcast(formatted_message, client_socket, room, keep=True)
+            if received is not None:
+                FANOUT_SECONDS.observe(time.perf_counter() - received)
+            
+            # Log the message
+            self.log_message(nickname, "ALL" if room == LOBBY else f"#{room}", message)
+            
+            # Update message count
+            MESSAGES_PROCESSED.inc()
+        else:
+            # Rate limit exceeded, tell the client when it may send again
+            RATE_LIMITED.inc()
+            warning = f"You're sending messages too quickly. Please slow down. You can send again in {wait:.1f} seconds."
+            state.send(warning)
+            if state.codec.framed:
+                # machine readable for clients that speak the framed protocol
+                state.send(f"/retry-after {wait:.2f}")
+    
+    def join_room(self, client_socket, nickname, room):
+        """Subscribe a client to a room (creating it) and make it the client's current room"""
+        room = room.strip().lstrip("#")
+        if not valid_room_name(room):
+            self.send_to(client_socket, f"Invalid room name '{room}'.")
+            return
+        
+        with self.lock:
+            state = self.clients.get(client_socket)
+            if state is None:
+                return
+            already_joined = room in state.rooms
+            if not already_joined:
+                self.subscribe(state, room)
+                history = self.replay_history(state, room, self.history_replay)
+            state.current_room = room
+        
+        state.send(f"You are now talking in #{room}.")
+        if not already_joined:
+            if history:
+                state.outbox.put(history)
+            join_message = f"[{self.timestamp()}] {room_label(room)}{nickname} has joined the room!"
+            self.broadcast(join_message, None, room)
+            self.send_user_snapshot(state, room)
+            self.user_list_changed(room, nickname, True)
+    
+    def leave_room(self, client_socket, nickname, room):
+        """Unsubscribe a client from a room"""
+        room = room.strip().lstrip("#")
+        with self.lock:
+            state = self.clients.get(client_socket)
+            joined = state is not None and room in state.rooms
+            if joined:
+                self.unsubscribe(state, room)
+                current = state.current_room
+        if not joined:
+            self.send_to(client_socket, f"You are not in room '{room}'.")
+            return
+        
+        self.send_to(client_socket, f"You left #{room}." + (f" You are now talking in #{current}." if current else ""))
+        leave_message = f"[{self.timestamp()}] {room_label(room)}{nickname} has left the room!"
+        self.broadcast(leave_message, None, room)
+        self.user_list_changed(room, nickname, False)
+    
+    def subscribe(self, state, room):
+        """Add a client to a room's index, self.lock must be held"""
+        client_socket = state.client
+        self.rooms.setdefault(room, {})[client_socket] = state.nickname
+        # the history cursor is set by the replay that follows
+        state.rooms[room] = None
+        if self.bus:
+            self.bus.member_changed(room, state.nickname, True)
+        if isinstance(client_socket, MuxSession) and client_socket.link.fanout:
+            # the relay delivers the room's broadcasts to this session, it has to know it is a member
+            link = client_socket.link
+            links = self.room_links.setdefault(room, {})
+            links[link] = links.get(link, 0) + 1
+            link.schedule(encode_mux(client_socket.session_id, MUX_JOIN, room.encode(ENCODING)))
+        else:
+            self.room_targets.setdefault(room, {})[client_socket] = state
+    
+    def unsubscribe(self, state, room):
+        """Remove a client from a room's index, self.lock must be held"""
+        client_socket = state.client
+        members = self.rooms.get(room)
+        nickname = members.pop(client_socket, None) if members is not None else None
+        if nickname is not None:
+            if self.bus:
+                self.bus.member_changed(room, nickname, False)
+            if isinstance(client_socket, MuxSession) and client_socket.link.fanout:
+                link = client_socket.link
+                links = self.room_links[room]
+                links[link] -= 1
+                if not links[link]:
+                    del links[link]
+                    if not links:
+                        del self.room_links[room]
+                link.schedule(encode_mux(client_socket.session_id, MUX_LEAVE, room.encode(ENCODING)))
+            else:
+                self.room_targets[room].pop(client_socket, None)
+            # empty rooms go away, the lobby always exists
+            if not members and room != LOBBY:
+                del self.rooms[room]
+                self.room_targets.pop(room, None)
+                if room not in self.remote_members:
+                    self.histories.pop(room, None)
+        state.rooms.pop(room, None)
+        if state.current_room == room:
+            # fall back to the lobby, or any other room the client is still in
+            state.current_room = LOBBY if LOBBY in state.rooms else next(iter(state.rooms), None)
+    
+    def send_room_list(self, client_socket):
+        """Tell a client which rooms exist and how many people are in each"""
+        with self.lock:
+            counts = {room: len(members) for room, members in self.rooms.items()}
+            for room, members in self.remote_members.items():
+                counts[room] = counts.get(room, 0) + len(members)
+        rooms = ", ".join(f"#{room} ({count})" for room, count in counts.items())
+        self.send_to(client_socket, f"Rooms: {rooms}")
+    
+    def remote_member_changed(self, room, nickname, joined):
+        """A client on another shard joined or left a room"""
+        with self.lock:
+            members = self.remote_members.setdefault(room, {})
+            if joined:
+                members[nickname] = None
+            else:
+                members.pop(nickname, None)
+                if not members:
+                    del self.remote_members[room]
+                    if room not in self.rooms:
+                        self.histories.pop(room, None)
+        self.user_list_changed(room, nickname, joined)
+    
+    def replay_history(self, state, room, count):
+        """Up to count of a room's messages before the oldest the client has seen, encoded for it
+        in one piece, self.lock must be held"""
+        history = self.histories.get(room)
+        if history is None:
+            state.rooms[room] = 0
+            return b""
+        cursor = state.rooms[room]
+        frames, state.rooms[room] = history.before(history.end if cursor is None else cursor, count)
+        return state.codec.encode_frames(frames) if frames else b""
+    
+    def send_history(self, client_socket, count):
+        """Page further back through the history of the client's current room"""
+        with self.lock:
+            state = self.clients.get(client_socket)
+            if state is None:
+                return
+            room = state.current_room
+            history = self.replay_history(state, room, count) if room else b""
+        if history:
+            # one outbox entry and one write, however many messages it holds
+            state.outbox.put(history)
+        else:
+            state.send(f"No earlier messages in #{room}." if room else "You are not in any room.")
+    
+    def remove_client(self, client_socket):
+        """Forget a disconnected client and tell everyone else, returns False if it never registered"""
+        with self.lock:
+            state = self.clients.pop(client_socket, None)
+            if state is None:
+                return False
+            left_nickname = state.nickname
+            del self.nicknames[left_nickname]
+            left_rooms = sorted(state.rooms)
+            for room in left_rooms:
+                self.unsubscribe(state, room)
+            if isinstance(client_socket, Session) and self.sessions.get(client_socket.token) is client_socket:
+                del self.sessions[client_socket.token]
+        state.outbox.close()
+        if self.bus:
+            self.bus.release(left_nickname)
+        self.rate_limiter.release_ip(state.ip)
+        DISCONNECTS.inc()
+        
+        # Broadcast that the client has left, in every room it was in
+        # I got help a LLM to write that exit message again..
+        timestamp = self.timestamp()
+        for room in left_rooms:
+            leave_message = f"[{timestamp}] {room_label(room)}{left_nickname} has left the chat!"
+            self.broadcast(leave_message, None, room)
+            self.user_list_changed(room, left_nickname, False)
+        return True
+    
+    def check_rate_limit(self, state):
+        """Check if a client is sending messages too quickly, returns 0 or the seconds it has to wait"""
+        # the connection's bucket is only used by its own reader, so self.lock is not needed
+        return self.rate_limiter.check(state.bucket, state.ip_bucket)
+    
+    def broadcast(self, message, sender_socket, room=LOBBY, keep=False):
+        """Queue a message for every member of a room except the sender, keep puts it in the room's history"""
+        self.broadcast_local(message, sender_socket, room, keep)
+        if self.bus and (keep or room in self.remote_members):
+            # the other shards deliver it to their members of the room, and keep their history complete
+            self.bus.broadcast(room, message, keep)
+    
+    def broadcast_local(self, message, sender_socket, room=LOBBY, keep=False):
+        """Queue a message for this server's members of a room except the sender"""
+        # encoded once, every member with the same wire format gets the same bytes
+        payload = Payload(message)
+        with self.lock:
+            if keep and self.history_size and (room in self.rooms or room in self.remote_members):
+                history = self.histories.get(room)
+                if history is None:
+                    history = self.histories[room] = History(self.history_size)
+                history.append(payload.frame)
+            # Don't send the message back to the sender
+            targets = [state for client, state in self.room_targets.get(room, {}).items() if client != sender_socket]
+            links = list(self.room_links.get(room, ()))
+        
+        # only enqueues, the writers do the actual sending outside the lock
+        for state in targets:
+            state.outbox.put(state.codec.encode_payload(payload))
+        
+        # a fan-out relay gets the message once and delivers it to its members of the room
+        if links:
+            body = room.encode(ENCODING) + b"\n" + payload.data
+            sender_link = sender_socket.link if isinstance(sender_socket, MuxSession) else None
+            for link in links:
+                excluded = sender_socket.session_id if link is sender_link else 0
+                link.schedule(encode_mux(excluded, MUX_BROADCAST, body))
+    
+    def send_to(self, client_socket, message):
+        """Queue a message for one client, encoded with its negotiated codec"""
+        state = self.clients.get(client_socket)
+        if state is None:
+            # the client has already left
+            return False
+        return state.send(message)
     
     def private_message(self, sender, recipient, message):
         """Send a private message to a specific client"""
+        delivered = self.deliver_private(sender, recipient, message)
+        if not delivered and self.bus:
+            # the recipient may be on another shard, the hub answers with private_sent
+            self.bus.private(sender, recipient, message)
+            return
+        self.private_sent(sender, recipient, message, delivered)
+    
+    def deliver_private(self, sender, recipient, message):
+        """Queue a private message for a client of this server, False if there is no such client"""
+        with self.lock:
+            target = self.nicknames.get(recipient)
+            if target is None:
+                return False
+            timestamp = self.timestamp()
+            formatted_message = f"[{timestamp}] [Private] {sender}: {message}"
+            target.send(formatted_message)
+        return True
+    
+    def private_sent(self, sender, recipient, message, delivered):
+        """Confirm a private message to its sender, or tell them the recipient is not online"""
         with self.lock:
-            if recipient in self.nicknames:
-                target_socket = self.nicknames[recipient]
-                timestamp = datetime.now().strftime('%H:%M:%S')
-                formatted_message = f"[{timestamp}] [Private] {sender}: {message}"
+            sender_state = self.nicknames.get(sender)
+            if delivered:
+                # confirmation
+                timestamp = self.timestamp()
+                reply = f"[{timestamp}] [Private to {recipient}]: {message}"
+                
+                # Log the private message
+                self.log_message(sender, recipient, message, "private")
                 
-                try:
-                    target_socket.send(formatted_message.encode('utf-8'))
-                    
-                    # confirmation
-                    sender_socket = self.nicknames[sender]
-                    confirm_message = f"[{timestamp}] [Private to {recipient}]: {message}"
-                    sender_socket.send(confirm_message.encode('utf-8'))
-                    
-                    # Log the private message
-                    self.log_message(sender, recipient, message, "private")
-                    
-                    # Update message count
-                    with self.lock:
-                        self.message_count += 1
-                except:
-                    # If there's an issue with the client socket, we'll handle it in the client thread
-                    pass
+                # Update message count
+                MESSAGES_PROCESSED.inc()
             else:
                 # Recipient not found
-                sender_socket = self.nicknames[sender]
-                error_message = f"User '{recipient}' not found or offline."
-                sender_socket.send(error_message.encode('utf-8'))
+                reply = f"User '{recipient}' not found or offline."
+            if sender_state is not None:
+                # the sender may have left in the meantime
+                sender_state.send(reply)
     
-    def send_user_list(self):
-        """Send the updated user list to all clients"""
+    def user_list_changed(self, room, nickname, joined):
+        """Record a join or leave in a room, the update goes out when the delta window closes"""
         with self.lock:
-            user_list = "/users " + ",".join(self.nicknames.keys())
-            for client in self.clients:
-                try:
-                    client.send(user_list.encode('utf-8'))
-                except:
-                    # If there's an issue with the client socket, we'll handle it in the client thread
-                    pass
+            pending = self.pending_deltas.get(room)
+            schedule = pending is None
+            if schedule:
+                pending = self.pending_deltas[room] = {}
+            if nickname in pending:
+                # joining and leaving within one window cancel out
+                del pending[nickname]
+            else:
+                pending[nickname] = "+" if joined else "-"
+        
+        if schedule:
+            if self.delta_window > 0:
+                self.call_later(self.delta_window, self.send_user_list, room)
+            else:
+                self.send_user_list(room)
+    
+    def call_later(self, delay, callback, *args):
+        """Run callback after delay seconds"""
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+    
+    def call_soon(self, callback, *args):
+        """Run callback for another thread, e.g. the shard bus reader"""
+        callback(*args)
+    
+    def send_user_snapshot(self, state, room):
+        """Send a room's full user list to a client that takes deltas afterwards"""
+        if not state.deltas:
+            # old clients get the full list with every update anyway
+            return
+        with self.lock:
+            user_list = user_list_message(room, self.room_nicknames(room))
+        state.send(user_list)
+    
+    def send_user_list(self, room=LOBBY):
+        """Send a room's pending user list changes to the room's members"""
+        with self.lock:
+            pending = self.pending_deltas.pop(room, None)
+            if not pending:
+                # nothing left after joins and leaves cancelled out
+                return
+            members = self.rooms.get(room, {})
+            delta_targets = []
+            full_targets = []
+            for client in members:
+                state = self.clients[client]
+                (delta_targets if state.deltas else full_targets).append(state)
+            user_list = user_list_message(room, self.room_nicknames(room)) if full_targets else None
+        
+        delta = Payload("/users-delta " + ("" if room == LOBBY else f"#{room} ") + ",".join(
+            op + nickname for nickname, op in pending.items()
+        ))
+        for state in delta_targets:
+            state.outbox.put(state.codec.encode_payload(delta))
+        if full_targets:
+            user_list = Payload(user_list)
+            for state in full_targets:
+                state.outbox.put(state.codec.encode_payload(user_list))
+    
+    def room_nicknames(self, room):
+        """Everyone in a room, here and on the other shards, self.lock must be held"""
+        nicknames = list(self.rooms.get(room, {}).values())
+        nicknames.extend(self.remote_members.get(room, ()))
+        return nicknames
+
+def send_buffers(sock, buffers):
+    """Write a batch of messages with one vectored write (sendmsg) where the platform has it"""
+    if len(buffers) == 1 or not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        # drop what went out, a partial write leaves the rest of one buffer
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+        buffers = buffers[done:]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+def listen_unix(path):
+    """A listening Unix stream socket at path, replacing the socket file a previous run left behind"""
+    remove_unix_socket(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        listener.listen(ASYNC_BACKLOG)
+    except OSError:
+        listener.close()
+        raise
+    return listener
+
+def remove_unix_socket(path):
+    """Delete the socket file at path, but never a file that is something else"""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def unix_address(path):
+    """What stands in for a Unix socket peer's address, all of them share the per-IP rate limit"""
+    return (f"unix:{path}", None)
+
+def set_keepalive(sock, idle):
+    """Have the kernel probe a TCP connection that was idle for idle seconds, and end it if the peer is gone"""
+    if not idle or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # the timings can not be set everywhere, the system's defaults apply there
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_PROBES)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+def drop_connection(client):
+    """End the connection of a client the server gave up on, without waiting for what is unsent"""
+    if isinstance(client, Session):
+        client = client.connection
+    if isinstance(client, StreamClient):
+        client.abort()
+    elif not isinstance(client, MuxSession):
+        # a relayed client's session is ended by its link's writer
+        shutdown_connection(client)
+
+def shutdown_connection(connection):
+    """Shut down a client connection, a socket or a StreamClient, that may already be gone"""
+    if connection is None:
+        return
+    try:
+        connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def link_caps_granted(link):
+    """The caps a relay link was granted"""
+    caps = [CAP_MUX]
+    if link.fanout:
+        caps.append(CAP_FANOUT)
+    if link.deflater is not None:
+        caps.append(CAP_COMPRESS)
+    return caps
+
+def link_caps(link):
+    """The server's answer to a relay link's hello"""
+    return FramedCodec().encode(f"/caps {format_caps(link_caps_granted(link))}")
+
+def reading_codec(codec, caps):
+    """The codec a connection's reader decodes with, it inflates first if the connection is compressed"""
+    return InflatingCodec(codec) if CAP_COMPRESS in caps else codec
+
+def random_nicknames(prefix):
+    """Random nicknames to assign instead of a taken one, longer ones once the short ones were tried"""
+    digits = 3
+    while True:
+        yield f"{prefix}User{''.join(random.choices(string.digits, k=digits))}"
+        digits += 1
+
+def assigned_message(requested_nickname, assigned_nickname):
+    return f"Nickname '{requested_nickname}' is taken. You've been assigned '{assigned_nickname}'"
+
+def room_label(room):
+    """Prefix shown before messages of a room, empty for the lobby so old clients see no change"""
+    return "" if room == LOBBY else f"[#{room}] "
+
+def user_list_message(room, nicknames):
+    """Full "/users" list, the lobby keeps the original "/users a,b" format, other rooms name themselves"""
+    prefix = "/users " if room == LOBBY else f"/users #{room} "
+    return prefix + ",".join(nicknames)
+
+def valid_room_name(room):
+    """Room names are short and cannot break the /users or /room syntax"""
+    return 0 < len(room) <= MAX_ROOM_NAME and not any(c in room for c in " ,#\n")
+
+class ClientState:
+    """Everything the server keeps about one registered client.
+
+    One record in ChatServer.clients, keyed by the client's socket or stand-in,
+    instead of an entry in a dict per attribute. With slots here and in the outbox,
+    codec and rate limit bucket, an idle client costs the server around a kilobyte,
+    see chat_bench.py --idle-sessions.
+    """
+    
+    __slots__ = ("client", "nickname", "codec", "outbox", "bucket", "ip", "ip_bucket", "deltas",
+                 "heartbeats", "last_seen", "pinged", "rooms", "current_room")
+    
+    def __init__(self, client, nickname, codec, outbox, bucket, ip, ip_bucket, deltas, heartbeats=False):
+        self.client = client
+        self.nickname = nickname
+        self.codec = codec
+        self.outbox = outbox
+        # rate limiting, the connection's own bucket and the one shared by its IP
+        self.bucket = bucket
+        self.ip = ip
+        self.ip_bucket = ip_bucket
+        # takes "/users-delta" updates instead of full lists
+        self.deltas = deltas
+        # answers "/ping", and when it was last heard from and pinged, in time.monotonic()
+        self.heartbeats = heartbeats
+        self.last_seen = self.pinged = time.monotonic()
+        # room -> sequence number of the oldest history message the client was shown,
+        # for every room it joined, and the room its plain messages go to
+        self.rooms = {}
+        self.current_room = None
+    
+    def send(self, message):
+        """Queue a message, encoded with the client's negotiated codec"""
+        return self.outbox.put(self.codec.encode(message))
+
+class Hello:
+    """A client's hello as far as the handshake got before claiming its nickname"""
+    
+    __slots__ = ("nickname", "prefix", "granted", "codec", "deflater", "replies")
+    
+    def __init__(self, nickname, prefix, granted, codec, deflater, replies):
+        # the requested nickname, and '*' when a relay may keep that prefix on it
+        self.nickname = nickname
+        self.prefix = prefix
+        self.granted = granted
+        self.codec = codec
+        self.deflater = deflater
+        # what goes out ahead of the welcome
+        self.replies = replies
+
+class StreamClient:
+    """Socket-like wrapper around an asyncio stream so ChatServer's shared code can use it"""
+    
+    def __init__(self, writer):
+        self.writer = writer
+    
+    def send(self, data):
+        # StreamWriter.write never blocks, asyncio buffers whatever the socket cannot take yet.
+        # Only used before the client has an outbox, e.g. to refuse a nickname
+        self.writer.write(data)
+        return len(data)
+    
+    def shutdown(self, how):
+        # ends the reader as well, like shutting down a socket
+        self.writer.close()
+    
+    def abort(self):
+        # close waits until the buffered data is sent, which a client that stopped reading never lets happen
+        self.writer.transport.abort()
+    
+    def close(self):
+        self.writer.close()
+
+class AsyncChatServer(ChatServer):
+    """Chat server that serves every client from a single asyncio event loop"""
+    
+    def start(self):
+        """Start the chat server"""
+        raise_fd_limit()
+        
+        # monitoring thread and metrics endpoint
+        self.start_monitoring()
+        
+        # log file
+        self.init_log_file()
+        
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("[Server] Shutting down...")
+        finally:
+            self.close_log()
+    
+    async def serve(self):
+        """Accept connections until the server is stopped"""
+        server = await asyncio.start_server(
+            self.handle_client_async, self.host, self.port,
+            reuse_address=True, reuse_port=bool(self.bus), backlog=ASYNC_BACKLOG
+        )
+        self.loop = asyncio.get_running_loop()
+        self.start_sweeping()
+        print(f"[Server] Listening on {self.host}:{self.port} (asyncio" + (f", shard {self.bus.shard})" if self.bus else ")"))
+        if self.unix_path:
+            unix_server = await asyncio.start_unix_server(self.handle_client_async, sock=listen_unix(self.unix_path))
+            print(f"[Server] Listening on {self.unix_path}")
+        if self.bus:
+            self.bus.start(self)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.unix_path:
+                unix_server.close()
+                remove_unix_socket(self.unix_path)
+    
+    async def handle_client_async(self, reader, writer):
+        """Handle communication with a client on the event loop"""
+        connection = client = StreamClient(writer)
+        # empty for a Unix socket peer
+        address = writer.get_extra_info('peername') or unix_address(self.unix_path)
+        print(f"[Server] New connection from {address}")
+        set_keepalive(writer.get_extra_info('socket'), self.keepalive)
+        exited = False
+        
+        try:
+            nickname_data = await reader.read(BUFSIZE)
+            if is_link_hello(nickname_data):
+                if self.trusts_relay(address):
+                    await self.handle_link_async(reader, writer, address, nickname_data)
+                else:
+                    print(f"[Server] Refused a relay link from {address}, not a trusted relay")
+                return
+            session = self.resume_session(connection, nickname_data)
+            if session is not None:
+                client, nickname, codec = session, session.nickname, reading_codec(FramedCodec(), session.caps)
+            else:
+                client = self.open_session(connection, nickname_data)
+                nickname, codec = await self.register_client_async(client, nickname_data, address)
+                if nickname is None:
+                    await writer.drain()
+                    return
+            
+            while True:
+                data = await reader.read(BUFSIZE)
+                
+                if not data:
+                    break
+                
+                if not self.process_data(client, nickname, codec, data):
+                    exited = True
+                    break
+                
+        except asyncio.CancelledError:
+            # server shutting down, finishing normally keeps asyncio from logging every open connection
+            pass
+        except TimeoutError:
+            # the keepalive probes went unanswered
+            KEEPALIVE_TIMEOUTS.inc()
+            print(f"[Server] Connection from {address} timed out")
+        except Exception as e:
+            print(f"[Error] {e}")
+        finally:
+            if isinstance(client, Session) and not exited:
+                # it may come back
+                self.detach_session(client, connection)
+            else:
+                self.remove_client(client)
+            connection.close()
+    
+    async def register_client_async(self, client_socket, nickname_data, address=None):
+        """register_client for the event loop, a nickname claim waits for the hub without blocking it"""
+        hello, codec = self.negotiate(client_socket, nickname_data, address)
+        if hello is None:
+            return None, codec
+        nickname, reply = await self.choose_nickname_async(hello.nickname, hello.prefix)
+        return self.admit_client(client_socket, hello, nickname, reply, address)
+    
+    async def choose_nickname_async(self, requested_nickname, prefix):
+        if await self.claim_nickname_async(requested_nickname):
+            return requested_nickname, f"Welcome, {requested_nickname}!"
+        for assigned_nickname in random_nicknames(prefix):
+            if await self.claim_nickname_async(assigned_nickname):
+                return assigned_nickname, assigned_message(requested_nickname, assigned_nickname)
+    
+    async def claim_nickname_async(self, nickname):
+        if not self.reserve_nickname(nickname):
+            return False
+        if self.bus and not await self.bus.claim_async(nickname):
+            self.unreserve_nickname(nickname)
+            return False
+        return True
+    
+    def start_link_registration(self, session, hello, address):
+        """Register a session of a relay link in a task of its own, it waits for the hub"""
+        self.loop.create_task(self.register_link_session_async(session, hello, address))
+    
+    async def register_link_session_async(self, session, hello, address):
+        nickname, _ = await self.register_client_async(session, hello, address)
+        self.link_session_registered(session, nickname)
+    
+    async def handle_link_async(self, reader, writer, address, hello):
+        """Serve a relay's multiplexed link on the event loop"""
+        link = self.open_link(hello, address)
+        link.connection = StreamClient(writer)
+        writer.write(link_caps(link))
+        ready = asyncio.Event()
+        link.wakeup = ready.set
+        asyncio.get_running_loop().create_task(self.link_write_loop_async(writer, link, ready))
+        
+        codec = reading_codec(FramedCodec(), link_caps_granted(link))
+        try:
+            while True:
+                data = await reader.read(LINK_BUFSIZE)
+                if not data:
+                    break
+                received = time.perf_counter()
+                BYTES_IN.inc(len(data))
+                for payload in codec.decode_payloads(data):
+                    self.process_link_frame(link, payload, address, received)
+        finally:
+            self.close_link(link)
+    
+    async def link_write_loop_async(self, writer, link, ready):
+        """Write the queued messages of every session on a link until the link is closed"""
+        try:
+            while True:
+                items = link.take_nowait()
+                if items:
+                    frames, ended = link.collect(items)
+                    if frames:
+                        data = b"".join(frames)
+                        if link.deflater is not None:
+                            data = link.deflater.compress(data)
+                        writer.write(data)
+                        MESSAGES_OUT.inc(len(frames))
+                        BYTES_OUT.inc(len(data))
+                    for session in ended:
+                        self.end_session(session)
+                    await writer.drain()
+                    continue
+                if link.closed:
+                    break
+                ready.clear()
+                await ready.wait()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            link.close()
+            if link.cut_off:
+                print(f"[Server] Disconnecting {link.cut_off}")
+            writer.close()
+    
+    def call_later(self, delay, callback, *args):
+        """Run callback after delay seconds on the event loop"""
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback, *args)
+    
+    def call_soon(self, callback, *args):
+        """Run callback on the event loop, the outboxes' wakeups must not be called from other threads"""
+        self.loop.call_soon_threadsafe(callback, *args)
+    
+    def start_session_writer(self, session, outbox):
+        """Start the event-loop task that drains a resumable client's outbox"""
+        ready = asyncio.Event()
+        outbox.wakeup = ready.set
+        asyncio.get_running_loop().create_task(self.session_write_loop_async(session, outbox, ready))
+    
+    async def session_write_loop_async(self, session, outbox, ready):
+        """Write a resumable client's messages to whichever connection it has until its outbox is closed"""
+        try:
+            while True:
+                if self.coalesce_window:
+                    await self.coalesce(outbox, ready)
+                batch = outbox.take_nowait()
+                if batch:
+                    session.record(b"".join(batch))
+                connection, data = session.unwritten()
+                if data is None:
+                    # missed more than the buffer holds, the client has to start over
+                    connection.close()
+                elif data:
+                    connection.writer.write(data)
+                    WRITES.inc()
+                    MESSAGES_OUT.inc(len(batch))
+                    BYTES_OUT.inc(len(data))
+                    try:
+                        await connection.writer.drain()
+                    except (ConnectionError, OSError):
+                        # the reader detaches the session, a resume sends the rest
+                        pass
+                if batch or data:
+                    continue
+                if outbox.closed:
+                    break
+                ready.clear()
+                await ready.wait()
+        finally:
+            outbox.close()
+            if outbox.cut_off:
+                print(f"[Server] Disconnecting {outbox.cut_off}")
+            shutdown_connection(session.connection)
+    
+    def start_writer(self, client, outbox, deflater=None):
+        """Start the event-loop task that drains a client's outbox"""
+        ready = asyncio.Event()
+        outbox.wakeup = ready.set
+        asyncio.get_running_loop().create_task(self.write_loop_async(client, outbox, ready, deflater))
+    
+    async def write_loop_async(self, client, outbox, ready, deflater=None):
+        """Write queued messages to a client until its outbox is closed"""
+        writer = client.writer
+        try:
+            while True:
+                if self.coalesce_window:
+                    await self.coalesce(outbox, ready)
+                batch = outbox.take_nowait()
+                if batch:
+                    if deflater is not None:
+                        data = deflater.compress(b"".join(batch))
+                        writer.write(data)
+                        BYTES_OUT.inc(len(data))
+                    else:
+                        # a vectored write where the event loop's transport has one
+                        writer.writelines(batch)
+                        BYTES_OUT.inc(sum(len(data) for data in batch))
+                    WRITES.inc()
+                    MESSAGES_OUT.inc(len(batch))
+                    # waits while the socket's send buffer is full, the outbox absorbs the backlog
+                    await writer.drain()
+                    continue
+                if outbox.closed:
+                    break
+                ready.clear()
+                await ready.wait()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            outbox.close()
+            if outbox.cut_off:
+                print(f"[Server] Disconnecting {outbox.cut_off}")
+            client.close()
+
+    async def coalesce(self, outbox, ready):
+        """Wait up to the coalescing window for more of a client's messages before they are taken"""
+        if not outbox.linger(self.coalesce_bytes):
+            return
+        # the outbox wakes the writer early if the batch fills up
+        timer = asyncio.get_running_loop().call_later(self.coalesce_window, ready.set)
+        ready.clear()
+        try:
+            await ready.wait()
+        finally:
+            timer.cancel()
+
+def raise_fd_limit():
+    """Raise the open file limit to the hard limit so the event loop can hold many sockets"""
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
 
 def main():
     parser = argparse.ArgumentParser(description='Chat Server')
     parser.add_argument('--host', dest="host", default=HOST, help=f'Host address (default: {HOST})')
     parser.add_argument('--port', dest="port", type=int, default=PORT, help=f'Port to listen on (default: {PORT})')
+    parser.add_argument('--engine', dest="engine", choices=ENGINES, default="threads",
+                        help='Connection engine: one thread per client or a single asyncio event loop (default: threads)')
+    parser.add_argument('--queue-size', dest="queue_size", type=int, default=QUEUE_SIZE,
+                        help=f'Outbound messages queued per client before the overflow policy applies (default: {QUEUE_SIZE})')
+    parser.add_argument('--overflow', dest="overflow", choices=OVERFLOW_POLICIES, default=DROP_OLDEST,
+                        help=f'What to do when a client\'s outbound queue is full (default: {DROP_OLDEST})')
+    parser.add_argument('--delta-window', dest="delta_window", type=float, default=DELTA_WINDOW,
+                        help=f'Seconds of joins and leaves coalesced into one user list update (default: {DELTA_WINDOW})')
+    parser.add_argument('--metrics-port', dest="metrics_port", type=int,
+                        help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (default: off)')
+    parser.add_argument('--log-batch', dest="log_batch", type=int, default=BATCH_SIZE,
+                        help=f'Log records written per batch (default: {BATCH_SIZE})')
+    parser.add_argument('--log-flush-interval', dest="log_flush_interval", type=float, default=FLUSH_INTERVAL,
+                        help=f'Seconds a log record may wait before its batch is written (default: {FLUSH_INTERVAL})')
+    parser.add_argument('--log-fsync', dest="log_fsync", choices=FSYNC_POLICIES, default="none",
+                        help='When to fsync the log file (default: none)')
+    parser.add_argument('--rate', dest="rate", type=float, default=RATE,
+                        help=f'Public messages per second each client may send, 0 disables (default: {RATE:.2f})')
+    parser.add_argument('--burst', dest="burst", type=int, default=BURST,
+                        help=f'Messages a client may send in a burst (default: {BURST})')
+    parser.add_argument('--ip-rate', dest="ip_rate", type=float, default=0,
+                        help='Public messages per second shared by all clients from one IP, 0 disables (default: 0)')
+    parser.add_argument('--ip-burst', dest="ip_burst", type=int, default=0,
+                        help='Burst size of the per-IP limit (default: same as --burst)')
+    parser.add_argument('--global-rate', dest="global_rate", type=float, default=0,
+                        help='Public messages per second for the whole server, 0 disables (default: 0)')
+    parser.add_argument('--global-burst', dest="global_burst", type=int, default=0,
+                        help='Burst size of the global limit (default: same as --burst)')
+    parser.add_argument('--log-dir', dest="log_dir",
+                        help=f'Keep the log as rotating, compressed segments in this directory instead of {LOG_FILE}')
+    parser.add_argument('--segment-size', dest="segment_size", type=int, default=SEGMENT_SIZE,
+                        help=f'Bytes per log segment before rotating (default: {SEGMENT_SIZE})')
+    parser.add_argument('--max-segments', dest="max_segments", type=int, default=MAX_SEGMENTS,
+                        help=f'Log segments kept before the oldest is deleted, 0 keeps all (default: {MAX_SEGMENTS})')
+    parser.add_argument('--history-size', dest="history_size", type=int, default=HISTORY_SIZE,
+                        help=f'Bytes of recent messages kept per room, 0 disables the history (default: {HISTORY_SIZE})')
+    parser.add_argument('--history-replay', dest="history_replay", type=int, default=HISTORY_REPLAY,
+                        help=f'Recent messages sent to a client entering a room (default: {HISTORY_REPLAY})')
+    parser.add_argument('--resume-grace', dest="resume_grace", type=float, default=RESUME_GRACE,
+                        help=f'Seconds a dropped client can resume its session, 0 disables resuming (default: {RESUME_GRACE:.0f})')
+    parser.add_argument('--resume-buffer', dest="resume_buffer", type=int, default=RESUME_BUFFER,
+                        help=f'Bytes of recent messages kept per session for a resume (default: {RESUME_BUFFER})')
+    parser.add_argument('--coalesce-window', dest="coalesce_window", type=float, default=COALESCE_WINDOW,
+                        help='Seconds a client\'s writer waits for more messages before writing them together, '
+                             'e.g. 0.002 (default: 0, write at once)')
+    parser.add_argument('--coalesce-bytes', dest="coalesce_bytes", type=int, default=COALESCE_BYTES,
+                        help=f'Bytes gathered for a client that end the coalescing window early (default: {COALESCE_BYTES})')
+    parser.add_argument('--workers', dest="workers", type=int, default=1,
+                        help='Worker processes sharing the port with SO_REUSEPORT, each logging to its own file (default: 1)')
+    parser.add_argument('--unix-socket', dest="unix_socket", metavar="PATH",
+                        help='Also listen on a Unix socket at PATH, for relays on the same host (default: off)')
+    parser.add_argument('--heartbeat', dest="heartbeat", type=float, default=HEARTBEAT_INTERVAL,
+                        help=f'Seconds of silence after which clients with the ping capability are pinged, 0 for never '
+                             f'(default: {HEARTBEAT_INTERVAL:g})')
+    parser.add_argument('--idle-timeout', dest="idle_timeout", type=float, default=IDLE_TIMEOUT,
+                        help=f'Seconds after which a client with the ping capability that sent nothing is disconnected, '
+                             f'0 for never, needs --heartbeat (default: {IDLE_TIMEOUT:g})')
+    parser.add_argument('--keepalive', dest="keepalive", type=int, default=KEEPALIVE_IDLE,
+                        help=f'Seconds a TCP connection is idle before keepalive probes check on the peer, 0 for off '
+                             f'(default: {KEEPALIVE_IDLE})')
+    parser.add_argument('--max-backlog', dest="max_backlog", type=int, default=MAX_BACKLOG,
+                        help=f'Bytes waiting for a client after which it is disconnected as too slow, 0 for no limit '
+                             f'(default: {MAX_BACKLOG})')
+    parser.add_argument('--max-backlog-age', dest="max_backlog_age", type=float, default=MAX_BACKLOG_AGE,
+                        help=f'Seconds a message may wait for a client before it is disconnected as too slow, '
+                             f'0 for no limit (default: {MAX_BACKLOG_AGE:g})')
+    parser.add_argument('--trusted-relay', dest="trusted_relays", action="append", metavar="ADDRESS",
+                        help=f'IP address a relay may connect from, repeat for several; only these may open relay links '
+                             f'or flag hellos as relayed (default: {", ".join(TRUSTED_RELAYS)}, and the Unix socket)')
     args = parser.parse_args()
     
-    server = ChatServer(args.host, args.port)
+    if args.idle_timeout and args.heartbeat and args.heartbeat >= args.idle_timeout:
+        parser.error("--idle-timeout must be longer than --heartbeat, or clients are disconnected before they are pinged")
+    if args.unix_socket and not hasattr(socket, "AF_UNIX"):
+        parser.error("--unix-socket needs Unix domain sockets, which this platform does not have")
+    if args.workers > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers needs SO_REUSEPORT, which this platform does not have")
+        if args.unix_socket:
+            parser.error("--workers cannot share a Unix socket, connect relays over TCP")
+        run_shards(args.workers, serve, args)
+    else:
+        serve(args)
+
+def serve(args, shard=None, bus=None):
+    """Run a server configured by the command line, or one shard of it"""
+    log_file = LOG_FILE
+    log_dir = args.log_dir
+    metrics_port = args.metrics_port
+    if shard:
+        # every shard logs on its own and serves its own metrics, on consecutive ports
+        name, extension = os.path.splitext(LOG_FILE)
+        log_file = f"{name}.shard{shard}{extension}"
+        log_dir = log_dir and os.path.join(log_dir, f"shard{shard}")
+        metrics_port = metrics_port and metrics_port + shard - 1
+    
+    if log_dir:
+        log_writer = LogStore(log_dir, args.segment_size, args.max_segments, True,
+                              args.log_batch, args.log_flush_interval, args.log_fsync)
+    else:
+        log_writer = LogWriter(log_file, args.log_batch, args.log_flush_interval, args.log_fsync)
+    server_class = AsyncChatServer if args.engine == "asyncio" else ChatServer
+    rate_limiter = RateLimiter(args.rate, args.burst, args.ip_rate, args.ip_burst, args.global_rate, args.global_burst)
+    server = server_class(args.host, args.port, args.queue_size, args.overflow, log_writer, args.delta_window,
+                          rate_limiter, metrics_port, bus, args.history_size, args.history_replay,
+                          args.resume_grace, args.resume_buffer, args.coalesce_window, args.coalesce_bytes,
+                          args.unix_socket, args.heartbeat, args.idle_timeout, args.keepalive, args.max_backlog,
+                          args.max_backlog_age, args.trusted_relays or TRUSTED_RELAYS)
     server.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import secrets
+import threading
+from collections import deque
+
+# Session resumption, see chat_protocol for the handshake.
+#
+# A client that asks for the resume capability is registered as a Session, which
+# stands in for its connection in ChatServer the way a MuxSession does for relay
+# clients. When the connection drops the session stays registered, with its
+# nickname, rooms and outbox, for a grace period. A new connection that presents
+# the session's token and the stream offset it got to takes over and receives
+# only what it missed, nobody sees the client leave and join again.
+
+# seconds a dropped session waits for its client, 0 disables resumption
+RESUME_GRACE = 30.0
+# bytes of recently written messages kept per session for a resume
+RESUME_BUFFER = 64 * 1024
+
+class Session:
+    """A resumable client, outlives its connection for the grace period.
+
+    Everything written to the client is a stream numbered by byte offset, the
+    offsets are the messages' sequence numbers. The last buffer_size bytes are
+    kept, so a resume can be served from any offset the client may have reached.
+    One writer per session drains the outbox into whatever connection it has.
+    """
+
+    def __init__(self, connection, buffer_size=RESUME_BUFFER):
+        self.token = secrets.token_urlsafe(16)
+        self.connection = connection
+        self.buffer_size = buffer_size
+        self.nickname = None
+        # caps granted at registration, repeated to resuming connections
+        self.caps = []
+        # bumped whenever the session changes hands, a grace timer only expires the detachment it was set for
+        self.generation = 0
+        # recent stream data, the offset after its last byte, and how far the connection has been sent
+        self.chunks = deque()
+        self.buffered = 0
+        self.sent = 0
+        self.written = 0
+        # written before the stream on a new connection, not part of it ("/caps ...")
+        self.greeting = b""
+        # compresses the stream for the current connection when it negotiated zlib, a new one per connection
+        self.deflater = None
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        # Only used before the session has an outbox, to refuse it
+        return self.connection.send(data)
+
+    def record(self, data):
+        """Append data the writer is about to send to the stream"""
+        if not data:
+            return
+        with self.lock:
+            self.chunks.append(data)
+            self.buffered += len(data)
+            self.sent += len(data)
+            while self.buffered - len(self.chunks[0]) >= self.buffer_size:
+                self.buffered -= len(self.chunks.popleft())
+
+    def unwritten(self):
+        """The connection and what it has not been sent yet, data is None if that is no longer buffered"""
+        with self.lock:
+            connection = self.connection
+            if connection is None:
+                return None, b""
+            greeting, self.greeting = self.greeting, b""
+            if self.written == self.sent:
+                return connection, greeting
+            data = self._since(self.written)
+            if data is None:
+                return connection, None
+            self.written = self.sent
+            if self.deflater is not None:
+                data = self.deflater.compress(data)
+            return connection, greeting + data
+
+    def _since(self, offset):
+        if not self.sent - self.buffered <= offset <= self.sent:
+            return None
+        # usually just the last chunk, joined only when a resume needs more
+        parts = []
+        start = self.sent
+        for chunk in reversed(self.chunks):
+            if start <= offset:
+                break
+            start -= len(chunk)
+            parts.append(chunk)
+        parts.reverse()
+        if start < offset:
+            parts[0] = parts[0][offset - start:]
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def attach(self, connection, offset, greeting, deflater=None):
+        """Continue the stream on a new connection from offset, False if that part is no longer buffered"""
+        with self.lock:
+            if not self.sent - self.buffered <= offset <= self.sent:
+                return False
+            self.connection = connection
+            self.written = offset
+            self.greeting = greeting
+            self.deflater = deflater
+            self.generation += 1
+        return True
+
+    def detach(self, connection):
+        """The connection dropped, returns the generation to expire or None if a resume already took over"""
+        with self.lock:
+            if self.connection is not connection:
+                return None
+            self.connection = None
+            self.generation += 1
+            return self.generation
@@ -0,0 +1,314 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import socket
+import threading
+from chat_outbox import Outbox, DISCONNECT
+from chat_protocol import ENCODING, FramedCodec, encode_mux, decode_mux
+
+# Sharded server: several worker processes accept on the same port (SO_REUSEPORT),
+# each one a complete ChatServer for the clients the kernel hands it. What has to be
+# global goes over a local bus, a Unix socket pair between every worker and the hub
+# in the parent process:
+#   claim, release - nicknames, the hub keeps them unique across workers
+#   join, leave    - room memberships, every worker keeps a copy of the others' so
+#                    user lists and room counts cover the whole server
+#   broadcast      - a room message, sent on to the workers with members in the room,
+#                    or to every worker if it is a chat message kept in the room history
+#   private        - sent on to the worker that has the recipient, the hub answers
+#                    the sender's worker with delivered or unknown
+# Bus frames are multiplexed link frames (chat_protocol.encode_mux). The id is a
+# claim's request id, 1 for a broadcast kept in the history and 0 otherwise, bodies
+# are newline separated fields.
+
+BUS_CLAIM = 1
+BUS_CLAIMED = 2
+BUS_RELEASE = 3
+BUS_JOIN = 4
+BUS_LEAVE = 5
+BUS_BROADCAST = 6
+BUS_PRIVATE = 7
+BUS_DELIVERED = 8
+BUS_UNKNOWN = 9
+
+BUS_BUFSIZE = 65536
+# a bus connection carries a whole worker's traffic
+BUS_QUEUE_SIZE = 1024 * 1024
+# seconds a registering client waits for the hub before its nickname counts as taken
+CLAIM_TIMEOUT = 5
+
+def encode_fields(*fields):
+    return "\n".join(fields).encode(ENCODING)
+
+def decode_fields(body, count):
+    """Split a body into count fields, the last one may contain newlines"""
+    return body.decode(ENCODING).split("\n", count - 1)
+
+def resolve(future, result):
+    # a claim that timed out was cancelled by wait_for
+    if not future.done():
+        future.set_result(result)
+
+class BusConnection:
+    """One end of a bus socket, frames are queued and written by a writer thread"""
+
+    def __init__(self, bus_socket):
+        self.socket = bus_socket
+        # a lost frame would leave the shards' nicknames and rooms out of step, the connection is dropped
+        # instead and its reader ends: the hub forgets the worker, a worker shuts down
+        self.outbox = Outbox(BUS_QUEUE_SIZE, DISCONNECT)
+        writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        writer_thread.start()
+
+    def send(self, request_id, kind, body=b""):
+        # never blocks, so it is safe with the server's lock held
+        if not self.outbox.put(encode_mux(request_id, kind, body)) and self.outbox.cut_off:
+            # the writer may be stuck in a send, this ends it and the reader
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def write_loop(self):
+        try:
+            while True:
+                batch = self.outbox.take()
+                if not batch:
+                    break
+                self.socket.sendall(b"".join(batch))
+        except OSError:
+            pass
+        finally:
+            self.outbox.close()
+            if self.outbox.cut_off:
+                print(f"[Bus] Dropping the connection, over {BUS_QUEUE_SIZE} frames were waiting to be sent")
+
+    def frames(self):
+        """Yield (request id, kind, body) for every frame received until the other end closes"""
+        codec = FramedCodec()
+        while True:
+            data = self.socket.recv(BUS_BUFSIZE)
+            if not data:
+                return
+            for payload in codec.decode_payloads(data):
+                yield decode_mux(payload)
+
+    def close(self):
+        self.outbox.close()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+class ShardBus(BusConnection):
+    """A worker's end of the bus, used by ChatServer when it runs as one shard of several"""
+
+    def __init__(self, bus_socket, shard):
+        super().__init__(bus_socket)
+        self.shard = shard
+        self.server = None
+        self.request_ids = itertools.count(1)
+        # request id -> callback taking whether the claim was granted
+        self.claims = {}
+
+    def start(self, server):
+        """Start handing the other workers' frames to the server"""
+        self.server = server
+        reader_thread = threading.Thread(target=self.read_loop, daemon=True)
+        reader_thread.start()
+
+    def claim(self, nickname):
+        """Ask the hub for a nickname, blocks the calling thread for the round trip"""
+        event = threading.Event()
+        result = []
+        def granted(answer):
+            result.append(answer)
+            event.set()
+        request_id = self.request_claim(nickname, granted)
+        if event.wait(CLAIM_TIMEOUT):
+            return result[0]
+        return self.claim_timed_out(request_id, nickname)
+
+    async def claim_async(self, nickname):
+        """claim for the asyncio engine, the event loop goes on while the hub answers"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def granted(answer):
+            loop.call_soon_threadsafe(resolve, future, answer)
+        request_id = self.request_claim(nickname, granted)
+        try:
+            return await asyncio.wait_for(future, CLAIM_TIMEOUT)
+        except asyncio.TimeoutError:
+            return self.claim_timed_out(request_id, nickname)
+
+    def request_claim(self, nickname, granted):
+        request_id = next(self.request_ids)
+        self.claims[request_id] = granted
+        self.send(request_id, BUS_CLAIM, nickname.encode(ENCODING))
+        return request_id
+
+    def claim_timed_out(self, request_id, nickname):
+        """The nickname counts as taken. Released as well, in case the hub grants it after all:
+        the hub handles a worker's frames in order, so the release comes after the grant"""
+        self.claims.pop(request_id, None)
+        self.release(nickname)
+        return False
+
+    def release(self, nickname):
+        self.send(0, BUS_RELEASE, nickname.encode(ENCODING))
+
+    def member_changed(self, room, nickname, joined):
+        self.send(0, BUS_JOIN if joined else BUS_LEAVE, encode_fields(room, nickname))
+
+    def broadcast(self, room, message, keep=False):
+        self.send(1 if keep else 0, BUS_BROADCAST, encode_fields(room, message))
+
+    def private(self, sender, recipient, message):
+        self.send(0, BUS_PRIVATE, encode_fields(sender, recipient, message))
+
+    def read_loop(self):
+        server = self.server
+        try:
+            for request_id, kind, body in self.frames():
+                if kind == BUS_CLAIMED:
+                    granted = self.claims.pop(request_id, None)
+                    if granted is not None:
+                        granted(body == b"1")
+                elif kind == BUS_BROADCAST:
+                    room, message = decode_fields(body, 2)
+                    server.call_soon(server.broadcast_local, message, None, room, request_id == 1)
+                elif kind in (BUS_JOIN, BUS_LEAVE):
+                    room, nickname = decode_fields(body, 2)
+                    server.call_soon(server.remote_member_changed, room, nickname, kind == BUS_JOIN)
+                elif kind == BUS_PRIVATE:
+                    server.call_soon(server.deliver_private, *decode_fields(body, 3))
+                elif kind in (BUS_DELIVERED, BUS_UNKNOWN):
+                    server.call_soon(server.private_sent, *decode_fields(body, 3), kind == BUS_DELIVERED)
+        except Exception as e:
+            print(f"[Shard {self.shard} Error] {e}")
+        # without the hub nicknames could no longer be kept unique
+        print(f"[Shard {self.shard}] Lost the bus, shutting down")
+        server.close_log()
+        os._exit(1)
+
+class ShardHub:
+    """The parent process's end of the bus, owns the nickname registry and routes frames between workers"""
+
+    def __init__(self):
+        # shard -> BusConnection
+        self.workers = {}
+        # nickname -> shard that has the client
+        self.nicknames = {}
+        # room -> {shard: members there}, and shard -> {(room, nickname)} to clean up after a worker
+        self.rooms = {}
+        self.members = {}
+        self.lock = threading.Lock()
+
+    def add_worker(self, shard, bus_socket):
+        connection = BusConnection(bus_socket)
+        with self.lock:
+            self.workers[shard] = connection
+            self.members[shard] = set()
+        reader_thread = threading.Thread(target=self.read_loop, args=(shard, connection), daemon=True)
+        reader_thread.start()
+
+    def read_loop(self, shard, connection):
+        try:
+            for request_id, kind, body in connection.frames():
+                self.route(shard, connection, request_id, kind, body)
+        except Exception as e:
+            print(f"[Hub Error] {e}")
+        finally:
+            self.remove_worker(shard)
+            connection.close()
+
+    def route(self, shard, connection, request_id, kind, body):
+        """Handle one frame from a worker"""
+        with self.lock:
+            if kind == BUS_CLAIM:
+                nickname = body.decode(ENCODING)
+                granted = nickname not in self.nicknames
+                if granted:
+                    self.nicknames[nickname] = shard
+                connection.send(request_id, BUS_CLAIMED, b"1" if granted else b"0")
+            elif kind == BUS_RELEASE:
+                nickname = body.decode(ENCODING)
+                if self.nicknames.get(nickname) == shard:
+                    del self.nicknames[nickname]
+            elif kind in (BUS_JOIN, BUS_LEAVE):
+                room, nickname = decode_fields(body, 2)
+                self.member_changed(shard, room, nickname, kind == BUS_JOIN)
+                self.send_to_others(shard, kind, body)
+            elif kind == BUS_BROADCAST:
+                room, _ = decode_fields(body, 2)
+                # every worker keeps the whole history, it may get members of the room later
+                for other in (self.workers if request_id else self.rooms.get(room, ())):
+                    if other != shard:
+                        self.workers[other].send(request_id, kind, body)
+            elif kind == BUS_PRIVATE:
+                _, recipient, _ = decode_fields(body, 3)
+                owner = self.nicknames.get(recipient)
+                if owner is not None:
+                    self.workers[owner].send(0, BUS_PRIVATE, body)
+                connection.send(0, BUS_UNKNOWN if owner is None else BUS_DELIVERED, body)
+
+    def member_changed(self, shard, room, nickname, joined):
+        """Track which workers have members in which room, self.lock must be held"""
+        members = self.members[shard]
+        shards = self.rooms.setdefault(room, {})
+        if joined and (room, nickname) not in members:
+            members.add((room, nickname))
+            shards[shard] = shards.get(shard, 0) + 1
+        elif not joined and (room, nickname) in members:
+            members.discard((room, nickname))
+            shards[shard] -= 1
+            if not shards[shard]:
+                del shards[shard]
+        if not shards:
+            del self.rooms[room]
+
+    def send_to_others(self, shard, kind, body):
+        for other, worker in self.workers.items():
+            if other != shard:
+                worker.send(0, kind, body)
+
+    def remove_worker(self, shard):
+        """A worker exited, its clients are gone from every room and their nicknames are free again"""
+        with self.lock:
+            self.workers.pop(shard, None)
+            for room, nickname in sorted(self.members.pop(shard, ())):
+                self.send_to_others(shard, BUS_LEAVE, encode_fields(room, nickname))
+            for shards in self.rooms.values():
+                shards.pop(shard, None)
+            self.rooms = {room: shards for room, shards in self.rooms.items() if shards}
+            for nickname in [nickname for nickname, owner in self.nicknames.items() if owner == shard]:
+                del self.nicknames[nickname]
+        print(f"[Hub] Worker {shard} left the bus")
+
+def run_shards(count, target, *args):
+    """Run target(*args, shard, bus) in count worker processes and serve their bus until they all exit"""
+    hub = ShardHub()
+    processes = []
+    for shard in range(1, count + 1):
+        hub_socket, worker_socket = socket.socketpair()
+        process = multiprocessing.Process(target=run_worker, args=(target, args, shard, worker_socket, hub_socket))
+        process.start()
+        worker_socket.close()
+        hub.add_worker(shard, hub_socket)
+        processes.append(process)
+    print(f"[Server] {count} worker processes sharing the port")
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # the workers got the interrupt as well, let them write out their logs
+        for process in processes:
+            process.join()
+
+def run_worker(target, args, shard, worker_socket, hub_socket):
+    # forked workers inherit the parent's end, it has to be closed for the worker to see the hub go
+    hub_socket.close()
+    target(*args, shard, ShardBus(worker_socket, shard))
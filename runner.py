@@ -8,7 +8,7 @@ class ChatLauncher:
     def __init__(self, root):
         self.root = root
         self.root.title("Chat Launcher")
-        self.root.geometry("400x400")
+        self.root.geometry("400x440")
         self.root.resizable(False, False)
         
         # style
@@ -38,6 +38,12 @@ class ChatLauncher:
         self.server_port = tk.StringVar(value="8888")
         ttk.Entry(server_frame, textvariable=self.server_port, width=6).grid(row=0, column=3, padx=5, pady=5)
         
+        # Unix socket the relay connects through, empty for TCP only
+        ttk.Label(server_frame, text="Unix socket:").grid(row=1, column=0, padx=5, pady=5, sticky=tk.W)
+        self.server_socket = tk.StringVar(value="")
+        ttk.Entry(server_frame, textvariable=self.server_socket, width=30).grid(row=1, column=1, columnspan=3,
+                                                                             padx=5, pady=5, sticky=tk.W)
+        
         # Relay settings frame
         relay_frame = ttk.LabelFrame(main_frame, text="Relay Settings")
         relay_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -106,9 +112,13 @@ class ChatLauncher:
             
             # Start new server process
             cmd = [sys.executable, "chat_server.py", "--host", server_host, "--port", server_port]
+            server_socket = self.server_socket.get().strip()
+            if server_socket:
+                cmd += ["--unix-socket", server_socket]
             self.processes["server"] = subprocess.Popen(cmd)
             
-            self.status_var.set(f"Server started on {server_host}:{server_port}")
+            self.status_var.set(f"Server started on {server_host}:{server_port}"
+                                + (f" and {server_socket}" if server_socket else ""))
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start server: {e}")
@@ -132,6 +142,10 @@ class ChatLauncher:
                    "--relay-port", relay_port,
                    "--server-host", server_host,
                    "--server-port", server_port]
+            # the relay reaches the server through its Unix socket when it has one
+            server_socket = self.server_socket.get().strip()
+            if server_socket:
+                cmd += ["--server-socket", server_socket]
             self.processes["relay"] = subprocess.Popen(cmd)
             
             self.status_var.set(f"Relay started on {relay_host}:{relay_port}")
@@ -0,0 +1,21 @@
+import unittest
+
+from chat_bench import LatencyRecorder
+
+class LatencyRecorderTest(unittest.TestCase):
+
+    def test_single_sample(self):
+        recorder = LatencyRecorder()
+        recorder.record(0.0123)
+        summary = recorder.summary()
+        # the sample's bucket reaches past it, the percentiles stop at the slowest sample
+        self.assertEqual(summary["max_ms"], 12.3)
+        for key in ("p50_ms", "p99_ms", "p999_ms"):
+            self.assertLessEqual(summary[key], summary["max_ms"])
+            self.assertAlmostEqual(summary[key], 12.3, delta=12.3 * LatencyRecorder.GROWTH - 12.3)
+
+    def test_no_samples(self):
+        self.assertIsNone(LatencyRecorder().percentile(0.5))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import socket
+import unittest
+
+from chat_protocol import CAP_FRAMED, CAP_PING, RELAYED, build_hello
+from chat_server import ChatServer
+from chat_mux import MuxLink, MuxSession
+from chat_log import LogWriter
+
+def make_server(**options):
+    """A server that is never started, its clients are sessions of a relay link"""
+    server = ChatServer("127.0.0.1", 0, log_writer=LogWriter(os.devnull), **options)
+    # sweeps are run by hand
+    server.call_later = lambda delay, callback, *args: None
+    return server
+
+def register(server, link, session_id, nickname, caps=(CAP_FRAMED, CAP_PING)):
+    session = link.sessions[session_id] = MuxSession(link, session_id)
+    session.nickname, _ = server.register_client(session, build_hello(nickname, list(caps)), ("127.0.0.1", None))
+    return session
+
+def sent(link):
+    """The frames the link's writer would send, as one bytes object"""
+    frames, _ = link.collect(link.take_nowait())
+    return b"".join(frames)
+
+class SweepTest(unittest.TestCase):
+
+    def quiet_client(self, **options):
+        server = make_server(**options)
+        link = MuxLink("test")
+        session = register(server, link, 1, "lurker")
+        sent(link)
+        state = server.clients[session]
+        state.last_seen -= 100
+        state.pinged -= 100
+        return server, link, state
+
+    def test_idle_client_is_pinged_then_reaped(self):
+        server, link, state = self.quiet_client(heartbeat=1, idle_timeout=2)
+        state.last_seen += 99
+        server.sweep()
+        self.assertIn(b"/ping", sent(link))
+        self.assertIsNone(state.outbox.cut_off)
+        state.last_seen -= 99
+        server.sweep()
+        self.assertIn("answered nothing", state.outbox.cut_off)
+
+    def test_no_idle_timeout_without_heartbeats(self):
+        # a client that is never pinged has no reason to send anything
+        server, link, state = self.quiet_client(heartbeat=0, idle_timeout=2)
+        server.sweep()
+        self.assertIsNone(state.outbox.cut_off)
+        self.assertNotIn(b"/ping", sent(link))
+
+class LinkBacklogTest(unittest.TestCase):
+
+    def test_link_over_its_byte_limit_is_cut_off(self):
+        link = MuxLink("test", max_bytes=100)
+        link.schedule(b"x" * 60)
+        self.assertIsNone(link.cut_off)
+        link.schedule(b"x" * 60)
+        self.assertIn("over 100 bytes", link.cut_off)
+        # nothing is left for the writer, and nothing more gets queued
+        self.assertEqual(link.take_nowait(), [])
+        link.schedule(b"x")
+        self.assertEqual(link.take_nowait(), [])
+
+    def test_sweep_cuts_off_a_stalled_link(self):
+        server = make_server(max_backlog_age=2)
+        link = server.open_link(build_hello("relay", []), ("127.0.0.1", None))
+        register(server, link, 1, "lurker")
+        server.sweep()
+        self.assertIsNone(link.cut_off)
+        link.since -= 100
+        server.sweep()
+        self.assertIn("waited over 2 seconds", link.cut_off)
+
+class NicknameTest(unittest.TestCase):
+
+    def test_room_and_list_separators_are_refused(self):
+        # either would make a user list of the lobby look like one of a room
+        server = make_server()
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        for nickname in ("#dev", "a,b"):
+            hello, _ = server.negotiate(ours, build_hello(nickname, [CAP_FRAMED]), ("127.0.0.1", 40000))
+            self.assertIsNone(hello)
+        self.assertIn(b"cannot contain '#'", theirs.recv(4096))
+        hello, _ = server.negotiate(ours, build_hello("dev", [CAP_FRAMED]), ("127.0.0.1", 40000))
+        self.assertEqual(hello.nickname, "dev")
+
+class TrustedRelayTest(unittest.TestCase):
+
+    def test_relayed_hello_only_counts_from_a_trusted_relay(self):
+        server = make_server()
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        hello = build_hello("*amy", [CAP_FRAMED, RELAYED])
+        accepted, _ = server.negotiate(ours, hello, ("127.0.0.1", 40000))
+        self.assertEqual(accepted.prefix, "*")
+        # anyone else asking for the relay prefix is told the nickname is not allowed
+        refused, _ = server.negotiate(ours, hello, ("203.0.113.7", 40000))
+        self.assertIsNone(refused)
+        self.assertTrue(server.trusts_relay(("unix:/tmp/chat.sock", None)))
+        self.assertFalse(server.trusts_relay(("203.0.113.7", 40000)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import socket
+import unittest
+
+from chat_shard import BusConnection, BUS_BROADCAST
+
+class BusConnectionTest(unittest.TestCase):
+
+    def test_overflowing_bus_is_dropped(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        bus = BusConnection(ours)
+        self.addCleanup(bus.close)
+        # the other end never reads, the writer gets stuck once the socket buffers are full
+        bus.outbox.max_messages = 8
+        for _ in range(100000):
+            bus.send(0, BUS_BROADCAST, b"x" * 1000)
+            if bus.outbox.cut_off:
+                break
+        self.assertIsNotNone(bus.outbox.cut_off)
+        # the connection is shut down, so its reader ends instead of going on with a lost frame
+        ours.settimeout(1)
+        self.assertEqual(list(bus.frames()), [])
+
+if __name__ == "__main__":
+    unittest.main()